@@ -1,74 +1,542 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from collections import namedtuple, OrderedDict
+from contextlib import closing
+from functools import partial
+import hashlib
+import io
 import os
 import re
 import shutil
-from zipfile import ZipFile
+import threading
+from zipfile import BadZipfile, ZipFile
 
-from kepler.exceptions import FileNotFound, InvalidAccessLevel
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from werkzeug.utils import cached_property
+
+from kepler.exceptions import FileNotFound, InvalidAccessLevel, InvalidBag
 from kepler.records import rights_mapper
 
 
+COPY_BUFFER_SIZE = 1024 * 1024
+NESTED_ZIP_MEMORY_LIMIT = 64 * 1024 * 1024
+
+BagMember = namedtuple('BagMember', ['name', 'size', 'offset', 'crc'])
+
+
+class BaseBag(object):
+    """Common interface for bags.
+
+    Payload files are classified by suffix the first time they are looked
+    for, and the values derived from them (datatype, access level and layer
+    name) are computed once and cached on the instance. Passing the same
+    instance from task to task means the bag is only inspected once per job.
+
+    Subclasses provide ``payload`` and ``tagfiles``, lists of payload and
+    top level file names relative to the bag directory, along with
+    :meth:`open` and :meth:`extract`.
+    """
+
+    payload = ()
+    tagfiles = ()
+    gdal_archive = None
+
+    def find(self, endswith):
+        """Return the name of the first payload file ending with a suffix.
+
+        :param endswith: file name suffix, such as ``.tif``
+        :returns: file name relative to the bag directory
+        """
+
+        found = self.__dict__.setdefault('_found', {})
+        if endswith not in found:
+            found[endswith] = next(
+                (n for n in self.payload if n.endswith(endswith)), None)
+        if found[endswith] is None:
+            raise FileNotFound("No file in bag ending with %s" % endswith)
+        return found[endswith]
+
+    def open(self, name):
+        raise NotImplementedError
+
+    def extract(self, name):
+        raise NotImplementedError
+
+    def size(self, name):
+        """Return the uncompressed size of a file in bytes."""
+        raise NotImplementedError
+
+    def gdal_path(self, name):
+        """Return a path GDAL can open a file at.
+
+        The file is extracted, unless the bag can be read in place through a
+        GDAL virtual file system.
+
+        :param name: file name relative to the bag directory
+        """
+
+        return self.extract(name)
+
+    def read(self, name):
+        with closing(self.open(name)) as fp:
+            return fp.read()
+
+    @property
+    def fgdc(self):
+        return self.extract(self.find('.xml'))
+
+    @property
+    def shapefile(self):
+        return self.extract(self.find('.zip'))
+
+    @property
+    def geotiff(self):
+        return self.extract(self.find('.tif'))
+
+    @cached_property
+    def shapefile_name(self):
+        return _layer_name(self.shapefile)
+
+    @cached_property
+    def geotiff_name(self):
+        return _basename(self.find('.tif'))
+
+    @cached_property
+    def datatype(self):
+        try:
+            self.find('.zip')
+            return 'shapefile'
+        except FileNotFound:
+            self.find('.tif')
+            return 'geotiff'
+
+    @cached_property
+    def access(self):
+        return _parse_access(self.read(self.find('.xml')).decode('utf-8'))
+
+    @cached_property
+    def checksum(self):
+        """SHA-1 of the bag's payload manifests.
+
+        This identifies the bag's contents without reading the payload. It is
+        ``None`` for bags without a payload manifest.
+        """
+
+        manifests = sorted(n for n in self.tagfiles
+                           if n.startswith('manifest-') and n.endswith('.txt'))
+        if not manifests:
+            return None
+        sha = hashlib.sha1()
+        for name in manifests:
+            sha.update(self.read(name))
+        return sha.hexdigest()
+
+    @cached_property
+    def payload_checksum(self):
+        """SHA-1 of the manifest entries for the payload, minus metadata.
+
+        The FGDC metadata is left out, so two bags with the same data files
+        have the same payload checksum even if their metadata differs. It is
+        ``None`` for bags without a payload manifest.
+        """
+
+        try:
+            fgdc = self.find('.xml')
+        except FileNotFound:
+            fgdc = None
+        entries = sorted(e for e in self.manifest_entries() if e[2] != fgdc)
+        if not entries:
+            return None
+        sha = hashlib.sha1()
+        for algorithm, digest, name in entries:
+            sha.update(('%s:%s  %s\n' % (algorithm, digest, name))
+                       .encode('utf-8'))
+        return sha.hexdigest()
+
+    def manifest_entries(self, prefix='manifest-'):
+        """Return entries from the payload or tag manifests.
+
+        :param prefix: ``manifest-`` for payload manifests or
+                       ``tagmanifest-`` for tag manifests
+        :returns: list of (algorithm, digest, file name) tuples
+        """
+
+        entries = []
+        for name in sorted(self.tagfiles):
+            if name.startswith(prefix) and name.endswith('.txt'):
+                algorithm = name[len(prefix):-len('.txt')]
+                for line in self.read(name).decode('utf-8').splitlines():
+                    if line.strip():
+                        digest, path = line.strip().split(None, 1)
+                        entries.append((algorithm, digest.lower(),
+                                        path.lstrip('*')))
+        return entries
+
+    def verify(self, files=None, extract=(), max_workers=4):
+        """Verify files in the bag against the bag's manifests.
+
+        Files are read in chunks and hashed with every algorithm they are
+        listed under, several files at a time. Files named in ``extract``
+        are written to disk as they are hashed, so they only need to be read
+        once. Once verified, the digests can be used to identify the files'
+        contents; they are also kept in ``digests``.
+
+        :param files: names of files to verify, defaults to every file in the
+                      payload and tag manifests
+        :param extract: names of files to extract while verifying
+        :param max_workers: maximum number of files to hash at once
+        :returns: dictionary mapping file names to ``algorithm:digest``
+        :raises InvalidBag: if a file is missing or does not match
+        """
+
+        expected = {}
+        entries = self.manifest_entries('manifest-')
+        if not entries:
+            raise InvalidBag('Bag has no payload manifest')
+        for algorithm, digest, name in \
+                entries + self.manifest_entries('tagmanifest-'):
+            expected.setdefault(name, []).append((algorithm, digest))
+        errors = ['%s is not in the payload manifest' % name
+                  for name in self.payload if name not in expected]
+        if files is not None:
+            expected = dict((n, expected.get(n, [])) for n in files)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict((executor.submit(self._hash, name,
+                                            [a for a, _ in digests],
+                                            name in extract), name)
+                           for name, digests in expected.items())
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    actual = future.result()
+                except (IOError, KeyError, BadZipfile) as e:
+                    errors.append('%s could not be read: %s' % (name, e))
+                    continue
+                for algorithm, digest in expected[name]:
+                    if actual[algorithm] != digest:
+                        errors.append('%s does not match %s checksum' %
+                                      (name, algorithm))
+        if errors:
+            raise InvalidBag('Invalid bag: %s' % '; '.join(sorted(errors)))
+        verified = dict((name, '%s:%s' % digests[0])
+                        for name, digests in expected.items() if digests)
+        self.__dict__.setdefault('digests', {}).update(verified)
+        return verified
+
+    def _hash(self, name, algorithms, extract=False):
+        with closing(self.open(name)) as fp:
+            return _hash_stream(fp, algorithms)
+
+    def close(self):
+        pass
+
+
+class BagIndex(BaseBag):
+    """Inventory of an unpacked bag.
+
+    The ``data/`` directory is listed once when the index is created. Files
+    are served in place, so :meth:`extract` simply returns their path.
+
+    :param path: absolute path to bag directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.payload = ['data/' + f for f in
+                        os.listdir(os.path.join(path, 'data/'))]
+
+    @cached_property
+    def tagfiles(self):
+        return [f for f in os.listdir(self.path)
+                if os.path.isfile(os.path.join(self.path, f))]
+
+    def open(self, name):
+        return io.open(self.extract(name), 'rb')
+
+    def extract(self, name):
+        return os.path.join(self.path, name)
+
+    def size(self, name):
+        return os.path.getsize(self.extract(name))
+
+
+class Bag(BaseBag):
+    """A zipped bag read in place.
+
+    The archive is opened once and an index of its members, keyed by their
+    path relative to the bag directory, is built from the zip central
+    directory. Metadata such as the access level or the Shapefile layer name
+    is read straight from the archive. A payload file is only extracted to
+    ``workdir`` the first time its path is requested. Reads from the archive
+    are serialized, so a bag can be shared by stages running in different
+    threads::
+
+        with closing(Bag('bag.zip', '/tmp/bag')) as bag:
+            bag.access           # read from the archive
+            bag.shapefile        # extracts data/shapefile.zip
+
+    Verifying a bag hashes several members at once. Each one is read through
+    a new file object for the archive, so if ``archive`` is a file object
+    rather than a file name, ``reopen`` should be given to create these.
+    Without it members are hashed one at a time.
+
+    If ``gdal_archive`` is given, :meth:`gdal_path` returns a ``/vsizip/``
+    path inside it rather than extracting the file, so GDAL reads a GeoTIFF
+    straight out of the archive. It may be a file name or another virtual
+    file system path, such as ``/vsis3/bucket/key``.
+
+    :param archive: file name or seekable file object of zipped bag
+    :param workdir: directory to extract files into
+    :param reopen: function returning a new file object for the archive
+    :param gdal_archive: path GDAL can open the archive at
+    """
+
+    def __init__(self, archive, workdir, reopen=None, gdal_archive=None):
+        self.workdir = workdir
+        self.gdal_archive = gdal_archive
+        self.zf = ZipFile(archive, 'r')
+        if reopen is None and not hasattr(archive, 'read'):
+            reopen = partial(io.open, archive, 'rb')
+        self._reopen = reopen
+        self._lock = threading.RLock()
+        root = _bag_root(self.zf.namelist())
+        self.members = OrderedDict()
+        self._info = {}
+        for info in self.zf.infolist():
+            name = info.filename[len(root):]
+            if not name or name.endswith('/'):
+                continue
+            self.members[name] = BagMember(name, info.file_size,
+                                           info.header_offset, info.CRC)
+            self._info[name] = info
+        self.payload = [n for n in self.members if n.startswith('data/')]
+        self.tagfiles = [n for n in self.members if '/' not in n]
+
+    def open(self, name):
+        return self.zf.open(self._info[name])
+
+    def size(self, name):
+        return self.members[name].size
+
+    def read(self, name):
+        with self._lock:
+            return self.zf.read(self._info[name])
+
+    def extract(self, name):
+        """Extract a member to ``workdir``, unless it already has been.
+
+        :param name: member name relative to the bag directory
+        :returns: absolute path to extracted file
+        """
+
+        target = self._target(name)
+        with self._lock:
+            if not os.path.isfile(target):
+                with closing(self.open(name)) as src:
+                    _copy(src, target)
+        return target
+
+    def gdal_path(self, name):
+        if self.gdal_archive is None:
+            return self.extract(name)
+        self._target(name)
+        return '/vsizip/%s/%s' % (self.gdal_archive,
+                                  self._info[name].filename)
+
+    def _target(self, name):
+        parts = name.split('/')
+        if '..' in parts or os.path.isabs(name):
+            raise InvalidBag('Invalid path in bag: %s' % name)
+        return os.path.join(self.workdir, *parts)
+
+    def _hash(self, name, algorithms, extract=False):
+        target = self._target(name) if extract else None
+        if self._reopen is None:
+            with self._lock:
+                with closing(self.open(name)) as src:
+                    return _hash_stream(src, algorithms, target)
+        with closing(self._reopen()) as fp, closing(ZipFile(fp)) as zf, \
+                closing(zf.open(self._info[name].filename)) as src:
+            return _hash_stream(src, algorithms, target)
+
+    @cached_property
+    def shapefile_name(self):
+        name = self.find('.zip')
+        if self.members[name].size > NESTED_ZIP_MEMORY_LIMIT:
+            return _layer_name(self.shapefile)
+        return _layer_name(io.BytesIO(self.read(name)))
+
+    def close(self):
+        self.zf.close()
+
+
+def index(bag):
+    """Return a :class:`BaseBag` for ``bag``.
+
+    Bags that have already been indexed are returned as is, so tasks can
+    call this on whatever they are given.
+
+    :param bag: :class:`BaseBag` or absolute path to unpacked bag
+    """
+
+    if isinstance(bag, BaseBag):
+        return bag
+    return BagIndex(bag)
+
+
 def get_fgdc(bag):
-    return _extract_data(bag, '.xml')
+    return index(bag).fgdc
 
 
 def get_shapefile(bag):
-    return _extract_data(bag, '.zip')
+    return index(bag).shapefile
 
 
 def get_shapefile_name(bag):
-    shp = get_shapefile(bag)
-    with ZipFile(shp) as zf:
-        files = zf.namelist()
-    for f in files:
-        if f.endswith('.shp'):
-            return os.path.splitext(os.path.basename(f))[0]
+    return index(bag).shapefile_name
 
 
 def get_geotiff_name(bag):
-    gt = get_geotiff(bag)
-    return os.path.splitext(os.path.basename(gt))[0]
+    return index(bag).geotiff_name
 
 
 def get_geotiff(bag):
-    return _extract_data(bag, '.tif')
+    return index(bag).geotiff
+
+
+def get_geotiff_source(bag):
+    """Return a path GDAL can read the bag's GeoTIFF from.
+
+    See :meth:`BaseBag.gdal_path`.
+    """
+
+    bag = index(bag)
+    return bag.gdal_path(bag.find('.tif'))
 
 
 def unpack(bag, path):
-    archive = ZipFile(bag, 'r')
-    try:
-        archive.extractall(path)
-        bagdir = os.path.join(path, os.listdir(path)[0])
-        for f in os.listdir(bagdir):
-            shutil.move(os.path.join(bagdir, f), path)
-        shutil.rmtree(bagdir)
-    finally:
-        archive.close()
+    """Unpack a zipped bag into ``path``.
+
+    Each member of the archive is copied directly to its final location,
+    with the top level bag directory stripped off, so the archive is only
+    read once. See :meth:`Bag.extract`. The bag may be a file name or any
+    seekable file object, such as the stream returned by
+    :func:`kepler.transfer.open_object`.
+
+    :param bag: file name or file object of zipped bag
+    :param path: directory to unpack bag into
+    :returns: ``path``
+    """
+
+    with closing(Bag(bag, path)) as archive:
+        for name in archive.members:
+            archive.extract(name)
     return path
 
 
 def get_datatype(bag):
-    try:
-        get_shapefile(bag)
-        return 'shapefile'
-    except FileNotFound:
-        get_geotiff(bag)
-        return 'geotiff'
+    return index(bag).datatype
 
 
 def get_access(bag):
-    with open(get_fgdc(bag)) as fp:
-        match = re.search('<accconst>(?P<access>.*)</accconst>', fp.read())
+    return index(bag).access
+
+
+def _extract_data(bag, endswith):
+    bag = index(bag)
+    return bag.extract(bag.find(endswith))
+
+
+def _bag_root(names):
+    """Return the top level bag directory shared by all archive members.
+
+    Returns an empty string if the members are not wrapped in a single
+    directory.
+    """
+
+    roots = set(name.split('/', 1)[0] for name in names)
+    if len(roots) == 1 and any('/' in name for name in names):
+        return roots.pop() + '/'
+    return ''
+
+
+def _parse_access(fgdc):
+    match = re.search('<accconst>(?P<access>.*)</accconst>', fgdc)
     access = rights_mapper(match.group('access'))
     if access not in ('Public', 'Restricted'):
         raise InvalidAccessLevel(access)
     return access
 
 
-def _extract_data(bag, endswith):
-    data_dir = os.path.join(bag, 'data/')
-    for fname in os.listdir(data_dir):
-        if fname.endswith(endswith):
-            return os.path.join(data_dir, fname)
-    raise FileNotFound("No file in bag ending with %s" % endswith)
+def _layer_name(shapefile):
+    """Return the layer name of a zipped Shapefile.
+
+    :param shapefile: file name or file object of zipped Shapefile
+    """
+
+    with closing(ZipFile(shapefile)) as zf:
+        files = zf.namelist()
+    for f in files:
+        if f.endswith('.shp'):
+            return _basename(f)
+
+
+def _copy(src, target):
+    """Copy a file object to ``target``, creating directories as needed.
+
+    The data is written to a temporary file that is renamed once complete,
+    so a partially copied file is never mistaken for an extracted one.
+    """
+
+    if not os.path.isdir(os.path.dirname(target)):
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(target)):
+                raise
+    part = '%s.%s.part' % (target, threading.current_thread().ident)
+    with io.open(part, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    os.rename(part, target)
+
+
+def _hash_stream(src, algorithms, target=None):
+    """Hash a file object, optionally copying it to ``target`` as well.
+
+    :param src: file object to read
+    :param algorithms: names of :mod:`hashlib` algorithms
+    :param target: file name to copy data to
+    :returns: dictionary mapping algorithms to hex digests
+    """
+
+    hashes = dict((a, hashlib.new(a)) for a in set(algorithms))
+    dst = _HashingWriter(hashes.values())
+    if target is None:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    else:
+        _copy(_TeeReader(src, dst), target)
+    return dict((a, h.hexdigest()) for a, h in hashes.items())
+
+
+class _HashingWriter(object):
+    def __init__(self, hashes):
+        self.hashes = list(hashes)
+
+    def write(self, data):
+        for h in self.hashes:
+            h.update(data)
+
+
+class _TeeReader(object):
+    def __init__(self, src, sink):
+        self.src = src
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.sink.write(data)
+        return data
+
+
+def _basename(path):
+    return os.path.splitext(os.path.basename(path))[0]
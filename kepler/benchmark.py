@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    kepler.benchmark
+    ----------------
+
+    This module compares compression profiles. Each raster is compressed
+    with each profile and given overviews, and the time taken and size of
+    the output are recorded::
+
+        for result in benchmark(['tests/fixtures'], ['jpeg', 'deflate']):
+            print(result)
+
+    The ``benchmark`` command in ``manage.py`` runs this over the test
+    fixtures and any directories or files given to it.
+"""
+
+from __future__ import absolute_import, division
+from collections import namedtuple
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from kepler.geo import GDALEngine, PROFILES, compress, pyramid
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests', 'fixtures')
+
+
+Result = namedtuple('Result', 'file profile encode_time size overview_time '
+                              'total_size error')
+
+
+def rasters(paths):
+    """Return the GeoTIFFs in a list of files and directories."""
+
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, '*.tif'))))
+        else:
+            found.append(path)
+    return found
+
+
+def benchmark(paths, profiles=None, engine=GDALEngine, **kwargs):
+    """Compress rasters with each profile.
+
+    A profile that fails for a raster is reported with the error rather
+    than stopping the benchmark.
+
+    :param paths: list of GeoTIFFs or directories containing them
+    :param profiles: list of profile names, defaults to all of ``PROFILES``
+    :param engine: :class:`~kepler.geo.Engine` class
+    :param kwargs: other options passed to the engine
+    :returns: iterator of :class:`Result`
+    """
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for path in rasters(paths):
+            for name in profiles or sorted(PROFILES):
+                yield _run(path, name, engine(profile=name, **kwargs),
+                           os.path.join(tmpdir, name + '.tif'))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def format_results(results):
+    """Format results as a table.
+
+    :param results: iterable of :class:`Result`
+    :returns: list of lines
+    """
+
+    lines = ['%-30s %-10s %10s %12s %10s %12s' %
+             ('file', 'profile', 'encode (s)', 'size (KB)', 'ovr (s)',
+              'total (KB)')]
+    for r in results:
+        name = os.path.basename(r.file)
+        if r.error:
+            lines.append('%-30s %-10s %s' % (name, r.profile, r.error))
+        else:
+            lines.append('%-30s %-10s %10.2f %12.1f %10.2f %12.1f' %
+                         (name, r.profile, r.encode_time, r.size / 1024,
+                          r.overview_time, r.total_size / 1024))
+    return lines
+
+
+def _run(path, name, engine, out):
+    try:
+        start = time.time()
+        compress(path, out, engine)
+        encode_time = time.time() - start
+        size = os.path.getsize(out)
+        start = time.time()
+        pyramid(out, engine)
+        return Result(path, name, encode_time, size, time.time() - start,
+                      os.path.getsize(out), None)
+    except Exception as e:
+        return Result(path, name, None, None, None, None, str(e) or repr(e))
+    finally:
+        if os.path.exists(out):
+            os.remove(out)
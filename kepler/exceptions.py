@@ -8,3 +8,15 @@ class FileNotFound(Exception):
 
 class InvalidAccessLevel(Exception):
     pass
+
+
+class InvalidBag(Exception):
+    pass
+
+
+class InsufficientScratchSpace(Exception):
+    pass
+
+
+class GDALError(Exception):
+    pass
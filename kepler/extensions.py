@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from flask.ext.sqlalchemy import SQLAlchemy
 import redis
 import requests
@@ -35,16 +36,21 @@ class GeoServer(BaseExtension):
         pub_session.auth = auth
         sec_session = requests.Session()
         sec_session.auth = auth
+        conn = redis.from_url(app.config['REDISTOGO_URL'])
         self._public = GeoService(
             session=pub_session,
             url=app.config.get('GEOSERVER_PUBLIC_URL'),
             workspace=app.config.get('GEOSERVER_WORKSPACE'),
-            datastore=app.config.get('GEOSERVER_DATASTORE'))
+            datastore=app.config.get('GEOSERVER_DATASTORE'),
+            catalog_ttl=app.config.get('GEOSERVER_CATALOG_TTL', 300),
+            connection=conn)
         self._secure = GeoService(
             session=sec_session,
             url=app.config.get('GEOSERVER_RESTRICTED_URL'),
             workspace=app.config.get('GEOSERVER_WORKSPACE'),
-            datastore=app.config.get('GEOSERVER_DATASTORE'))
+            datastore=app.config.get('GEOSERVER_DATASTORE'),
+            catalog_ttl=app.config.get('GEOSERVER_CATALOG_TTL', 300),
+            connection=conn)
 
     @property
     def public(self):
@@ -74,18 +80,25 @@ class RQ(BaseExtension):
 class S3(BaseExtension):
     def init_app(self, app):
         s3_url = app.config.get('S3_TEST_URL')
+        config = {'max_pool_connections':
+                  app.config.get('S3_MAX_POOL_CONNECTIONS', 10)}
         kwargs = {}
         if s3_url:
-            kwargs = {
-                'endpoint_url': s3_url,
-                'config': boto3.session.Config(s3={'addressing_style': 'virtual'})
-            }
+            kwargs['endpoint_url'] = s3_url
+            config['s3'] = {'addressing_style': 'virtual'}
         self.client = boto3.client('s3',
             aws_access_key_id=app.config.get('S3_ACCESS_KEY_ID'),
             aws_secret_access_key=app.config.get('S3_SECRET_ACCESS_KEY'),
+            config=boto3.session.Config(**config),
             **kwargs
         )
-
+        self.transfer_config = TransferConfig(
+            multipart_threshold=app.config.get('S3_MULTIPART_THRESHOLD',
+                                               8 * 1024 * 1024),
+            multipart_chunksize=app.config.get('S3_MULTIPART_CHUNKSIZE',
+                                               8 * 1024 * 1024),
+            max_concurrency=app.config.get('S3_MAX_CONCURRENCY', 10))
+        self.adaptive = app.config.get('S3_ADAPTIVE_TRANSFERS', False)
 
 db = SQLAlchemy()
 solr = Solr()
@@ -1,101 +1,1161 @@
 # -*- coding: utf-8 -*-
+"""
+    kepler.geo
+    ----------
+
+    This module compresses GeoTIFFs and adds overviews. The work is done by
+    an engine: :class:`SubprocessEngine` runs the GDAL command line tools,
+    while :class:`GDALEngine` uses the GDAL Python bindings in the current
+    process, reusing the dataset it opened to inspect the input and
+    reporting progress through a callback::
+
+        engine = GDALEngine(callback=gdal.TermProgress)
+        compress('in.tif', 'out.tif', engine)
+        pyramid('out.tif', engine)
+
+    :func:`cog` does both in one write, producing a Cloud Optimized
+    GeoTIFF.
+
+    :func:`describe` summarizes a raster as a :class:`RasterInfo`, reading
+    the file once however many times the summary is asked for.
+    :func:`raster_bounds` and :func:`shapefile_bounds` give the extent of
+    a layer in WGS 84 from the data itself.
+
+    Input files can be given as GDAL virtual file system paths, so a
+    GeoTIFF can be read straight out of a zipped bag, locally or on S3,
+    without being extracted first::
+
+        configure_s3(key, secret)
+        compress(vsizip(vsis3('bucket', 'bag.zip'), 'data/layer.tif'),
+                 'out.tif', GDALEngine())
+
+    Small rasters can be processed entirely in memory by giving the
+    :class:`GDALEngine` paths from :func:`memory_file`.
+"""
+
 from __future__ import absolute_import, division
-from contextlib import closing
+from collections import namedtuple, OrderedDict
+from contextlib import closing, contextmanager
 import math
+import multiprocessing
+import os
+import threading
+import uuid
+from xml.sax.saxutils import escape
 
-from osgeo import gdal
+import numpy as np
+from osgeo import gdal, ogr, osr
 from subprocess import check_output
+from werkzeug.utils import cached_property
+
+from kepler.exceptions import GDALError
 
 
 GDAL_RGB = (gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand)
 GDAL_PALETTED = gdal.GCI_PaletteIndex
 
+ENGINES = {}
+
+MB = 1024 * 1024
+
+#: First GDAL release whose GeoTIFF driver compresses blocks in parallel,
+#: given the ``NUM_THREADS`` creation option.
+THREADED_COMPRESSION_VERSION = 2010000
+
+#: First GDAL release that computes overviews in parallel, given the
+#: ``GDAL_NUM_THREADS`` configuration option.
+THREADED_OVERVIEWS_VERSION = 3020000
+
+#: Number of pixels read at a time when computing statistics.
+STATISTICS_STRIP_SIZE = 4 * 1024 * 1024
+
+#: Number of points along each edge of a layer's extent reprojected to
+#: find its bounding box.
+BOUNDS_DENSITY = 21
+
+#: Creation options that have a matching ``*_OVERVIEW`` config option.
+OVERVIEW_OPTIONS = ('COMPRESS', 'PHOTOMETRIC', 'PREDICTOR', 'JPEG_QUALITY',
+                    'WEBP_LEVEL')
+
+#: GeoTIFF creation options named differently by the COG driver.
+COG_OPTIONS = {'BLOCKXSIZE': 'BLOCKSIZE', 'JPEG_QUALITY': 'QUALITY',
+               'WEBP_LEVEL': 'QUALITY'}
+
+
+class Profile(namedtuple('Profile',
+                         'compress quality predictor blocksize')):
+    """Compression settings for GeoTIFFs.
+
+    :param compress: GeoTIFF compression, ``JPEG``, ``WEBP``, ``DEFLATE``
+                     or ``LZW``
+    :param quality: JPEG or WEBP quality from 1 to 100, or ``None`` for the
+                    GDAL default
+    :param predictor: ``2`` for horizontal differencing, ``3`` for floating
+                      point, or ``None``; only used by ``DEFLATE`` and
+                      ``LZW``
+    :param blocksize: width and height of tiles in pixels
+    """
+
+    def __new__(cls, compress, quality=None, predictor=None, blocksize=2048):
+        return super(Profile, cls).__new__(cls, compress.upper(), quality,
+                                           predictor, blocksize)
+
+    @property
+    def lossy(self):
+        return self.compress in ('JPEG', 'WEBP')
+
+
+PROFILES = {
+    'jpeg': Profile('JPEG'),
+    'jpeg-q90': Profile('JPEG', quality=90),
+    'jpeg-512': Profile('JPEG', blocksize=512),
+    'webp': Profile('WEBP', quality=85, blocksize=512),
+    'deflate': Profile('DEFLATE', predictor=2, blocksize=512),
+    'lzw': Profile('LZW', predictor=2, blocksize=512),
+}
+
+DEFAULT_PROFILE = PROFILES['jpeg']
+
+
+def get_profile(profile):
+    """Return a :class:`Profile`.
+
+    :param profile: a :class:`Profile`, the name of one in ``PROFILES``, a
+                    dictionary of :class:`Profile` arguments, or ``None``
+                    for the default JPEG profile
+    """
+
+    if profile is None:
+        return DEFAULT_PROFILE
+    if isinstance(profile, Profile):
+        return profile
+    if isinstance(profile, dict):
+        return Profile(**profile)
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown compression profile: %s' % profile)
+
+
+class RasterInfo(namedtuple('RasterInfo', 'width height bands color_interp '
+                           'data_type nodata crs geotransform')):
+    """Summary of a raster, gathered in one pass over its header.
+
+    :param width: width in pixels
+    :param height: height in pixels
+    :param bands: number of bands
+    :param color_interp: tuple of GDAL color interpretations, one per band
+    :param data_type: name of the GDAL data type of the first band
+    :param nodata: tuple of nodata values, one per band
+    :param crs: coordinate reference system as WKT
+    :param geotransform: GDAL geotransform tuple
+    """
+
+    @classmethod
+    def from_dataset(cls, ds):
+        bands = [ds.GetRasterBand(i) for i in range(1, ds.RasterCount + 1)]
+        data_type = gdal.GetDataTypeName(bands[0].DataType) if bands \
+            else None
+        return cls(width=ds.RasterXSize,
+                   height=ds.RasterYSize,
+                   bands=ds.RasterCount,
+                   color_interp=tuple(b.GetColorInterpretation()
+                                      for b in bands),
+                   data_type=data_type,
+                   nodata=tuple(b.GetNoDataValue() for b in bands),
+                   crs=ds.GetProjection(),
+                   geotransform=tuple(ds.GetGeoTransform()))
+
+    @property
+    def rgb(self):
+        return (self.bands == 3 and
+                all(c in GDAL_RGB for c in self.color_interp))
+
+    @property
+    def paletted(self):
+        return self.bands == 1 and self.color_interp[0] == GDAL_PALETTED
+
 
 class Raster(object):
-    def __init__(self, file):
-        self.ds = gdal.Open(file)
+    def __init__(self, file, update=False):
+        self.ds = gdal.Open(file, gdal.GA_Update if update else
+                            gdal.GA_ReadOnly)
+        if self.ds is None:
+            raise GDALError(gdal.GetLastErrorMsg())
 
     def bands(self):
         bands = self.ds.RasterCount
         for i in range(1, bands+1):
             yield self.ds.GetRasterBand(i)
 
+    @cached_property
+    def info(self):
+        """:class:`RasterInfo` for the raster, read once."""
+        return RasterInfo.from_dataset(self.ds)
+
     @property
     def rgb(self):
-        return (self.ds.RasterCount == 3 and
-                all(band.GetColorInterpretation() in GDAL_RGB for band in self.bands()))
+        return self.info.rgb
 
     @property
     def paletted(self):
-        return (self.ds.RasterCount == 1 and
-                self.ds.GetRasterBand(1).GetColorInterpretation() == GDAL_PALETTED)
+        return self.info.paletted
 
     @property
     def width(self):
-        return self.ds.RasterXSize
+        return self.info.width
 
     @property
     def height(self):
-        return self.ds.RasterYSize
+        return self.info.height
 
     def close(self):
         self.ds = None
 
 
-def compress(file_in, file_out):
+_info_cache = OrderedDict()
+_info_lock = threading.Lock()
+INFO_CACHE_SIZE = 64
+
+
+def describe(file):
+    """Return a :class:`RasterInfo` for a raster file.
+
+    Summaries of local files are cached, keyed on the file's path, size and
+    modification time, so a file is only opened again once it has changed.
+    Virtual file system paths have nothing to tell when they change, so
+    they are opened every time.
+
+    :param file: file name or GDAL virtual file system path
+    """
+
+    try:
+        st = os.stat(file)
+    except OSError:
+        with closing(Raster(file)) as ds:
+            return ds.info
+    key = (os.path.abspath(file), st.st_size, st.st_mtime)
+    with _info_lock:
+        if key in _info_cache:
+            return _info_cache[key]
+    with closing(Raster(file)) as ds:
+        info = ds.info
+    with _info_lock:
+        _info_cache[key] = info
+        while len(_info_cache) > INFO_CACHE_SIZE:
+            _info_cache.popitem(last=False)
+    return info
+
+
+def vsizip(archive, member):
+    """Return the GDAL virtual file system path of a file in a zip archive.
+
+    :param archive: file name or virtual file system path of the archive
+    :param member: name of the file in the archive
+    """
+
+    return '/vsizip/%s/%s' % (archive, member)
+
+
+def vsis3(bucket, key):
+    """Return the GDAL virtual file system path of an S3 object.
+
+    See :func:`has_vsis3` and :func:`configure_s3`.
+    """
+
+    return '/vsis3/%s/%s' % (bucket, key)
+
+
+@contextmanager
+def memory_file(name, data=None):
+    """Provide a GDAL in-memory file for the duration of a block.
+
+    The file is given a ``/vsimem/`` path in a new directory. When the
+    block exits the directory is emptied, removing the file along with any
+    ``.aux.xml``, ``.ovr`` or other files GDAL has put beside it.
+
+    :param name: file name
+    :param data: bytes to write to the file, if any
+    :returns: path to the file
+    """
+
+    directory = '/vsimem/%s' % uuid.uuid4().hex
+    path = '%s/%s' % (directory, name)
+    if data is not None:
+        gdal.FileFromMemBuffer(path, data)
+    try:
+        yield path
+    finally:
+        for f in gdal.ReadDir(directory) or []:
+            gdal.Unlink('%s/%s' % (directory, f))
+
+
+def read_file(path):
+    """Read the whole of a file through GDAL's virtual file system.
+
+    :param path: file name or virtual file system path
+    :returns: bytes
+    """
+
+    fp = gdal.VSIFOpenL(path, 'rb')
+    if fp is None:
+        raise GDALError('Could not open %s' % path)
+    try:
+        gdal.VSIFSeekL(fp, 0, os.SEEK_END)
+        size = gdal.VSIFTellL(fp)
+        gdal.VSIFSeekL(fp, 0, os.SEEK_SET)
+        return gdal.VSIFReadL(1, size, fp)
+    finally:
+        gdal.VSIFCloseL(fp)
+
+
+def has_vsis3():
+    """Return whether GDAL can read from S3. ``/vsis3/`` needs GDAL 2.1."""
+
+    return int(gdal.VersionInfo()) >= 2010000
+
+
+def configure_s3(access_key, secret_key):
+    """Set the credentials GDAL uses to read from S3.
+
+    The credentials are set for the rest of the process, so any dataset
+    opened from a ``/vsis3/`` path can be read, by any engine running in
+    the process. They are not passed to the command line tools.
+
+    :param access_key: AWS access key id
+    :param secret_key: AWS secret access key
+    """
+
+    gdal.SetConfigOption('AWS_ACCESS_KEY_ID', access_key)
+    gdal.SetConfigOption('AWS_SECRET_ACCESS_KEY', secret_key)
+
+
+def register_engine(name):
+    """Register an engine class under a name."""
+
+    def register(cls):
+        ENGINES[name] = cls
+        cls.name = name
+        return cls
+    return register
+
+
+def get_engine(name, **kwargs):
+    """Create an engine by name.
+
+    :param name: ``subprocess`` or ``gdal``
+    :param kwargs: options passed to the engine
+    """
+
+    try:
+        cls = ENGINES[name]
+    except KeyError:
+        raise ValueError('Unknown GDAL engine: %s' % name)
+    return cls(**kwargs)
+
+
+class Engine(object):
+    """Base class for engines.
+
+    Engines with ``in_process`` set run GDAL in the current process, so can
+    read and write ``/vsimem/`` files.
+
+    :param config: dictionary of GDAL configuration options to set while
+                   the engine is working
+    :param callback: GDAL progress callback, called with the fraction
+                     complete, a message and user data; engines that cannot
+                     report progress ignore it
+    :param threads: number of threads used to compress blocks, ignored
+                    before GDAL 2.1
+    :param overview_threads: number of threads used to compute overviews,
+                             ignored before GDAL 3.2
+    :param profile: compression :class:`Profile`, or anything accepted by
+                    :func:`get_profile`
+    :param memory_budget: approximate limit in bytes on the memory used
+                          for processing; half is given to the GDAL block
+                          cache and engines that can will copy rasters a
+                          window at a time within the rest
+    """
+
+    in_process = False
+
+    def __init__(self, config=None, callback=None, threads=None,
+                 overview_threads=None, profile=None, memory_budget=None):
+        self.profile = get_profile(profile)
+        self.config = dict(config or {})
+        self.callback = callback
+        self.threads = threads
+        self.overview_threads = overview_threads
+        self.memory_budget = memory_budget
+        if memory_budget:
+            cachemax = max(1, memory_budget // 2 // MB)
+            self.config['GDAL_CACHEMAX'] = \
+                min(int(self.config.get('GDAL_CACHEMAX', cachemax)), cachemax)
+
+    def compress(self, file_in, file_out):
+        raise NotImplementedError
+
+    def pyramid(self, file_in):
+        raise NotImplementedError
+
+    def cog(self, file_in, file_out, compute_statistics=False):
+        raise NotImplementedError
+
+    def _threaded(self, options):
+        if self.threads and \
+                gdal_version() >= THREADED_COMPRESSION_VERSION:
+            return options + ['NUM_THREADS=%d' % self.threads]
+        return options
+
+    def _overview_config(self, options=None):
+        config = overview_config(options) if options else {}
+        if self.overview_threads and \
+                gdal_version() >= THREADED_OVERVIEWS_VERSION:
+            config['GDAL_NUM_THREADS'] = self.overview_threads
+        return config
+
+
+@register_engine('subprocess')
+class SubprocessEngine(Engine):
+    """Run ``gdal_translate`` and ``gdaladdo``."""
+
+    def compress(self, file_in, file_out):
+        options, expand, color = compress_options(describe(file_in),
+                                                  self.profile)
+        args = _creation_args(options)
+        if expand:
+            args = args + ['-expand', 'rgb']
+        args = args + _creation_args(self._threaded(color))
+        command = ['gdal_translate'] + self._config_args() + args + \
+            [file_in, file_out]
+        check_output(command)
+
+    def pyramid(self, file_in):
+        info = describe(file_in)
+        levels = compute_levels(info.width, info.height,
+                                self.profile.blocksize)
+        if levels:
+            command = ['gdaladdo'] + \
+                self._config_args(self._overview_config()) + \
+                ['-r', 'average', file_in] + levels
+            check_output(command)
+
+    def cog(self, file_in, file_out, compute_statistics=False):
+        info = describe(file_in)
+        options, expand, color = compress_options(info, self.profile)
+        levels = compute_levels(info.width, info.height,
+                                self.profile.blocksize)
+        vrt = file_out + '.vrt'
+        stats = None
+        try:
+            command = ['gdal_translate'] + self._config_args() + \
+                ['-of', 'VRT'] + (['-expand', 'rgb'] if expand else []) + \
+                [file_in, vrt]
+            check_output(command)
+            if levels:
+                config = self._overview_config(options + color)
+                command = ['gdaladdo'] + self._config_args(config) + \
+                    ['-ro', '-r', 'average', vrt] + levels
+                check_output(command)
+            if compute_statistics:
+                stats = statistics(vrt, update=True)
+            options = self._threaded(options + color +
+                                     ['COPY_SRC_OVERVIEWS=YES'])
+            command = ['gdal_translate'] + self._config_args() + \
+                _creation_args(options) + [vrt, file_out]
+            check_output(command)
+        finally:
+            _remove(vrt, vrt + '.ovr')
+        return stats
+
+    def _config_args(self, extra=None):
+        config = dict(self.config, **(extra or {}))
+        args = []
+        for k, v in sorted(config.items()):
+            args = args + ['--config', k, str(v)]
+        return args
+
+
+@register_engine('gdal')
+class GDALEngine(Engine):
+    """Use the GDAL Python bindings in process."""
+
+    in_process = True
+
+    def compress(self, file_in, file_out):
+        with config_options(self.config), closing(Raster(file_in)) as ds:
+            options, expand, color = compress_options(ds, self.profile)
+            options = self._threaded(options + color)
+            if self.memory_budget:
+                copy_windowed(ds.ds, file_out, options,
+                              self.memory_budget // 2,
+                              self.profile.blocksize, expand=expand,
+                              callback=self.callback)
+            else:
+                translate(ds.ds, file_out, options, expand=expand,
+                          callback=self.callback)
+
+    def pyramid(self, file_in):
+        with config_options(dict(self.config, **self._overview_config())), \
+                closing(Raster(file_in, update=True)) as ds:
+            levels = compute_levels(ds.width, ds.height,
+                                    self.profile.blocksize)
+            if levels:
+                build_overviews(ds.ds, levels, callback=self.callback)
+
+    def cog(self, file_in, file_out, compute_statistics=False):
+        with config_options(self.config), closing(Raster(file_in)) as ds:
+            options, expand, color = compress_options(ds, self.profile)
+            cog_driver = gdal.GetDriverByName('COG') is not None
+            if cog_driver and not compute_statistics:
+                options = self._threaded(options + color)
+                translate(ds.ds, file_out, cog_options(options),
+                          expand=expand, format='COG',
+                          callback=self.callback)
+                return None
+            levels = [] if cog_driver else \
+                compute_levels(ds.width, ds.height, self.profile.blocksize)
+            vrt = file_out + '.vrt'
+            stats = None
+            try:
+                translate(ds.ds, vrt, [], expand=expand, format='VRT')
+                with closing(Raster(vrt)) as src:
+                    if levels:
+                        config = self._overview_config(options + color)
+                        with config_options(config):
+                            build_overviews(src.ds, levels)
+                    if compute_statistics:
+                        stats = embed_statistics(src.ds)
+                    if cog_driver:
+                        translate(src.ds, file_out,
+                                  cog_options(self._threaded(options +
+                                                             color)),
+                                  format='COG', callback=self.callback)
+                    else:
+                        translate(src.ds, file_out,
+                                  self._threaded(options + color +
+                                                 ['COPY_SRC_OVERVIEWS=YES']),
+                                  callback=self.callback)
+            finally:
+                _remove(vrt, vrt + '.ovr')
+            return stats
+
+
+@contextmanager
+def config_options(options):
+    """Set GDAL configuration options for the duration of a block.
+
+    Options are restored to their previous values afterwards.
+
+    GDAL only reads ``GDAL_CACHEMAX``, in MB, when it first sets up the
+    block cache in a process, so it is applied with ``SetCacheMax`` instead
+    and the previous size is restored the same way.
+
+    :param options: dictionary of GDAL configuration options
+    """
+
+    options = dict(options)
+    cachemax = options.pop('GDAL_CACHEMAX', None)
+    previous = {}
+    for k, v in options.items():
+        previous[k] = gdal.GetConfigOption(k)
+        gdal.SetConfigOption(k, str(v))
+    previous_cachemax = gdal.GetCacheMax()
+    if cachemax is not None:
+        _set_cache_max(int(cachemax) * MB)
+    try:
+        yield
+    finally:
+        if cachemax is not None:
+            _set_cache_max(previous_cachemax)
+        for k, v in previous.items():
+            gdal.SetConfigOption(k, v)
+
+
+def gdal_version():
+    """Return the GDAL version as a number, such as 1110100 for 1.11.1."""
+    return int(gdal.VersionInfo('VERSION_NUM'))
+
+
+def cpu_count():
+    """Return the number of CPUs, or 1 if it cannot be determined."""
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def default_cachemax():
+    """Return a GDAL block cache size in MB suited to this machine.
+
+    A quarter of physical memory is used, leaving the rest for the worker
+    and for the operating system to cache the files being read and written.
+    """
+
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 64
+    return max(64, memory // 4 // MB)
+
+
+def compress_options(raster, profile=None):
+    """Return the options for compressing a raster.
+
+    Lossy profiles expand a paletted image to RGB, and JPEG stores RGB
+    images in YCbCr color space. WEBP can only store RGB images, so other
+    images fall back to DEFLATE.
+
+    :param raster: :class:`Raster` or :class:`RasterInfo`
+    :param profile: compression :class:`Profile`, defaults to JPEG
+    :returns: tuple of GeoTIFF creation options, whether to expand a
+              paletted image to RGB, and creation options for the color
+              space of the output
+    """
+
+    profile = get_profile(profile)
+    expand = profile.lossy and raster.paletted
+    compress = profile.compress
+    if compress == 'WEBP' and not (expand or raster.rgb):
+        compress = 'DEFLATE'
+    options = ['TILED=YES', 'COMPRESS=%s' % compress,
+               'BLOCKXSIZE=%d' % profile.blocksize,
+               'BLOCKYSIZE=%d' % profile.blocksize]
+    if profile.quality and compress in ('JPEG', 'WEBP'):
+        key = 'JPEG_QUALITY' if compress == 'JPEG' else 'WEBP_LEVEL'
+        options.append('%s=%d' % (key, profile.quality))
+    if profile.predictor and compress in ('DEFLATE', 'LZW'):
+        options.append('PREDICTOR=%d' % profile.predictor)
+    ycbcr = compress == 'JPEG' and (expand or raster.rgb)
+    color = ['PHOTOMETRIC=YCBCR'] if ycbcr else []
+    return options, expand, color
+
+
+def overview_config(options):
+    """Return the config options for overviews matching creation options.
+
+    Overviews built in a separate ``.ovr`` file are only compressed if
+    these are set.
+
+    :param options: list of GeoTIFF creation options
+    :returns: dictionary of GDAL config options
+    """
+
+    config = {'INTERLEAVE_OVERVIEW': 'PIXEL'}
+    for option in options:
+        k, v = option.split('=', 1)
+        if k in OVERVIEW_OPTIONS:
+            config[k + '_OVERVIEW'] = v
+    return config
+
+
+def cog_options(options):
+    """Convert GeoTIFF creation options to those of the COG driver.
+
+    The COG driver tiles the output, chooses the color space and builds
+    overviews itself.
+
+    :param options: list of GeoTIFF creation options
+    :returns: list of COG creation options
+    """
+
+    converted = ['OVERVIEWS=AUTO', 'RESAMPLING=AVERAGE']
+    for option in options:
+        k, v = option.split('=', 1)
+        if k in ('TILED', 'BLOCKYSIZE', 'PHOTOMETRIC'):
+            continue
+        converted.append('%s=%s' % (COG_OPTIONS.get(k, k), v))
+    return converted
+
+
+def translate(ds, file_out, options, expand=False, format='GTiff',
+              callback=None):
+    """Copy a dataset to a new file.
+
+    :param ds: open :class:`gdal.Dataset`
+    :param file_out: output file name
+    :param options: list of creation options
+    :param expand: whether to expand a paletted dataset to RGB
+    :param format: name of GDAL driver for the output
+    :param callback: GDAL progress callback
+    """
+
+    if hasattr(gdal, 'Translate'):
+        out = gdal.Translate(file_out, ds, format=format,
+                             creationOptions=options,
+                             rgbExpand='rgb' if expand else None,
+                             callback=callback)
+    else:
+        if expand:
+            ds = expand_rgb(ds)
+        driver = gdal.GetDriverByName(format)
+        out = driver.CreateCopy(file_out, ds, 0, options, callback=callback)
+    if out is None:
+        raise GDALError(gdal.GetLastErrorMsg())
+    out = None
+
+
+def windows(width, height, blocksize, pixel_size, budget):
+    """Divide a raster into windows that fit in a memory budget.
+
+    Windows are aligned to blocks, so each one covers whole tiles of the
+    output. A window spans several rows of tiles if they fit, otherwise
+    as many tiles of one row as fit, and at least one tile.
+
+    :param width: width of raster in pixels
+    :param height: height of raster in pixels
+    :param blocksize: width and height of tiles in pixels
+    :param pixel_size: bytes per pixel, over all bands
+    :param budget: bytes available for a window
+    :returns: list of ``(x, y, width, height)`` tuples
+    """
+
+    tile = blocksize * blocksize * pixel_size
+    tiles = max(1, budget // tile)
+    across = int(math.ceil(width / blocksize))
+    if tiles >= across:
+        cols = width
+        rows = blocksize * (tiles // across)
+    else:
+        cols = blocksize * tiles
+        rows = blocksize
+    result = []
+    for y in range(0, height, rows):
+        for x in range(0, width, cols):
+            result.append((x, y, min(cols, width - x), min(rows, height - y)))
+    return result
+
+
+def copy_windowed(ds, file_out, options, budget, blocksize, expand=False,
+                  callback=None):
+    """Copy a dataset to a GeoTIFF a window at a time.
+
+    Unlike :func:`translate`, which leaves GDAL to decide how much of the
+    input to hold in memory, at most ``budget`` bytes of pixels are read at
+    once. Each window covers whole output tiles, which can be compressed
+    and flushed as soon as it is written.
+
+    :param ds: open :class:`gdal.Dataset`
+    :param file_out: output file name
+    :param options: list of GeoTIFF creation options
+    :param budget: bytes available for a window
+    :param blocksize: width and height of tiles in pixels
+    :param expand: whether to expand a paletted dataset to RGB
+    :param callback: GDAL progress callback
+    """
+
+    if expand:
+        ds = expand_rgb(ds)
+    src = [ds.GetRasterBand(i) for i in range(1, ds.RasterCount + 1)]
+    data_type = src[0].DataType
+    out = gdal.GetDriverByName('GTiff').Create(
+        file_out, ds.RasterXSize, ds.RasterYSize, ds.RasterCount, data_type,
+        options)
+    if out is None:
+        raise GDALError(gdal.GetLastErrorMsg())
+    out.SetProjection(ds.GetProjection())
+    out.SetGeoTransform(ds.GetGeoTransform())
+    out.SetMetadata(ds.GetMetadata())
+    for i, band in enumerate(src, 1):
+        dest = out.GetRasterBand(i)
+        if band.GetNoDataValue() is not None:
+            dest.SetNoDataValue(band.GetNoDataValue())
+        if band.GetColorTable() is not None:
+            dest.SetColorTable(band.GetColorTable())
+    pixel_size = gdal.GetDataTypeSize(data_type) // 8 * ds.RasterCount
+    parts = windows(ds.RasterXSize, ds.RasterYSize, blocksize, pixel_size,
+                    budget)
+    for n, (x, y, w, h) in enumerate(parts, 1):
+        if out.WriteRaster(x, y, w, h, ds.ReadRaster(x, y, w, h)) != 0:
+            raise GDALError(gdal.GetLastErrorMsg())
+        if callback is not None:
+            callback(n / len(parts), '', None)
+    out.FlushCache()
+    out = None
+
+
+def build_overviews(ds, levels, callback=None):
+    """Add overviews to a dataset opened for update.
+
+    :param ds: open :class:`gdal.Dataset`
+    :param levels: list of overview levels
+    :param callback: GDAL progress callback
+    """
+
+    if ds.BuildOverviews('AVERAGE', levels, callback=callback) != 0:
+        raise GDALError(gdal.GetLastErrorMsg())
+
+
+def expand_rgb(ds):
+    """Return an in-memory VRT expanding a paletted dataset to RGB.
+
+    This is what ``gdal_translate -expand rgb`` does, for versions of GDAL
+    without :func:`gdal.Translate`.
+
+    :param ds: open :class:`gdal.Dataset` with a single paletted band
+    :returns: :class:`gdal.Dataset`
+    """
+
+    vrt = gdal.GetDriverByName('VRT').Create('', ds.RasterXSize,
+                                             ds.RasterYSize, 0)
+    vrt.SetProjection(ds.GetProjection())
+    vrt.SetGeoTransform(ds.GetGeoTransform())
+    source = ('<ComplexSource><SourceFilename>{0}</SourceFilename>'
+              '<SourceBand>1</SourceBand>'
+              '<ColorTableComponent>{1}</ColorTableComponent>'
+              '</ComplexSource>')
+    for i, interp in enumerate(GDAL_RGB, 1):
+        vrt.AddBand(gdal.GDT_Byte)
+        band = vrt.GetRasterBand(i)
+        band.SetColorInterpretation(interp)
+        band.SetMetadataItem('source_0',
+                             source.format(escape(ds.GetDescription()), i),
+                             'new_vrt_sources')
+    return vrt
+
+
+def compress(file_in, file_out, engine=None):
     """Compress and tile a GeoTIFF.
 
-    This will call out to ``gdal_translate`` using JPEG compression and
-    a block size of 2048x2048. If the input file is a single band paletted
-    image this will expand to RGB. Finally, any RGB images will be converted
-    to YCbCr color space.
+    By default this will use JPEG compression and a block size of
+    2048x2048. If the input file is a single band paletted image this will
+    expand to RGB. Finally, any RGB images will be converted to YCbCr color
+    space. Other compression profiles can be chosen with the engine, see
+    :func:`compress_options`.
 
     .. note:: Both parameters are file names, not file handles.
 
     :param file_in: input file name
     :param file_out: output file name
+    :param engine: :class:`Engine`, defaults to :class:`SubprocessEngine`
     """
 
-    args = ['-co', 'TILED=YES', '-co', 'COMPRESS=JPEG', '-co',
-            'BLOCKXSIZE=2048', '-co', 'BLOCKYSIZE=2048']
-    with closing(Raster(file_in)) as ds:
-        if ds.paletted:
-            args = args + ['-expand', 'rgb', '-co', 'PHOTOMETRIC=YCBCR']
-        elif ds.rgb:
-            args = args + ['-co', 'PHOTOMETRIC=YCBCR']
-    command = ['gdal_translate'] + args + [file_in, file_out]
-    check_output(command)
+    (engine or SubprocessEngine()).compress(file_in, file_out)
 
 
-def pyramid(file_in):
+def pyramid(file_in, engine=None):
     """Add overviews to a GeoTIFF.
 
-    Calls out to ``gdaladdo`` to add overview images to the input file. This
+    Overviews are added to the input file using average resampling. This
     will operate directly on the input file.
 
     .. note:: The parameter is a file name, not a file handle.
 
     :param file_in: input file name
+    :param engine: :class:`Engine`, defaults to :class:`SubprocessEngine`
     """
 
-    with closing(Raster(file_in)) as ds:
-        levels = compute_levels(ds.width, ds.height)
-    if levels:
-        command = ['gdaladdo', '-r', 'average', file_in] + levels
-        check_output(command)
+    (engine or SubprocessEngine()).pyramid(file_in)
+
+
+def statistics(file, update=False, buckets=256, min_size=1024):
+    """Compute and store band statistics and histograms for a raster.
+
+    Each band is read once, a strip of blocks at a time, from its smallest
+    overview at least ``min_size`` pixels across, or from the full
+    resolution band if there is none. Pixels equal to the band's nodata
+    value are ignored. Byte bands get a 256 bucket histogram covering every
+    value; other types are bucketed between GDAL's approximate minimum and
+    maximum, which it takes from an overview or a sample.
+
+    Without ``update``, the results are set with ``SetStatistics`` and
+    ``SetDefaultHistogram``, which GDAL keeps in a ``.aux.xml`` file beside
+    the raster. With ``update``, the file is opened for update with
+    ``GDAL_PAM_ENABLED`` off and the results are written as band metadata,
+    which a GeoTIFF holds internally, so they travel with the file and
+    clients find them instead of computing them on first request. The
+    histogram is stored in the ``STATISTICS_HISTOMIN``,
+    ``STATISTICS_HISTOMAX``, ``STATISTICS_HISTONUMBINS`` and
+    ``STATISTICS_HISTOBINVALUES`` items.
+
+    .. note:: The parameter is a file name, not a file handle.
+
+    :param file: file name
+    :param update: whether to write the statistics into the file
+    :param buckets: number of histogram buckets for non-byte bands
+    :param min_size: smallest width or height of overview to read
+    :returns: list with a dictionary of ``min``, ``max``, ``mean``,
+              ``stddev`` and ``histogram`` for each band
+    """
+
+    config = {'GDAL_PAM_ENABLED': 'NO'} if update else {}
+    with config_options(config), closing(Raster(file, update=update)) as ds:
+        if update:
+            results = embed_statistics(ds.ds, buckets, min_size)
+        else:
+            results = []
+            for band in ds.bands():
+                stats = band_statistics(band, buckets, min_size)
+                hist = stats['histogram']
+                band.SetStatistics(stats['min'], stats['max'],
+                                   stats['mean'], stats['stddev'])
+                band.SetDefaultHistogram(hist['min'], hist['max'],
+                                         hist['counts'])
+                results.append(stats)
+        ds.ds.FlushCache()
+    return results
+
+
+def embed_statistics(ds, buckets=256, min_size=1024):
+    """Compute statistics for an open dataset and set them as metadata.
+
+    See :func:`statistics`. Copying the dataset afterwards carries the
+    statistics into the copy, which is how :func:`cog` includes them
+    without rewriting the finished file.
+
+    :param ds: :class:`gdal.Dataset`
+    :param buckets: number of histogram buckets for non-byte bands
+    :param min_size: smallest width or height of overview to read
+    :returns: list of statistics for each band, as for :func:`statistics`
+    """
+
+    results = []
+    for i in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(i)
+        stats = band_statistics(band, buckets, min_size)
+        metadata = band.GetMetadata() or {}
+        metadata.update(_statistics_metadata(stats))
+        band.SetMetadata(metadata)
+        results.append(stats)
+    return results
+
+
+def band_statistics(band, buckets=256, min_size=1024):
+    """Compute statistics and a histogram for a band.
+
+    See :func:`statistics`.
+
+    :param band: :class:`gdal.Band`
+    :param buckets: number of histogram buckets for non-byte bands
+    :param min_size: smallest width or height of overview to read
+    :returns: dictionary of ``min``, ``max``, ``mean``, ``stddev`` and
+              ``histogram``
+    """
+
+    nodata = band.GetNoDataValue()
+    source = _statistics_source(band, min_size)
+    if source.DataType == gdal.GDT_Byte:
+        lo, hi, buckets = -0.5, 255.5, 256
+    else:
+        lo, hi = source.ComputeRasterMinMax(1)
+        if lo == hi:
+            lo, hi = lo - 0.5, hi + 0.5
+    width, height = source.XSize, source.YSize
+    block_rows = source.GetBlockSize()[1]
+    rows = max(1, STATISTICS_STRIP_SIZE // max(width, 1))
+    rows = max(block_rows, rows - rows % block_rows)
+    count, total, total_sq = 0, 0.0, 0.0
+    mn, mx = None, None
+    counts = np.zeros(buckets, dtype=np.int64)
+    for y in range(0, height, rows):
+        data = source.ReadAsArray(0, y, width, min(rows, height - y))
+        values = data.ravel().astype(np.float64)
+        mask = ~np.isnan(values)
+        if nodata is not None:
+            mask &= values != nodata
+        values = values[mask]
+        if not values.size:
+            continue
+        count += values.size
+        total += values.sum()
+        total_sq += np.square(values).sum()
+        mn = values.min() if mn is None else min(mn, values.min())
+        mx = values.max() if mx is None else max(mx, values.max())
+        counts += np.histogram(np.clip(values, lo, hi), bins=buckets,
+                               range=(lo, hi))[0]
+    if not count:
+        raise GDALError('Band contains no data')
+    mean = total / count
+    stddev = math.sqrt(max(total_sq / count - mean * mean, 0))
+    return {'min': float(mn), 'max': float(mx), 'mean': mean,
+            'stddev': stddev,
+            'histogram': {'min': lo, 'max': hi,
+                          'counts': [int(c) for c in counts]}}
+
+
+def raster_bounds(file, density=BOUNDS_DENSITY):
+    """Return the bounding box of a raster in WGS 84.
+
+    The corners of the raster are found from its geotransform. Since a
+    straight edge in the raster's projection may be curved in WGS 84,
+    ``density`` points along each edge are reprojected, all in one call,
+    and the box drawn around them. The raster is read with
+    :func:`describe`, so a raster that has already been inspected is not
+    opened again.
+
+    :param file: file name
+    :param density: number of points along each edge
+    :returns: tuple of ``(west, east, north, south)``, or ``None`` if the
+              raster has no coordinate reference system
+    """
+
+    info = describe(file)
+    if not info.crs:
+        return None
+    edges = _edge_points(0, info.width, 0, info.height, density)
+    gt = info.geotransform
+    x = gt[0] + edges[:, 0] * gt[1] + edges[:, 1] * gt[2]
+    y = gt[3] + edges[:, 0] * gt[4] + edges[:, 1] * gt[5]
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(info.crs)
+    return _wgs84_bounds(srs, np.column_stack((x, y)))
+
+
+def shapefile_bounds(file, density=BOUNDS_DENSITY):
+    """Return the bounding box of a zipped Shapefile in WGS 84.
 
+    The extent of the layer is read from the Shapefile's header, without
+    unpacking the archive or reading its features, and reprojected as in
+    :func:`raster_bounds`.
 
-def compute_levels(w, h):
+    :param file: file name of zip archive containing a Shapefile
+    :param density: number of points along each edge
+    :returns: tuple of ``(west, east, north, south)``, or ``None`` if the
+              Shapefile has no coordinate reference system
+    """
+
+    ds = ogr.Open('/vsizip/' + os.path.abspath(file))
+    if ds is None:
+        raise GDALError('Could not open %s' % file)
+    try:
+        layer = ds.GetLayer(0)
+        srs = layer.GetSpatialRef()
+        if srs is None:
+            return None
+        minx, maxx, miny, maxy = layer.GetExtent()
+    finally:
+        ds = None
+    edges = _edge_points(minx, maxx, miny, maxy, density)
+    return _wgs84_bounds(srs, edges)
+
+
+def cog(file_in, file_out, engine=None, compute_statistics=False):
+    """Write a Cloud Optimized GeoTIFF.
+
+    The output is compressed and tiled as by :func:`compress`, with
+    internal overviews, in a single write. Overviews come before the full
+    resolution image in the file, so a client reading a small scale view
+    only needs the start of the file.
+
+    Where GDAL has the COG driver it is used. Otherwise overviews are built
+    in a ``.ovr`` file beside a VRT of the input, and copied with it into
+    the output using ``COPY_SRC_OVERVIEWS``.
+
+    A COG cannot be given statistics afterwards without moving its image
+    directory behind the image data. If ``compute_statistics`` is true
+    they are computed on the VRT, from its overviews where there are any,
+    and set on it as metadata, so they are written with the rest of the
+    file. See :func:`embed_statistics`.
+
+    .. note:: Both parameters are file names, not file handles.
+
+    :param file_in: input file name
+    :param file_out: output file name
+    :param engine: :class:`Engine`, defaults to :class:`SubprocessEngine`
+    :param compute_statistics: whether to compute and embed statistics
+    :returns: list of statistics for each band if they were computed, as
+              for :func:`statistics`, otherwise ``None``
+    """
+
+    return (engine or SubprocessEngine()).cog(
+        file_in, file_out, compute_statistics=compute_statistics)
+
+
+def compute_levels(w, h, blocksize=2048):
     """Compute optimal list of overview levels.
 
-    Given the supplied width and height of an image, and assuming a block size
-    of 2048x2048, calculate the best levels for generating overviews. If
-    ``max(w, h)`` is less than 2048 an empty list is returned.
+    Given the supplied width and height of an image, and its block size,
+    calculate the best levels for generating overviews. Levels are added
+    until the smallest overview fits in a single block. If ``max(w, h)`` is
+    less than the block size an empty list is returned.
 
     :param w: width of image
     :param h: height of image
+    :param blocksize: width and height of tiles in pixels
     :returns: list of levels
     """
 
-    num_levels = int(math.ceil(math.log((max(w, h)/2048), 2)))
+    num_levels = int(math.ceil(math.log((max(w, h)/blocksize), 2)))
     return [2**y for y in range(1, num_levels + 1)]
+
+
+def _edge_points(x0, x1, y0, y1, density):
+    steps = np.linspace(0, 1, max(density, 2))
+    xs = x0 + (x1 - x0) * steps
+    ys = y0 + (y1 - y0) * steps
+    return np.concatenate((
+        np.column_stack((xs, np.full_like(xs, y0))),
+        np.column_stack((xs, np.full_like(xs, y1))),
+        np.column_stack((np.full_like(ys, x0), ys)),
+        np.column_stack((np.full_like(ys, x1), ys))))
+
+
+def _wgs84_bounds(srs, points):
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs = srs.Clone()
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if srs.IsSame(wgs84):
+        transformed = points
+    else:
+        transform = osr.CoordinateTransformation(srs, wgs84)
+        transformed = np.array(transform.TransformPoints(points.tolist()))
+    lon, lat = transformed[:, 0], transformed[:, 1]
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    if not valid.any():
+        raise GDALError('Could not reproject extent to WGS 84')
+    lon, lat = lon[valid], lat[valid]
+    return (float(lon.min()), float(lon.max()), float(lat.max()),
+            float(lat.min()))
+
+
+def _statistics_source(band, min_size):
+    source = band
+    for i in range(band.GetOverviewCount()):
+        overview = band.GetOverview(i)
+        if max(overview.XSize, overview.YSize) < min_size:
+            continue
+        if max(overview.XSize, overview.YSize) < \
+                max(source.XSize, source.YSize):
+            source = overview
+    return source
+
+
+def _statistics_metadata(stats):
+    hist = stats['histogram']
+    return {
+        'STATISTICS_MINIMUM': repr(stats['min']),
+        'STATISTICS_MAXIMUM': repr(stats['max']),
+        'STATISTICS_MEAN': repr(stats['mean']),
+        'STATISTICS_STDDEV': repr(stats['stddev']),
+        'STATISTICS_HISTOMIN': repr(hist['min']),
+        'STATISTICS_HISTOMAX': repr(hist['max']),
+        'STATISTICS_HISTONUMBINS': str(len(hist['counts'])),
+        'STATISTICS_HISTOBINVALUES':
+            ''.join('%d|' % c for c in hist['counts']),
+    }
+
+
+def _set_cache_max(size):
+    # Before GDAL 2.0 the bindings take the cache size as a C int
+    if gdal_version() < 2000000:
+        size = min(size, 2**31 - 1)
+    gdal.SetCacheMax(size)
+
+
+def _remove(*files):
+    for f in files:
+        if f.startswith('/vsimem/'):
+            gdal.Unlink(f)
+        elif os.path.exists(f):
+            os.remove(f)
+
+
+def _creation_args(options):
+    args = []
+    for option in options:
+        args = args + ['-co', option]
+    return args
@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import io
+import os
+import threading
+import time
+import uuid
+
+
+#: Size of the blocks uploaded files are read from disk in.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 class GeoService(object):
-    def __init__(self, session, url, workspace, datastore):
+    def __init__(self, session, url, workspace, datastore, catalog_ttl=300,
+                 connection=None):
         self.session = session
         self.url = url
         self.workspace = workspace
         self.datastore = datastore
+        self.catalog = Catalog(self, catalog_ttl, connection)
         self.shapefile_import = {
             'import': {
                 'targetStore': {
@@ -47,18 +57,54 @@ class GeoService(object):
         return '%s/wfs' % self.url.rstrip('/')
 
     def put(self, data, ftype, name):
-        if ftype == 'shapefile':
-            import_url = self._create_import(self.shapefile_import)
-        elif ftype == 'geotiff':
-            import_url = self._create_import(self.geotiff_import)
-        else:
-            raise Exception('unknown format')
+        import_url = self._create_import(self._import_context(ftype))
         task_url = self._create_upload_task(
             '{}/tasks'.format(import_url.rstrip('/')), data)
         self._set_task_method(task_url, name, ftype)
         self._run_import(import_url)
+        self.catalog.add(name, ftype)
         return import_url
 
+    def _import_context(self, ftype):
+        if ftype == 'shapefile':
+            return self.shapefile_import
+        elif ftype == 'geotiff':
+            return self.geotiff_import
+        raise Exception('unknown format')
+
+    def list_layers(self, ftype):
+        """Return the names of the layers of a type in GeoServer.
+
+        Shapefiles are published as feature types in the datastore, and
+        GeoTIFFs as coverages in the workspace. Each is listed in one
+        request. A workspace or datastore that does not exist yet has no
+        layers.
+
+        :param ftype: one of ``shapefile`` or ``geotiff``
+        :returns: set of layer names
+        """
+
+        url = self.url.rstrip('/')
+        if ftype == 'shapefile':
+            url = '{}/rest/workspaces/{}/datastores/{}/featuretypes.json'.\
+                format(url, self.workspace, self.datastore)
+            key, item = 'featureTypes', 'featureType'
+        elif ftype == 'geotiff':
+            url = '{}/rest/workspaces/{}/coverages.json'.format(
+                url, self.workspace)
+            key, item = 'coverages', 'coverage'
+        else:
+            raise Exception('unknown format')
+        r = self.session.get(url)
+        if r.status_code == 404:
+            return set()
+        r.raise_for_status()
+        layers = r.json().get(key) or {}
+        return set(layer['name'] for layer in layers.get(item, []))
+
+    def _replace(self, task_url):
+        self.session.put(task_url, json={'task': {'updateMode': 'REPLACE'}})
+
     def _create_import(self, data):
         r = self.session.post(self.service_url, json=data)
         r.raise_for_status()
@@ -69,20 +115,171 @@ class GeoService(object):
         r.raise_for_status()
 
     def _create_upload_task(self, url, data):
-        with io.open(data, 'rb') as fp:
-            r = self.session.post(url, files={'filedata': fp})
+        if isinstance(data, tuple):
+            return self._post_file(url, *data)
+        with io.open(data, 'rb', buffering=UPLOAD_CHUNK_SIZE) as fp:
+            return self._post_file(url, os.path.basename(data), fp)
+
+    def _post_file(self, url, filename, fp):
+        body = MultipartFile('filedata', filename, fp)
+        r = self.session.post(url, data=body,
+                              headers={'Content-Type': body.content_type})
         r.raise_for_status()
         return r.headers.get('location')
 
     def _set_task_method(self, url, name, ftype):
-        shape = '{}/rest/workspaces/{}/datastores/{}/featuretypes/{}'
-        tiff = '{}/rest/workspaces/{}/coveragestores/{}/coverages/{}'
-        if ftype == 'shapefile':
-            r = self.session.get(shape.format(self.url.rstrip('/'),
-                                              self.workspace, self.datastore,
-                                              name))
-        elif ftype == 'geotiff':
-            r = self.session.get(tiff.format(self.url.rstrip('/'),
-                                             self.workspace, name, name))
-        if r.status_code == 200:
-            self.session.put(url, json={'task': {'updateMode': 'REPLACE'}})
+        if self.catalog.exists(name, ftype):
+            self._replace(url)
+
+
+class Catalog(object):
+    """Cache of the layers published in a GeoServer.
+
+    The layers of each type are listed with
+    :meth:`GeoService.list_layers` the first time they are needed, and
+    again once the listing is ``ttl`` seconds old. Layers published through
+    the service are added as they are uploaded. Checking whether a layer
+    exists, to decide whether an upload replaces it, is then usually a
+    lookup rather than a listing.
+
+    Given a redis connection, the listings are kept in redis as sets that
+    expire after ``ttl`` seconds. RQ runs each job in a process of its own,
+    so this is what lets one listing serve every job until it expires.
+    Without a connection they are kept in this process, and can be shared
+    between its threads.
+
+    :param service: :class:`GeoService`
+    :param ttl: seconds a listing is used for
+    :param connection: redis connection to keep listings in, if any
+    """
+
+    #: Member added to every listing kept in redis, so that an empty
+    #: listing is cached as well. It is not a valid layer name.
+    LISTED = ''
+
+    def __init__(self, service, ttl=300, connection=None):
+        self.service = service
+        self.ttl = ttl
+        self.connection = connection
+        self._lock = threading.Lock()
+        self._listings = {}
+
+    def exists(self, name, ftype):
+        """Return whether a layer exists.
+
+        :param name: layer name
+        :param ftype: one of ``shapefile`` or ``geotiff``
+        """
+
+        if self.connection is None:
+            return name in self._layers(ftype)
+        key = self._key(ftype)
+        pipe = self.connection.pipeline()
+        pipe.sismember(key, self.LISTED)
+        pipe.sismember(key, name)
+        listed, found = pipe.execute()
+        if listed:
+            return bool(found)
+        layers = self.service.list_layers(ftype)
+        pipe = self.connection.pipeline()
+        pipe.delete(key)
+        pipe.sadd(key, self.LISTED, *layers)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+        return name in layers
+
+    def add(self, name, ftype):
+        """Record a layer that has been published."""
+
+        if self.connection is None:
+            with self._lock:
+                if ftype in self._listings:
+                    self._listings[ftype][1].add(name)
+            return
+        key = self._key(ftype)
+        pipe = self.connection.pipeline()
+        pipe.sadd(key, name)
+        pipe.ttl(key)
+        ttl = pipe.execute()[1]
+        if ttl is None or ttl < 0:
+            # There was no listing to add to, only this layer.
+            self.connection.delete(key)
+
+    def invalidate(self):
+        """Discard the cached listings."""
+
+        if self.connection is not None:
+            self.connection.delete(*[self._key(ftype) for ftype in
+                                     ('shapefile', 'geotiff')])
+        with self._lock:
+            self._listings.clear()
+
+    def _key(self, ftype):
+        return 'kepler:catalog:{}:{}:{}:{}'.format(
+            self.service.url.rstrip('/'), self.service.workspace,
+            self.service.datastore, ftype)
+
+    def _layers(self, ftype):
+        with self._lock:
+            listing = self._listings.get(ftype)
+            if listing and time.time() - listing[0] < self.ttl:
+                return listing[1]
+        layers = self.service.list_layers(ftype)
+        with self._lock:
+            self._listings[ftype] = (time.time(), layers)
+        return layers
+
+
+class MultipartFile(object):
+    """A ``multipart/form-data`` request body containing one file.
+
+    requests builds a multipart body in memory before sending it, so
+    uploading a file that way needs as much memory as the file is big.
+    This reads the file as the body is sent instead, so memory use does
+    not depend on the size of the file. Its length is known up front, so
+    the body is sent with a ``Content-Length`` rather than chunked::
+
+        body = MultipartFile('filedata', 'layer.tif', fp)
+        session.post(url, data=body,
+                     headers={'Content-Type': body.content_type})
+
+    :param field: name of the form field
+    :param filename: file name given to the server
+    :param fp: seekable file object opened in binary mode, read from its
+               current position
+    :param boundary: multipart boundary, generated if not given
+    """
+
+    def __init__(self, field, filename, fp, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        head = ('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\nContent-Type: application/octet-stream'
+                '\r\n\r\n' % (self.boundary, field, filename))
+        tail = '\r\n--%s--\r\n' % self.boundary
+        start = fp.tell()
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell() - start
+        fp.seek(start)
+        self._parts = [io.BytesIO(head.encode('utf-8')), fp,
+                       io.BytesIO(tail.encode('utf-8'))]
+        self.len = len(head.encode('utf-8')) + size + len(tail)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        chunks = []
+        while size > 0 and self._parts:
+            data = self._parts[0].read(size)
+            if not data:
+                self._parts.pop(0)
+                continue
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
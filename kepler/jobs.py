@@ -1,24 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from contextlib import closing
+from datetime import timedelta
+from functools import partial
+import io
 import os
 import shutil
-import tempfile
 import traceback
 
 from flask import current_app
 
-from kepler.bag import unpack, get_datatype
-from kepler.extensions import db, s3
+from kepler import scratch
+from kepler.bag import Bag, get_datatype
+from kepler.exceptions import InsufficientScratchSpace
+from kepler.extensions import db, s3, req
+from kepler.geo import configure_s3, has_vsis3, vsis3
 from kepler.models import Job, Item, get_or_create
+from kepler.pipeline import Stage, run_stages
+from kepler.prefetch import discard_bag, prefetched_bag
 from kepler.tasks import (index_shapefile, upload_shapefile, index_geotiff,
                           upload_geotiff, submit_to_dspace,
-                          get_geotiff_url_from_dspace)
-
-
-def fetch_bag(bucket, key):
-    tmp = tempfile.NamedTemporaryFile(delete=False)
-    s3.client.download_file(bucket, key, tmp.name)
-    return tmp.name
+                          get_geotiff_url_from_dspace, publish_record,
+                          schedule_poll)
+from kepler.transfer import TransferStats, open_object
+from kepler.utils import children_rss, rss, utcnow
 
 
 def delete_bag(bucket, key):
@@ -33,30 +38,324 @@ def create_job(uri):
     return job
 
 
+PAYLOAD_STAGES = ('upload', 'dspace', 'tiff_url')
+
+
+def job_stages(datatype):
+    """Return the stages needed to process a bag of the given datatype.
+
+    Uploading a GeoTIFF to GeoServer and depositing it in DSpace do not
+    depend on each other and are run concurrently. Stages named in
+    ``PAYLOAD_STAGES`` only depend on the data files in the bag, not on its
+    metadata.
+
+    :param datatype: one of ``shapefile`` or ``geotiff``
+    :returns: list of :class:`~kepler.pipeline.Stage`
+    """
+
+    if datatype == 'shapefile':
+        return [
+            Stage('upload', upload_shapefile),
+            Stage('index', index_shapefile, requires=['upload']),
+        ]
+    elif datatype == 'geotiff':
+        return [
+            Stage('upload', upload_geotiff),
+            Stage('dspace', submit_to_dspace),
+            Stage('tiff_url', get_geotiff_url_from_dspace,
+                  requires=['dspace']),
+            Stage('index', index_geotiff, requires=['upload', 'tiff_url']),
+        ]
+    raise Exception('Unsupported format')
+
+
+def resume_job(job, bag):
+    """Pick up where the last unfinished job for the same bag left off.
+
+    The item's checkpoint is only trusted if it was written while processing
+    a bag with the same manifests. If only the metadata has changed since,
+    the stages in ``PAYLOAD_STAGES`` are still kept, since they depend on
+    the payload checksum alone; the rest are run again. Otherwise the
+    checkpoint is discarded.
+
+    :param job: :class:`~kepler.models.Job`
+    :param bag: :class:`~kepler.bag.BaseBag`
+    :returns: list of names of stages that do not need to be run again
+    """
+
+    checkpoint = job.item.load_checkpoint()
+    stages = checkpoint.get('stages', [])
+    same_bag = bag.checksum is not None and \
+        checkpoint.get('bag') == bag.checksum
+    same_payload = bag.payload_checksum is not None and \
+        checkpoint.get('payload') == bag.payload_checksum
+    if not (same_bag or same_payload):
+        job.item.clear_checkpoint()
+        return []
+    if not same_bag:
+        stages = [name for name in stages if name in PAYLOAD_STAGES]
+        job.item.clear_checkpoint()
+        job.item.save_checkpoint(bag=bag.checksum,
+                                 payload=bag.payload_checksum,
+                                 import_url=checkpoint.get('import_url'))
+        for name in stages:
+            job.item.save_checkpoint(stage=name)
+    if checkpoint.get('import_url'):
+        job.import_url = checkpoint['import_url']
+    return stages
+
+
+def payload_unchanged(item, bag):
+    """Check whether a bag's data files have already been published.
+
+    The data files are considered unchanged if the payload checksum and
+    access level match those of the last completed job for the item.
+
+    :param item: :class:`~kepler.models.Item`
+    :param bag: :class:`~kepler.bag.BaseBag`
+    """
+
+    return (bag.payload_checksum is not None and
+            item.payload_checksum == bag.payload_checksum and
+            item.access == bag.access)
+
+
+def verify_bag(bag, metadata_only=False):
+    """Check a bag against its manifests before any stage is run.
+
+    Payload files are extracted while they are verified, so a corrupt bag
+    fails before any expensive processing and a valid one has already been
+    unpacked. A GeoTIFF that GDAL will read in place is left in the
+    archive. If only the metadata is going to be used, only the tag files
+    and the FGDC metadata are verified.
+
+    :param bag: :class:`~kepler.bag.Bag`
+    :param metadata_only: whether to skip verifying the data files
+    :raises InvalidBag: if the bag fails verification
+    """
+
+    workers = current_app.config['VERIFY_WORKERS']
+    if metadata_only:
+        files = [bag.find('.xml')] + \
+            [name for _, _, name in bag.manifest_entries('tagmanifest-')]
+        return bag.verify(files=files, max_workers=workers)
+    extract = bag.payload
+    if bag.gdal_archive is not None:
+        extract = [name for name in extract if not name.endswith('.tif')]
+    return bag.verify(extract=extract, max_workers=workers)
+
+
+def gdal_archive(bucket, key, local=None):
+    """Return the path GDAL should read a bag's GeoTIFF through.
+
+    If ``GEOTIFF_VSI`` is set, a prefetched bag is read in place from local
+    disk and any other bag straight from S3, when GDAL supports it. This
+    saves extracting the GeoTIFF into scratch space.
+
+    That is all it saves. GDAL 1.11, which is pinned, has no ``/vsis3/``,
+    so only prefetched bags benefit. :func:`verify_bag` still streams the
+    GeoTIFF through its hashes before GDAL reads it again, and
+    :func:`~kepler.tasks.submit_to_dspace` still extracts it to build the
+    SWORD package. Hashing the GeoTIFF as GDAL reads it would save the
+    first of those reads.
+
+    :param bucket: name of S3 bucket
+    :param key: S3 key of the bag
+    :param local: path to a local copy of the bag
+    :returns: file name or GDAL virtual file system path of the bag, or
+              ``None`` if the GeoTIFF should be extracted
+    """
+
+    config = current_app.config
+    if not config.get('GEOTIFF_VSI'):
+        return None
+    if local:
+        return os.path.abspath(local)
+    if config.get('GDAL_ENGINE') == 'gdal' and has_vsis3() and \
+            not config.get('S3_TEST_URL'):
+        if config.get('S3_ACCESS_KEY_ID'):
+            configure_s3(config['S3_ACCESS_KEY_ID'],
+                         config['S3_SECRET_ACCESS_KEY'])
+        return vsis3(bucket, key)
+
+
+def detach_job(job):
+    """Copy a job and its item for a stage to change in a worker thread.
+
+    The copies are not added to any session, so a stage can change them
+    without touching the calling thread's session. See :func:`merge_job`.
+
+    :param job: :class:`~kepler.models.Job`
+    :returns: :class:`~kepler.models.Job`
+    """
+
+    item = Item(**_columns(job.item))
+    copy = Job(item=item, **_columns(job))
+    copy.detached_from = (_columns(job), _columns(job.item))
+    return copy
+
+
+def merge_job(job, copy):
+    """Apply the changes a stage made to a copy of a job.
+
+    Only the columns the stage changed are set, so stages that ran at the
+    same time do not undo each other's changes. The item's checkpoint is
+    only written in the calling thread, see :func:`checkpoint_stage`, and
+    is left alone.
+
+    :param job: :class:`~kepler.models.Job`
+    :param copy: :class:`~kepler.models.Job` from :func:`detach_job`
+    """
+
+    job_was, item_was = copy.detached_from
+    for obj, target, was in ((copy, job, job_was),
+                             (copy.item, job.item, item_was)):
+        for key, value in _columns(obj).items():
+            if key != 'checkpoint' and value != was[key]:
+                setattr(target, key, value)
+
+
+def checkpoint_stage(job, bag, stage):
+    """Record a finished stage, and the job's import URL, on the item.
+
+    This is called as each stage finishes and the checkpoint is committed
+    straight away, so it survives the worker being killed partway through
+    the job. Both the bag's checksum and its payload checksum are saved,
+    see :func:`resume_job`.
+    """
+
+    if bag.checksum is not None:
+        job.item.save_checkpoint(stage=stage.name, bag=bag.checksum,
+                                 payload=bag.payload_checksum,
+                                 import_url=job.import_url)
+
+
+def run_stages_with_usage(job, bag, stages, completed=()):
+    """Run a job's stages, checkpointing and reporting their resource usage.
+
+    Each stage works on a copy of the job. As it finishes, its changes are
+    applied to the job and committed along with its checkpoint, so they
+    are saved even if a later stage fails. The peak scratch space and
+    memory used while each stage was running are logged.
+
+    Memory is measured for the whole worker process, so stages running at
+    the same time are each given the peak of them all; the figures for a
+    stage are only exact when it ran alone. GDAL command line tools run as
+    child processes and are not included in these figures. The peak of
+    the largest of them is logged for the job as a whole, see
+    :func:`~kepler.utils.children_rss`.
+
+    :param job: :class:`~kepler.models.Job`
+    :param bag: :class:`~kepler.bag.BaseBag`
+    :param stages: list of :class:`~kepler.pipeline.Stage`
+    :param completed: names of stages that have already been run
+    """
+
+    with scratch.UsageMonitor() as disk, \
+            scratch.UsageMonitor(measure=rss) as memory:
+        def on_start(stage):
+            disk.start_stage(stage.name)
+            memory.start_stage(stage.name)
+
+        def on_finish(stage, copy):
+            disk.finish_stage(stage.name)
+            memory.finish_stage(stage.name)
+            merge_job(job, copy)
+            checkpoint_stage(job, bag, stage)
+            db.session.commit()
+
+        run_stages(stages, job, bag, current_app.config['JOB_STAGE_WORKERS'],
+                   completed=completed, on_start=on_start,
+                   on_finish=on_finish, detach=detach_job)
+    for name, peak in sorted(disk.peaks.items()):
+        current_app.logger.info('%r stage %s peak scratch usage: %d bytes, '
+                                'peak memory: %d bytes' %
+                                (job, name, peak, memory.peaks[name]))
+    current_app.logger.info('%r peak scratch usage: %d bytes, peak memory: '
+                            '%d bytes, peak memory of child processes: %d '
+                            'bytes' % (job, disk.peak, memory.peak,
+                                       children_rss()))
+
+
+def defer_job(job, error):
+    """Put off running a job until there may be more scratch space.
+
+    Rather than hold up the worker, the job is left for
+    :func:`~kepler.tasks.requeue_deferred_jobs` to put back on the queue
+    after ``SCRATCH_DEFER_DELAY`` seconds, doubling each time the job is
+    deferred. A job deferred more than ``SCRATCH_MAX_DEFERRALS`` times
+    fails.
+
+    :param job: :class:`~kepler.models.Job`
+    :param error: :class:`~kepler.exceptions.InsufficientScratchSpace`
+    :returns: whether the job was deferred
+    """
+
+    config = current_app.config
+    job.deferrals = (job.deferrals or 0) + 1
+    if job.deferrals > config['SCRATCH_MAX_DEFERRALS']:
+        job.status = u'FAILED'
+        job.error_msg = u'Deferred %d times: %s' % (job.deferrals - 1, error)
+        return False
+    delay = config['SCRATCH_DEFER_DELAY'] * 2 ** (job.deferrals - 1)
+    job.next_poll = utcnow() + timedelta(seconds=delay)
+    current_app.logger.warn('Deferring %r for %ds: %s' % (job, delay, error))
+    return True
+
+
 def run_job(id):
     job = Job.query.get(id)
     bucket = current_app.config['S3_BUCKET']
     key = job.item.uri
-    data = fetch_bag(bucket, key)
-    tmpdir = tempfile.mkdtemp()
+    tmpdir = scratch.mkdtemp()
+    deferred = False
+    stats = TransferStats()
     try:
-        bag = unpack(data, tmpdir)
-        datatype = get_datatype(bag)
-        if datatype == 'shapefile':
-            tasks = [upload_shapefile, index_shapefile, ]
-        elif datatype == 'geotiff':
-            tasks = [upload_geotiff, submit_to_dspace,
-                     get_geotiff_url_from_dspace, index_geotiff, ]
+        local = prefetched_bag(key)
+        if local:
+            reopen = partial(io.open, local, 'rb')
         else:
-            raise Exception('Unsupported format')
-        for task in tasks:
-            task(job, bag)
+            reopen = partial(open_object, bucket, key,
+                             current_app.config['S3_READ_BUFFER_SIZE'],
+                             stats=stats,
+                             read_ahead=current_app.config['S3_READ_AHEAD'])
+        archive = gdal_archive(bucket, key, local)
+        with reopen() as data, \
+                closing(Bag(data, tmpdir, reopen, archive)) as bag:
+            stages = job_stages(get_datatype(bag))
+            completed = resume_job(job, bag)
+            job.payload_checksum = bag.payload_checksum
+            republish = payload_unchanged(job.item, bag)
+            if republish:
+                completed = set(completed).union(PAYLOAD_STAGES)
+                job.import_url = None
+            with scratch.reserve(0 if republish else scratch.estimate(bag),
+                                 tmpdir):
+                if current_app.config['VERIFY_BAGS']:
+                    verify_bag(bag, metadata_only=republish)
+                run_stages_with_usage(job, bag, stages, completed)
+        job.item.clear_checkpoint()
         job.status = u'PENDING'
+        if republish:
+            db.session.commit()
+            req.q.enqueue(publish_record, job.id)
+        else:
+            schedule_poll(job)
+    except InsufficientScratchSpace as e:
+        deferred = defer_job(job, e)
     except:
         job.status = u'FAILED'
         job.error_msg = traceback.format_exc()
     finally:
         db.session.commit()
         shutil.rmtree(tmpdir, ignore_errors=True)
-        os.remove(data)
-        delete_bag(bucket, key)
+        discard_bag(key)
+        if stats.bytes:
+            current_app.logger.info('%r read %s from S3' % (job, stats))
+        if not deferred:
+            delete_bag(bucket, key)
+
+
+def _columns(obj):
+    return dict((column.key, getattr(obj, column.key))
+                for column in obj.__table__.columns)
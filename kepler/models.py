@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-from datetime import datetime
+import json
 
 from kepler.extensions import db
+from kepler.utils import utcnow
 
 
 def get_or_create(Model, **kwargs):
@@ -19,9 +20,14 @@ class Job(db.Model):
     status = db.Column(db.Enum(u'CREATED', u'PENDING', u'COMPLETED', u'FAILED',
                                name='status'), default=u'CREATED')
     import_url = db.Column(db.String())
-    time = db.Column(db.DateTime(timezone=True), default=datetime.now)
+    time = db.Column(db.DateTime(timezone=True), default=utcnow)
     error_msg = db.Column(db.Text())
+    payload_checksum = db.Column(db.String(40))
     item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
+    upload_size = db.Column(db.BigInteger)
+    next_poll = db.Column(db.DateTime(timezone=True))
+    polls = db.Column(db.Integer, default=0)
+    deferrals = db.Column(db.Integer, default=0)
 
     def __repr__(self):
         return '<Job #%d>' % (self.id,)
@@ -45,10 +51,41 @@ class Item(db.Model):
     jobs = db.relationship('Job', backref='item', lazy='dynamic')
     tiff_url = db.Column(db.Unicode(255))
     record = db.Column(db.Text())
+    checkpoint = db.Column(db.Text())
+    payload_checksum = db.Column(db.String(40))
+    stats = db.Column(db.Text())
 
     def __repr__(self):
         return '<Item #%d: %r>' % (self.id, self.uri)
 
+    def load_checkpoint(self):
+        """Return the stages completed by the last unfinished job.
+
+        The checkpoint is a dictionary containing a list of completed stage
+        names under ``stages``, along with any artifacts stages have saved,
+        such as ``import_url``.
+        """
+
+        return json.loads(self.checkpoint or '{}')
+
+    def save_checkpoint(self, stage=None, **kwargs):
+        """Add a completed stage and/or artifacts to the checkpoint.
+
+        :param stage: name of completed stage
+        :param \**kwargs: artifacts to save
+        """
+
+        checkpoint = self.load_checkpoint()
+        checkpoint.update(kwargs)
+        if stage is not None:
+            stages = checkpoint.setdefault('stages', [])
+            if stage not in stages:
+                stages.append(stage)
+        self.checkpoint = json.dumps(checkpoint)
+
+    def clear_checkpoint(self):
+        self.checkpoint = None
+
     def as_dict(self):
         return {
             'uri': self.uri,
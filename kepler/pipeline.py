@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    kepler.pipeline
+    ---------------
+
+    This module runs the tasks that make up a job as a graph of stages.
+    Each stage names the stages it depends on, and is started on a small
+    thread pool as soon as those have finished, so stages that do not
+    depend on each other overlap::
+
+        stages = [
+            Stage('upload', upload_geotiff),
+            Stage('dspace', submit_to_dspace),
+            Stage('tiff_url', get_geotiff_url_from_dspace,
+                  requires=['dspace']),
+            Stage('index', index_geotiff, requires=['upload', 'tiff_url']),
+        ]
+        run_stages(stages, job, bag)
+
+    Stages run in worker threads with their own application context. Objects
+    bound to the calling thread, such as models in its database session,
+    should not be handed to them. Pass a ``detach`` function to give each
+    stage its own copy of the job instead, and apply and commit the changes
+    the stage made to it in ``on_finish``, which runs in the calling thread.
+"""
+
+from __future__ import absolute_import
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from flask import current_app
+
+
+class Stage(object):
+    """A task in a job.
+
+    :param name: name of the stage, unique within a job
+    :param task: task to run, see :mod:`kepler.tasks`
+    :param requires: names of the stages that must finish first
+    """
+
+    def __init__(self, name, task, requires=()):
+        self.name = name
+        self.task = task
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return '<Stage %s>' % self.name
+
+
+def run_stages(stages, job, data, max_workers=2, completed=(),
+               on_start=None, on_finish=None, detach=None):
+    """Run stages concurrently, respecting their dependencies.
+
+    If a stage raises an exception no further stages are started. Stages
+    already running are allowed to finish before the exception is
+    re-raised.
+
+    Stages named in ``completed``, for example by a checkpoint from an
+    earlier attempt, are treated as finished and are not run again.
+
+    :param stages: list of :class:`Stage`
+    :param job: :class:`~kepler.models.Job` passed to each task
+    :param data: data passed to each task
+    :param max_workers: maximum number of stages to run at once
+    :param completed: names of stages that have already been run
+    :param on_start: function called with each :class:`Stage` as it is
+                     started, in the calling thread
+    :param on_finish: function called with each :class:`Stage` as it
+                      finishes, and the job its task was given, in the
+                      calling thread
+    :param detach: function called with the job as each stage is started,
+                   in the calling thread; the stage's task is given what it
+                   returns instead of the job
+    :returns: list of names of the stages run, in the order they finished
+    """
+
+    check_stages(stages)
+    app = current_app._get_current_object()
+    pending = OrderedDict((stage.name, stage) for stage in stages
+                          if stage.name not in completed)
+    running = {}
+    finished = [stage.name for stage in stages if stage.name in completed]
+    ran = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(r in finished for r in stage.requires):
+                    if on_start is not None:
+                        on_start(stage)
+                    stage_job = job if detach is None else detach(job)
+                    future = executor.submit(_run_stage, app, stage,
+                                             stage_job, data)
+                    running[future] = (stage, stage_job)
+                    del pending[name]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, stage_job = running.pop(future)
+                future.result()
+                finished.append(stage.name)
+                ran.append(stage.name)
+                if on_finish is not None:
+                    on_finish(stage, stage_job)
+    return ran
+
+
+def check_stages(stages):
+    """Ensure a list of stages can be run.
+
+    :raises ValueError: if a stage requires an unknown stage or the
+                        dependencies contain a cycle
+    """
+
+    names = set(stage.name for stage in stages)
+    for stage in stages:
+        unknown = set(stage.requires) - names
+        if unknown:
+            raise ValueError('%r requires unknown stages: %s' %
+                             (stage, ', '.join(sorted(unknown))))
+    resolved = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if set(s.requires) <= resolved]
+        if not ready:
+            raise ValueError('Stage dependencies contain a cycle: %s' %
+                             ', '.join(s.name for s in remaining))
+        resolved.update(s.name for s in ready)
+        remaining = [s for s in remaining if s not in ready]
+
+
+def _run_stage(app, stage, job, data):
+    with app.app_context():
+        stage.task(job, data)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    kepler.prefetch
+    ---------------
+
+    This module overlaps downloading a bag with processing the one before
+    it. :class:`PrefetchWorker` is an RQ worker that, as it starts each job,
+    looks at the next job on the queue and, if it is a
+    :func:`~kepler.jobs.run_job`, downloads its bag into scratch space in a
+    separate process. By the time that job runs its bag is usually already
+    on local disk, and :func:`~kepler.jobs.run_job` reads it from there
+    instead of from S3.
+
+    Prefetching is enabled with the ``PREFETCH_BAGS`` setting.
+"""
+
+from __future__ import absolute_import
+import hashlib
+import multiprocessing
+import os
+import signal
+
+from flask import current_app
+from rq import Worker
+
+from kepler import scratch
+from kepler.extensions import db, s3
+from kepler.models import Job
+from kepler.transfer import TransferStats, download
+
+
+def prefetch_path(key):
+    """Return the path a prefetched bag is stored at.
+
+    :param key: S3 key of the bag
+    """
+
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(scratch.root(), 'prefetch', name + '.zip')
+
+
+def prefetched_bag(key):
+    """Return the path of a prefetched bag, or ``None``.
+
+    :param key: S3 key of the bag
+    """
+
+    path = prefetch_path(key)
+    if os.path.isfile(path):
+        return path
+
+
+def prefetch_bag(bucket, key):
+    """Download a bag into scratch space.
+
+    The bag is written to a temporary file which is renamed once the
+    download is complete, so a partial download is never mistaken for a
+    prefetched bag. The bag is not downloaded if that would leave too
+    little scratch space for running jobs.
+
+    :param bucket: name of S3 bucket
+    :param key: S3 key of the bag
+    :returns: path to the bag, or ``None`` if it was not downloaded
+    """
+
+    path = prefetch_path(key)
+    if os.path.isfile(path):
+        return path
+    size = s3.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    available = scratch.free_space() - scratch.reserved() - \
+        current_app.config.get('SCRATCH_MIN_FREE', 0)
+    if size > available:
+        current_app.logger.info('Not prefetching %s: %d bytes needed, %d '
+                                'available' % (key, size, available))
+        return None
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = path + '.part'
+    stats = TransferStats()
+    try:
+        download(bucket, key, tmp, stats)
+        os.rename(tmp, path)
+        current_app.logger.info('Prefetched %s: %s' % (key, stats))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+def discard_bag(key):
+    """Remove a prefetched bag, if there is one."""
+
+    path = prefetch_path(key)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def next_bag(queue):
+    """Return the S3 key of the bag for the next job on a queue.
+
+    :param queue: :class:`rq.Queue`
+    :returns: tuple of RQ job id and S3 key, or ``None`` if the next job
+              is not a :func:`~kepler.jobs.run_job`
+    """
+
+    jobs = queue.get_jobs(0, 1)
+    if not jobs or jobs[0].func_name != 'kepler.jobs.run_job':
+        return None
+    job = Job.query.get(jobs[0].args[0])
+    if job is None:
+        return None
+    return jobs[0].id, job.item.uri
+
+
+class PrefetchWorker(Worker):
+    """RQ worker that prefetches the bag for the next job.
+
+    Jobs are still run one at a time in a forked work horse. The download
+    runs in a separate process with its own S3 client while the horse runs.
+    The worker itself starts no threads, so the horse it forks does not
+    inherit connections, or locks held by threads, part way through a
+    download. Before the next job is started the download is waited for; if
+    another worker has taken the job the bag was fetched for, the bag is
+    removed.
+
+    The worker must be run inside an application context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PrefetchWorker, self).__init__(*args, **kwargs)
+        self._prefetch = None
+
+    def execute_job(self, job, queue):
+        self._finish_prefetch(job)
+        self._start_prefetch(queue)
+        return super(PrefetchWorker, self).execute_job(job, queue)
+
+    def _start_prefetch(self, queue):
+        try:
+            upcoming = next_bag(queue)
+        finally:
+            # Database connections must not be shared with forked processes
+            db.session.remove()
+            db.engine.dispose()
+        if upcoming is None:
+            return
+        job_id, key = upcoming
+        app = current_app._get_current_object()
+        process = multiprocessing.Process(target=_prefetch, args=(app, key))
+        process.daemon = True
+        process.start()
+        self._prefetch = (job_id, key, process)
+
+    def _finish_prefetch(self, job):
+        if self._prefetch is None:
+            return
+        job_id, key, process = self._prefetch
+        self._prefetch = None
+        process.join()
+        if job.id != job_id:
+            discard_bag(key)
+
+
+def _prefetch(app, key):
+    # The worker's signal handlers are not meant for this process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    with app.app_context():
+        s3.init_app(app)
+        try:
+            prefetch_bag(app.config['S3_BUCKET'], key)
+        except Exception:
+            app.logger.exception('Failed to prefetch %s' % key)
@@ -9,14 +9,55 @@ from ogre.record import Record
 from ogre.xml import parse
 
 
-def create_record(metadata, parser, **kwargs):
+BBOX_FIELDS = ('_bbox_w', '_bbox_e', '_bbox_n', '_bbox_s')
+
+#: Largest difference, in degrees, between the bounding box in a layer's
+#: metadata and the one computed from its data for the metadata to be kept.
+BBOX_TOLERANCE = 0.01
+
+
+def create_record(metadata, parser, bbox=None, **kwargs):
+    """Create a record from metadata.
+
+    If ``bbox`` is given it should be the bounding box computed from the
+    layer itself. It replaces the bounding box in the metadata when that is
+    missing or differs by more than :data:`BBOX_TOLERANCE`.
+
+    :param metadata: file name or file object of metadata
+    :param parser: ogre parser class for the metadata
+    :param bbox: tuple of ``(west, east, north, south)`` in WGS 84
+    :param \**kwargs: additional fields to add to the record
+    """
+
     record = parse(metadata, parser)
     record.update(kwargs)
+    if bbox is not None and not bbox_matches(_record_bbox(record), bbox):
+        record.update(zip(BBOX_FIELDS, bbox))
     return MitRecord(solr_geom=(record['_bbox_w'], record['_bbox_e'],
                                 record['_bbox_n'], record['_bbox_s']),
                      **record)
 
 
+def bbox_matches(a, b, tolerance=BBOX_TOLERANCE):
+    """Return whether two bounding boxes are the same within a tolerance.
+
+    :param a: tuple of ``(west, east, north, south)``, or ``None``
+    :param b: tuple of ``(west, east, north, south)``, or ``None``
+    :param tolerance: largest difference in degrees for any side
+    """
+
+    if a is None or b is None:
+        return False
+    return all(abs(x - y) <= tolerance for x, y in zip(a, b))
+
+
+def _record_bbox(record):
+    try:
+        return tuple(float(record[f]) for f in BBOX_FIELDS)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
 def rights_mapper(term):
     """Maps access rights from FGDC to canonical GeoBlacklight value."""
     if term.lower().startswith('unrestricted'):
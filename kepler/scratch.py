@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+    kepler.scratch
+    --------------
+
+    This module manages the scratch space jobs use for their intermediate
+    files. All scratch files are created under ``SCRATCH_DIR`` (the system
+    temp directory by default).
+
+    Before a job starts it estimates the space it will need from the sizes
+    of the files in the bag and reserves it::
+
+        with reserve(estimate(bag)):
+            ...
+
+    A reservation that would leave less than ``SCRATCH_MIN_FREE`` bytes free
+    on the scratch volume, after allowing for every other outstanding
+    reservation, raises :class:`~kepler.exceptions.InsufficientScratchSpace`
+    so the job can be deferred instead of running out of space partway
+    through. Reservations are recorded as files in the scratch directory so
+    that they are seen by every worker process sharing it, and are made
+    under a lock on the directory.
+
+    A reservation can name the directory the job keeps its files in. Scratch
+    files the process creates while it holds the reservation go there, and
+    whatever is already in it is not counted again against the free space.
+    Each reservation records the process that made it and when, so one left
+    behind by a worker that was killed is removed, along with its
+    directory, once the process has gone or it is older than
+    ``RESERVATION_MAX_AGE``.
+"""
+
+from __future__ import absolute_import, division
+from contextlib import contextmanager
+import errno
+import fcntl
+import glob
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from kepler.exceptions import FileNotFound, InsufficientScratchSpace
+
+
+#: Size of the compressed GeoTIFF, with overviews, relative to the original.
+#: Compression nearly always shrinks the data, so this errs on the large side.
+COMPRESSED_GEOTIFF_RATIO = 1.34
+
+#: Seconds after which a reservation is assumed to have been left behind,
+#: even if a process with the same id is still running.
+RESERVATION_MAX_AGE = 24 * 60 * 60
+
+#: Directory of the job holding a reservation in this process, if any.
+_job_dir = None
+
+
+def root():
+    """Return the scratch directory, creating it if necessary."""
+
+    path = current_app.config.get('SCRATCH_DIR') or tempfile.gettempdir()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def mkdtemp(**kwargs):
+    """Create a temporary directory in the scratch directory.
+
+    While a job holds a reservation the directory is created in the job's
+    directory, see :func:`reserve`.
+    """
+
+    return tempfile.mkdtemp(dir=_job_dir or root(), **kwargs)
+
+
+def named_temporary_file(**kwargs):
+    """Create a :class:`tempfile.NamedTemporaryFile` in scratch.
+
+    While a job holds a reservation the file is created in the job's
+    directory, see :func:`reserve`.
+    """
+
+    return tempfile.NamedTemporaryFile(dir=_job_dir or root(), **kwargs)
+
+
+def free_space(path=None):
+    """Return the number of bytes available on the scratch volume."""
+
+    st = os.statvfs(path or root())
+    return st.f_bavail * st.f_frsize
+
+
+def estimate(bag):
+    """Estimate the scratch space needed to process a bag.
+
+    The payload is extracted from the bag. For GeoTIFFs there will also be
+    a compressed copy with overviews and a SWORD package containing the
+    original.
+
+    :param bag: :class:`~kepler.bag.BaseBag`
+    :returns: estimated number of bytes
+    """
+
+    needed = sum(bag.size(name) for name in bag.payload)
+    try:
+        tiff = bag.size(bag.find('.tif'))
+    except FileNotFound:
+        return needed
+    return needed + int(tiff * COMPRESSED_GEOTIFF_RATIO) + tiff
+
+
+def reserved():
+    """Return the number of reserved bytes not yet used.
+
+    Each reservation counts for its size less what is already in its job's
+    directory, since that space is no longer free. Reservations left behind
+    by workers that have died are removed.
+    """
+
+    total = 0
+    for path in glob.glob(os.path.join(root(), '.reservation-*')):
+        reservation = _read_reservation(path)
+        if reservation is None:
+            continue
+        if _abandoned(reservation):
+            _release(path, reservation.get('path'))
+            continue
+        total += max(reservation['size'] - _usage(reservation.get('path')),
+                     0)
+    return total
+
+
+@contextmanager
+def reserve(size, path=None):
+    """Reserve scratch space for the duration of a ``with`` block.
+
+    :param size: number of bytes to reserve
+    :param path: directory the job keeps its scratch files in; it is
+                 removed if the reservation is found to have been left
+                 behind by a worker that died
+    :raises InsufficientScratchSpace: if the space is not available
+    """
+
+    global _job_dir
+    with _locked():
+        available = free_space() - reserved() - \
+            current_app.config.get('SCRATCH_MIN_FREE', 0)
+        if size > available:
+            raise InsufficientScratchSpace(
+                'Job needs %d bytes of scratch space, %d available' %
+                (size, max(available, 0)))
+        name = os.path.join(root(), '.reservation-%s' % uuid.uuid4().hex)
+        with io.open(name, 'w') as fp:
+            fp.write(u'%s' % json.dumps({
+                'size': size,
+                'path': path,
+                'pid': os.getpid(),
+                'host': socket.gethostname(),
+                'time': time.time(),
+            }))
+    _job_dir = path
+    try:
+        yield
+    finally:
+        _job_dir = None
+        os.remove(name)
+
+
+class UsageMonitor(object):
+    """Track peak scratch usage while stages of a job run.
+
+    Free space on the scratch volume is sampled in a background thread.
+    Usage is measured relative to the free space when the monitor started,
+    and the peak is recorded for the job as a whole and for each stage
+    that was running at the time of the sample::
+
+        with UsageMonitor() as usage:
+            usage.start_stage('upload')
+            ...
+            usage.finish_stage('upload')
+        usage.peaks['upload']
+
+    Something other than scratch space can be tracked by passing a
+    function returning the current usage as ``measure``; its values are
+    recorded as they are, for example :func:`~kepler.utils.rss` for
+    memory.
+
+    :param interval: seconds between samples
+    :param measure: function returning current usage in bytes
+    """
+
+    def __init__(self, interval=0.5, measure=None):
+        self.interval = interval
+        self.peak = 0
+        self.peaks = {}
+        self._measure = measure
+        self._path = root()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        if self._measure is None:
+            baseline = free_space(self._path)
+            self._measure = \
+                lambda: max(baseline - free_space(self._path), 0)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self.sample()
+
+    def start_stage(self, name):
+        with self._lock:
+            self._running.add(name)
+            self.peaks.setdefault(name, 0)
+        self.sample()
+
+    def finish_stage(self, name):
+        self.sample()
+        with self._lock:
+            self._running.discard(name)
+
+    def sample(self):
+        used = self._measure()
+        with self._lock:
+            self.peak = max(self.peak, used)
+            for name in self._running:
+                self.peaks[name] = max(self.peaks[name], used)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+@contextmanager
+def _locked():
+    """Hold an exclusive lock on the scratch directory's reservations."""
+
+    with io.open(os.path.join(root(), '.reservations.lock'), 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _read_reservation(path):
+    try:
+        with io.open(path, 'r') as fp:
+            reservation = json.loads(fp.read())
+        int(reservation['size'])
+        return reservation
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _abandoned(reservation):
+    """Check whether the worker that made a reservation has gone."""
+
+    if time.time() - reservation.get('time', 0) > RESERVATION_MAX_AGE:
+        return True
+    if reservation.get('host') != socket.gethostname():
+        return False
+    try:
+        os.kill(reservation.get('pid'), 0)
+    except OSError as e:
+        return e.errno != errno.EPERM
+    except TypeError:
+        return True
+    return False
+
+
+def _release(path, job_dir=None):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    if job_dir:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _usage(path):
+    """Return the number of bytes in the files under a directory."""
+
+    total = 0
+    if not path:
+        return total
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+    return total
@@ -10,6 +10,37 @@ class DefaultConfig(object):
     TESTING = False
     DEBUG = False
     FGDC_MODS_XSLT = os.path.join(APP_ROOT, 'templates/fgdc_to_mods.xslt')
+    S3_READ_BUFFER_SIZE = 8 * 1024 * 1024
+    S3_READ_AHEAD = 4
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    S3_MAX_CONCURRENCY = 10
+    S3_MAX_POOL_CONNECTIONS = 10
+    S3_ADAPTIVE_TRANSFERS = False
+    JOB_STAGE_WORKERS = 2
+    CHECKPOINT_DIR = None
+    VERIFY_BAGS = True
+    VERIFY_WORKERS = 4
+    SCRATCH_DIR = None
+    SCRATCH_MIN_FREE = 512 * 1024 * 1024
+    SCRATCH_DEFER_DELAY = 30
+    SCRATCH_MAX_DEFERRALS = 10
+    PREFETCH_BAGS = False
+    GDAL_ENGINE = 'gdal'
+    COG_OUTPUT = False
+    GDAL_THREADS = None
+    GDAL_OVERVIEW_THREADS = None
+    GDAL_CACHEMAX = None
+    GEOTIFF_PROFILE = 'jpeg'
+    GDAL_MEMORY_BUDGET = None
+    GEOTIFF_STATISTICS = True
+    GEOTIFF_VSI = False
+    GEOTIFF_MEMORY_THRESHOLD = 16 * 1024 * 1024
+    RESOLVE_WORKERS = 8
+    POLL_MIN_INTERVAL = 10
+    POLL_MAX_INTERVAL = 600
+    POLL_IMPORT_RATE = 10 * 1024 * 1024
+    GEOSERVER_CATALOG_TTL = 300
 
 
 class HerokuConfig(DefaultConfig):
@@ -38,6 +69,22 @@ class HerokuConfig(DefaultConfig):
         self.S3_ACCESS_KEY_ID = os.environ['S3_ACCESS_KEY_ID']
         self.S3_SECRET_ACCESS_KEY = os.environ['S3_SECRET_ACCESS_KEY']
         self.S3_TEST_URL = os.environ.get('S3_TEST_URL')
+        self.S3_ADAPTIVE_TRANSFERS = \
+            os.environ.get('S3_ADAPTIVE_TRANSFERS') == 'true'
+        self.CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR')
+        self.SCRATCH_DIR = os.environ.get('SCRATCH_DIR')
+        self.PREFETCH_BAGS = os.environ.get('PREFETCH_BAGS') == 'true'
+        self.GDAL_ENGINE = os.environ.get('GDAL_ENGINE', 'gdal')
+        self.COG_OUTPUT = os.environ.get('COG_OUTPUT') == 'true'
+        self.GEOTIFF_PROFILE = os.environ.get('GEOTIFF_PROFILE', 'jpeg')
+        self.GEOTIFF_STATISTICS = \
+            os.environ.get('GEOTIFF_STATISTICS') != 'false'
+        self.GEOTIFF_VSI = os.environ.get('GEOTIFF_VSI') == 'true'
+        for name in ('GDAL_THREADS', 'GDAL_OVERVIEW_THREADS',
+                     'GDAL_CACHEMAX', 'GDAL_MEMORY_BUDGET',
+                     'GEOTIFF_MEMORY_THRESHOLD'):
+            if os.environ.get(name):
+                setattr(self, name, int(os.environ[name]))
 
 
 class TestConfig(DefaultConfig):
@@ -61,3 +108,6 @@ class TestConfig(DefaultConfig):
     S3_BUCKET = 'test_bucket'
     S3_ACCESS_KEY_ID = 'test_access_key_id'
     S3_SECRET_ACCESS_KEY = 'test_secret_access_key'
+    SCRATCH_MIN_FREE = 0
+    SCRATCH_DEFER_DELAY = 0
+    GEOTIFF_MEMORY_THRESHOLD = 0
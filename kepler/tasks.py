@@ -8,11 +8,16 @@
 
         task(job, data)
 
-    In most cases, the data will be an absolute path to a
-    `bag <https://tools.ietf.org/html/draft-kunze-bagit-10>`_.
+    In most cases, the data will be a :class:`~kepler.bag.BaseBag` or an
+    absolute path to a
+    `bag <https://tools.ietf.org/html/draft-kunze-bagit-10>`_. Tasks that
+    work on bags wrap the data with :func:`~kepler.bag.index` so that the
+    bag is only inspected once, however many values are read from it.
 """
 
-from __future__ import absolute_import
+from __future__ import absolute_import, division
+from datetime import timedelta
+from functools import partial
 import io
 import json
 import os
@@ -21,23 +26,30 @@ import tempfile
 import traceback
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
 from ogre.xml import FGDCParser
 from lxml import etree
 import pysolr
 import requests
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
 from sqlalchemy.sql import func
 
-from kepler import sword
+from kepler import scratch, sword
 from kepler.bag import (get_fgdc, get_shapefile, get_geotiff, get_access,
-                        get_shapefile_name, get_geotiff_name)
+                        get_shapefile_name, get_geotiff_name,
+                        get_geotiff_source, index)
 from kepler.models import Job
 from kepler.records import create_record, MitRecord
-from kepler.utils import make_uuid
+from kepler.utils import as_utc, make_uuid, utcnow
 from kepler.extensions import db, solr as solr_session, geoserver, dspace, req
 from kepler.parsers import MarcParser
-from kepler.geo import compress, pyramid
+from kepler.exceptions import GDALError
+from kepler.geo import (cog, compress, pyramid, get_engine, cpu_count,
+                        default_cachemax, gdal_version, memory_file,
+                        raster_bounds, read_file, shapefile_bounds,
+                        statistics, THREADED_COMPRESSION_VERSION,
+                        THREADED_OVERVIEWS_VERSION)
 
 try:
     from itertools import imap as map
@@ -48,22 +60,27 @@ except ImportError:
 def index_shapefile(job, data):
     """Index an uploaded Shapefile in Solr.
 
+        The bounding box in the FGDC metadata is checked against the
+        Shapefile, see :func:`_shapefile_bounds`.
+
         :param job: :class:`~kepler.models.Job`
         :param bag: absolute path to bag containing Shapefile
     """
 
-    access = get_access(data)
+    bag = index(data)
+    access = get_access(bag)
     gs = _get_geoserver(access)
     refs = {
         'http://www.opengis.net/def/serviceType/ogc/wms': gs.wms_url,
         'http://www.opengis.net/def/serviceType/ogc/wfs': gs.wfs_url,
     }
     uid = uuid.UUID(job.item.uri)
-    shp_name = get_shapefile_name(data)
+    shp_name = get_shapefile_name(bag)
     layer_id = "%s:%s" % (gs.workspace, shp_name)
     job.item.layer_id = layer_id
     db.session.commit()
-    _store_record(job, bag=data,
+    _store_record(job, bag=bag,
+                  bbox=_shapefile_bounds(job, bag),
                   dc_identifier_s=uid.urn,
                   dc_format_s='Shapefile',
                   dc_type_s='Dataset',
@@ -74,22 +91,27 @@ def index_shapefile(job, data):
 def index_geotiff(job, data):
     """Index an uploaded GeoTIFF file in Solr.
 
+    The bounding box in the FGDC metadata is checked against the GeoTIFF,
+    see :func:`_geotiff_bounds`.
+
     :param job: :class:`~kepler.models.Job`
     :param bag: absolute path to bag containing GeoTIFF
     """
 
-    access = get_access(data)
+    bag = index(data)
+    access = get_access(bag)
     gs = _get_geoserver(access)
     refs = {
         'http://www.opengis.net/def/serviceType/ogc/wms': gs.wms_url,
         'http://schema.org/downloadUrl': job.item.tiff_url
     }
-    tif_name = get_geotiff_name(data)
+    tif_name = get_geotiff_name(bag)
     uid = uuid.UUID(job.item.uri)
     layer_id = "%s:%s" % (gs.workspace, tif_name)
     job.item.layer_id = layer_id
     db.session.commit()
-    _store_record(job, bag=data,
+    _store_record(job, bag=bag,
+                  bbox=_geotiff_bounds(job, bag),
                   dc_identifier_s=uid.urn,
                   dc_format_s='GeoTIFF',
                   dc_type_s='Dataset',
@@ -106,11 +128,12 @@ def submit_to_dspace(job, data):
         :param data: absolute path to bag containing GeoTIFF
     """
     if not job.item.handle:
+        bag = index(data)
         pkg = sword.SWORDPackage(uuid=job.item.uri)
-        tiff = get_geotiff(data)
+        tiff = get_geotiff(bag)
         pkg.datafiles.append(tiff)
-        pkg.metadata = _fgdc_to_mods(get_fgdc(data))
-        with tempfile.NamedTemporaryFile(suffix='.zip') as fp:
+        pkg.metadata = _fgdc_to_mods(get_fgdc(bag))
+        with scratch.named_temporary_file(suffix='.zip') as fp:
             pkg.write(fp)
             handle = sword.submit(current_app.config['SWORD_SERVICE_URL'],
                                   fp.name)
@@ -149,72 +172,212 @@ def upload_shapefile(job, data):
         :param data: absolute path to bag containing Shapefile
     """
 
-    shp = get_shapefile(data)
-    access = get_access(data)
-    name = get_shapefile_name(data)
+    bag = index(data)
+    shp = get_shapefile(bag)
+    access = get_access(bag)
+    name = get_shapefile_name(bag)
+    job.upload_size = os.path.getsize(shp)
     import_url = _upload_to_geoserver(shp, 'shapefile', access, name)
     job.import_url = import_url
+    job.item.access = access
     db.session.commit()
 
 
 def upload_geotiff(job, data):
     """Upload GeoTIFF to GeoServer.
 
+        If ``COG_OUTPUT`` is set the GeoTIFF is written as a Cloud
+        Optimized GeoTIFF in one pass, rather than compressed and then
+        given overviews.
+
+        Unless ``GEOTIFF_STATISTICS`` is turned off, band statistics and
+        histograms are computed for the new GeoTIFF and saved on the item.
+        They are written into the GeoTIFF's own metadata, never a
+        ``.aux.xml`` sidecar, since only the ``.tif`` is posted. A Cloud
+        Optimized GeoTIFF gets them as it is written, rather than by
+        rewriting it afterwards, which would spoil its layout.
+
+        The GeoTIFF is read with :func:`~kepler.bag.get_geotiff_source`, so
+        it is not extracted from a bag GDAL can read in place (see
+        ``GEOTIFF_VSI``).
+
+        A GeoTIFF no bigger than ``GEOTIFF_MEMORY_THRESHOLD`` is compressed
+        and uploaded using GDAL's in-memory files, if the engine runs GDAL
+        in process, so the compressed GeoTIFF is never written to disk.
+        The original is only kept off the disk as well if the bag has not
+        been verified, since :func:`~kepler.jobs.verify_bag` extracts it,
+        or if GDAL reads it in place.
+
+        If ``CHECKPOINT_DIR`` is configured, the compressed GeoTIFF is kept
+        there until it has been uploaded, see :func:`_kept_geotiff`. A retry
+        of the same bag after a failed upload will then skip compressing the
+        GeoTIFF again, as long as the directory has survived.
+
         :param job: :class:`~kepler.models.Job`
         :param data: absolute path to bag containing GeoTIFF
     """
 
-    tiff = get_geotiff(data)
-    access = get_access(data)
-    name = get_geotiff_name(data)
-    tmpdir = tempfile.mkdtemp()
+    bag = index(data)
+    access = get_access(bag)
+    name = get_geotiff_name(bag)
+    kept = _kept_geotiff(job, bag, name)
+    engine = _geo_engine(job)
+    compressed = kept if kept and os.path.isfile(kept) else None
+    if compressed is None and _fits_in_memory(bag, engine):
+        job.import_url = _upload_in_memory(job, bag, engine, access, name)
+        job.item.access = access
+        db.session.commit()
+        return
+    workdir = None
+    import_url = None
     try:
-        with io.open(os.path.join(tmpdir, name + '.tif'), 'wb') as fp:
-            compress(tiff, fp.name)
-            pyramid(fp.name)
-            import_url = _upload_to_geoserver(fp.name, 'geotiff', access, name)
+        if compressed is None:
+            workdir = _workdir(kept)
+            compressed = os.path.join(workdir, name + '.tif')
+            _write_geotiff(job, get_geotiff_source(bag), compressed, engine)
+            if kept:
+                os.rename(workdir, os.path.dirname(kept))
+                compressed = kept
+        job.upload_size = os.path.getsize(compressed)
+        import_url = _upload_to_geoserver(compressed, 'geotiff', access, name)
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if kept and import_url:
+            shutil.rmtree(os.path.dirname(os.path.dirname(kept)),
+                          ignore_errors=True)
     job.import_url = import_url
+    job.item.access = access
     db.session.commit()
 
 
 def resolve_pending_jobs():
+    """Check on the GeoServer imports of pending jobs that are due.
+
+    Only jobs whose ``next_poll`` time has passed are checked, so this can
+    be run often; see :func:`schedule_poll`. Deferred jobs that are due are
+    put back on the queue first, see :func:`requeue_deferred_jobs`. Jobs
+    with no import, such as those republishing unchanged data, are left to
+    :func:`publish_record`.
+
+    The state of each import is requested concurrently, by up to
+    ``RESOLVE_WORKERS`` threads. Each job is then updated, or rescheduled
+    if its import is still running, inside its own savepoint, so an error
+    with one job is logged and rolled back without losing the others, and
+    all the updates are saved in a single commit. Jobs whose imports are
+    complete are then published, and finished imports are deleted from
+    GeoServer, again concurrently.
+    """
+
+    requeue_deferred_jobs()
+    workers = current_app.config.get('RESOLVE_WORKERS', 8)
     geo_session = requests.Session()
     geo_session.auth = (current_app.config.get('GEOSERVER_AUTH_USER'),
                         current_app.config.get('GEOSERVER_AUTH_PASS'))
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    geo_session.mount('http://', adapter)
+    geo_session.mount('https://', adapter)
     sub_q = db.session.query(Job.item_id, func.max(Job.time).label('time')).\
         group_by(Job.item_id).subquery()
     q = db.session.query(Job).\
         join(sub_q, and_(Job.item_id == sub_q.c.item_id,
                          Job.time == sub_q.c.time)).\
         order_by(Job.time.desc())
-    for job in q.filter(Job.status == 'PENDING'):
-        try:
-            r = geo_session.get(job.import_url)
-            r.raise_for_status()
-            state = r.json()['import']['state']
-            if state == 'COMPLETE':
-                req.q.enqueue(publish_record, job.id)
-            elif state == 'PENDING':
-                tasks = r.json()['import'].get('tasks', [])
-                task = tasks[0]
-                if task['state'] == 'ERROR':
-                    job.status = 'FAILED'
-                    job.error_msg = 'Task error'
-                elif task['state'] == 'NO_CRS':
-                    job.status = 'FAILED'
-                    job.error_msg = 'Missing CRS'
-        except:
-            job.status = 'FAILED'
-            job.error_msg = traceback.format_exc()
+    now = utcnow()
+    jobs = q.filter(Job.status == 'PENDING').\
+        filter(Job.import_url.isnot(None)).\
+        filter(or_(Job.next_poll.is_(None), Job.next_poll <= now)).all()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        states = executor.map(partial(_import_state, session=geo_session),
+                              [job.import_url for job in jobs])
+        completed, finished = [], []
+        for job, (state, error) in zip(jobs, states):
+            job_id, url = job.id, job.import_url
+            try:
+                with db.session.begin_nested():
+                    if error:
+                        job.status = 'FAILED'
+                        job.error_msg = error
+                    elif state != 'COMPLETE':
+                        job.polls = (job.polls or 0) + 1
+                        schedule_poll(job, now)
+            except Exception:
+                current_app.logger.exception(
+                    'Could not update job {}'.format(job_id))
+                continue
+            if state == 'COMPLETE' and not error:
+                completed.append(job_id)
+            if error or state == 'COMPLETE':
+                finished.append(url)
         db.session.commit()
-        if job.status == 'FAILED' or state == 'COMPLETE':
+        for job_id in completed:
+            req.q.enqueue(publish_record, job_id)
+        deletions = [(url, executor.submit(_delete_import_task, url,
+                                           geo_session))
+                     for url in finished]
+        for url, future in deletions:
             try:
-                _delete_import_task(job.import_url, geo_session)
+                future.result()
             except:
                 current_app.logger.warn(
-                    'Could not delete import task: {}'.format(job.import_url))
+                    'Could not delete import task: {}'.format(url))
+
+
+def requeue_deferred_jobs():
+    """Put jobs deferred for lack of scratch space back on the queue.
+
+    Jobs are requeued once their ``next_poll`` time has passed, see
+    :func:`~kepler.jobs.defer_job`.
+    """
+
+    jobs = Job.query.filter(Job.status == 'CREATED', Job.deferrals > 0,
+                            Job.next_poll <= utcnow()).all()
+    for job in jobs:
+        job.next_poll = None
+    db.session.commit()
+    for job in jobs:
+        req.q.enqueue('kepler.jobs.run_job', job.id)
+
+
+def schedule_poll(job, now=None):
+    """Set when a pending job's GeoServer import should next be checked.
+
+    See :func:`poll_delay`.
+
+    :param job: :class:`~kepler.models.Job`
+    :param now: timezone-aware current time, defaults to
+                :func:`~kepler.utils.utcnow`
+    """
+
+    now = now or utcnow()
+    elapsed = (now - as_utc(job.time)).total_seconds() if job.time else 0
+    delay = poll_delay(job.polls or 0, elapsed, job.upload_size)
+    job.next_poll = now + timedelta(seconds=delay)
+
+
+def poll_delay(polls, elapsed, size=None):
+    """Return how many seconds to wait before checking an import again.
+
+    The delay doubles with each check, from ``POLL_MIN_INTERVAL`` up to
+    ``POLL_MAX_INTERVAL``, but is never more than half the time the job
+    has been running, so an import that finishes quickly is noticed
+    quickly while a stuck one is checked less and less. The first check
+    waits for however long GeoServer is expected to take to import the
+    upload, at ``POLL_IMPORT_RATE`` bytes a second.
+
+    :param polls: number of times the import has been checked
+    :param elapsed: seconds since the job was created
+    :param size: size of the upload in bytes, if known
+    """
+
+    config = current_app.config
+    shortest = config.get('POLL_MIN_INTERVAL', 10)
+    longest = config.get('POLL_MAX_INTERVAL', 600)
+    delay = min(shortest * 2 ** polls, longest, elapsed / 2)
+    if polls == 0 and size:
+        delay = min(size / config.get('POLL_IMPORT_RATE', 10 * 1024 * 1024),
+                    longest)
+    return max(delay, shortest)
 
 
 def index_marc_records(job, data):
@@ -228,13 +391,14 @@ def publish_record(job_id):
     try:
         solr.add([json.loads(job.item.record)])
         job.status = 'COMPLETED'
+        job.item.payload_checksum = job.payload_checksum
     except:
         job.status = 'FAILED'
         job.error_msg = traceback.format_exc()
     db.session.commit()
 
 
-def _store_record(job, bag, **kwargs):
+def _store_record(job, bag, bbox=None, **kwargs):
     """Index a GeoServer-bound layer from the attached FGDC metadata.
 
     This will pull the FGDC metadata out of the Bag and add any necessary
@@ -242,11 +406,13 @@ def _store_record(job, bag, **kwargs):
 
     :param job: :class:`~kepler.models.Job`
     :param bag: absolute path to bag containing FGDC metadata
+    :param bbox: bounding box computed from the layer, used to check the
+                 one in the FGDC metadata
     :param \**kwargs: additional fields to add to the record
     """
 
     fgdc = get_fgdc(bag)
-    record = create_record(fgdc, FGDCParser, **kwargs)
+    record = create_record(fgdc, FGDCParser, bbox=bbox, **kwargs)
     job.item.record = record.to_json()
     db.session.commit()
 
@@ -259,7 +425,8 @@ def _upload_to_geoserver(data, filetype, access, name):
     and :func:`~upload_geotiff`.
 
     :param job: :class:`~kepler.models.Job`
-    :param data: absolute path to either Shapefile or GeoTIFF
+    :param data: absolute path to either Shapefile or GeoTIFF, or a tuple
+                 of file name and file object
     :param mimetype: one of ``application/zip`` or ``image/tiff``
     """
 
@@ -279,6 +446,32 @@ def _index_records(records):
     solr.add(map(_prep_solr_record, records))
 
 
+def _import_state(url, session):
+    """Return the state of a GeoServer import and any error.
+
+    This makes no changes to the database, so it can be run in any thread.
+
+    :param url: URL of the import
+    :param session: :class:`requests.Session` for GeoServer
+    :returns: tuple of import state and error message, which is ``None``
+              unless the import, or the request for it, failed
+    """
+
+    try:
+        r = session.get(url)
+        r.raise_for_status()
+        state = r.json()['import']['state']
+        if state == 'PENDING':
+            task = r.json()['import'].get('tasks', [])[0]
+            if task['state'] == 'ERROR':
+                return state, 'Task error'
+            elif task['state'] == 'NO_CRS':
+                return state, 'Missing CRS'
+        return state, None
+    except:
+        return None, traceback.format_exc()
+
+
 def _delete_import_task(url, session):
     _import = session.get(url).json()
     for task in _import['import']['tasks']:
@@ -325,6 +518,203 @@ def _normalize_sets(value):
     return value
 
 
+def _write_geotiff(job, source, out, engine):
+    """Compress a GeoTIFF, add overviews and compute its statistics.
+
+    Statistics are written into the GeoTIFF itself, since only the
+    ``.tif`` is posted to GeoServer. A Cloud Optimized GeoTIFF is given
+    them as it is written, see :func:`~kepler.geo.cog`; if they cannot be
+    computed it is written again without them.
+    """
+
+    with_statistics = current_app.config.get('GEOTIFF_STATISTICS', True)
+    if current_app.config.get('COG_OUTPUT'):
+        stats = None
+        if with_statistics:
+            try:
+                stats = cog(source, out, engine, compute_statistics=True)
+            except GDALError as e:
+                _statistics_failed(out, e)
+        if stats is None:
+            cog(source, out, engine)
+        else:
+            job.item.stats = json.dumps(stats)
+    else:
+        compress(source, out, engine)
+        pyramid(out, engine)
+        if with_statistics:
+            _save_statistics(job, out)
+
+
+def _fits_in_memory(bag, engine):
+    threshold = current_app.config.get('GEOTIFF_MEMORY_THRESHOLD')
+    return bool(threshold) and engine.in_process and \
+        bag.size(bag.find('.tif')) <= threshold
+
+
+def _upload_in_memory(job, bag, engine, access, name):
+    """Process and upload a small GeoTIFF in ``/vsimem/``.
+
+    The original is read from the bag into memory, unless GDAL can already
+    read it in place, and the compressed GeoTIFF is posted to GeoServer
+    from memory. Nothing is written to scratch space here, though the
+    original will already have been extracted if the bag was verified.
+    """
+
+    tif = bag.find('.tif')
+    filename = name + '.tif'
+    data = None if bag.gdal_archive else bag.read(tif)
+    with memory_file(os.path.basename(tif), data) as copy, \
+            memory_file(filename) as out:
+        source = bag.gdal_path(tif) if data is None else copy
+        _write_geotiff(job, source, out, engine)
+        compressed = read_file(out)
+    job.upload_size = len(compressed)
+    return _upload_to_geoserver((filename, io.BytesIO(compressed)),
+                                'geotiff', access, name)
+
+
+def _bounds(func, path):
+    try:
+        return func(path)
+    except GDALError as e:
+        current_app.logger.warning('Could not compute bounding box for %s: '
+                                   '%s' % (path, e))
+
+
+def _geotiff_bounds(job, bag):
+    """Return the bounding box of a bag's GeoTIFF, if it is cheap to read.
+
+    GDAL only needs the header, so a GeoTIFF it can read in place is never
+    extracted. When the payload is the one already published for the item
+    the GeoTIFF is not extracted just for its bounds either: a job
+    republishing metadata has no scratch space reserved, and the data was
+    checked when it was published. ``None`` is returned and the bounding
+    box in the FGDC metadata is kept.
+    """
+
+    if bag.gdal_archive is None and _republishing(job):
+        return None
+    return _bounds(raster_bounds, get_geotiff_source(bag))
+
+
+def _shapefile_bounds(job, bag):
+    """Return the bounding box of a bag's Shapefile, unless republishing.
+
+    The zipped Shapefile has to be extracted to be read, so as for
+    :func:`_geotiff_bounds` the bounding box in the FGDC metadata is kept
+    when the payload is the one already published for the item.
+    """
+
+    if _republishing(job):
+        return None
+    return _bounds(shapefile_bounds, get_shapefile(bag))
+
+
+def _republishing(job):
+    return job.payload_checksum is not None and \
+        job.payload_checksum == job.item.payload_checksum
+
+
+def _save_statistics(job, tiff):
+    try:
+        job.item.stats = json.dumps(statistics(tiff, update=True))
+    except GDALError as e:
+        _statistics_failed(tiff, e)
+
+
+def _statistics_failed(tiff, error):
+    current_app.logger.warning('Could not compute statistics for %s: %s'
+                               % (tiff, error))
+
+
+def _geo_engine(job):
+    """Create the GDAL engine configured by ``GDAL_ENGINE``.
+
+    GeoTIFFs are compressed with ``GEOTIFF_PROFILE``, see
+    :func:`~kepler.geo.get_profile`. ``GDAL_THREADS``,
+    ``GDAL_OVERVIEW_THREADS`` and ``GDAL_CACHEMAX`` default to the number
+    of CPUs and a share of the memory of the machine the worker is running
+    on. The thread settings only take effect from GDAL 2.1 and 3.2
+    respectively; older releases ignore them, which is logged. If
+    ``GDAL_MEMORY_BUDGET`` is set, GeoTIFFs are processed within it.
+    Progress is logged for engines that report it.
+    """
+
+    config = current_app.config
+    threads = config.get('GDAL_THREADS') or cpu_count()
+    ignored = [name for name, version in
+               (('GDAL_THREADS', THREADED_COMPRESSION_VERSION),
+                ('GDAL_OVERVIEW_THREADS', THREADED_OVERVIEWS_VERSION))
+               if gdal_version() < version]
+    if ignored:
+        current_app.logger.info('GDAL %d ignores %s' %
+                                (gdal_version(), ', '.join(ignored)))
+    cachemax = config.get('GDAL_CACHEMAX') or default_cachemax()
+    return get_engine(config.get('GDAL_ENGINE', 'subprocess'),
+                      config={'GDAL_CACHEMAX': cachemax},
+                      threads=threads,
+                      overview_threads=config.get('GDAL_OVERVIEW_THREADS') or
+                      threads,
+                      profile=config.get('GEOTIFF_PROFILE'),
+                      memory_budget=config.get('GDAL_MEMORY_BUDGET'),
+                      callback=_ProgressLogger(job))
+
+
+class _ProgressLogger(object):
+    """GDAL progress callback logging every ``step`` of progress."""
+
+    def __init__(self, job, step=0.25):
+        self.job = job
+        self.step = step
+        self.logged = 0
+
+    def __call__(self, complete, message, data):
+        if complete < self.logged:
+            self.logged = 0
+        if complete - self.logged >= self.step or \
+                (complete >= 1 and self.logged < 1):
+            self.logged = complete
+            current_app.logger.info('%r GDAL progress: %d%%' %
+                                    (self.job, complete * 100))
+        return 1
+
+
+def _kept_geotiff(job, bag, name):
+    """Return where a compressed GeoTIFF is kept between attempts.
+
+    Compressed GeoTIFFs are kept under ``CHECKPOINT_DIR``, in a directory
+    for the item and the payload of the bag they were made from. A retry of
+    the same bag finds one there without it being recorded in the database
+    partway through a stage, and a bag with new data files never picks up
+    a stale one.
+
+    :returns: file name, or ``None`` if GeoTIFFs are not kept
+    """
+
+    checkpoint_dir = current_app.config.get('CHECKPOINT_DIR')
+    if not checkpoint_dir or bag.payload_checksum is None:
+        return None
+    return os.path.join(checkpoint_dir, str(uuid.UUID(job.item.uri)),
+                        bag.payload_checksum, name + '.tif')
+
+
+def _workdir(kept=None):
+    """Create a working directory for a job's intermediate files.
+
+    If the compressed GeoTIFF is going to be kept the directory is created
+    beside where it will be kept, so that it can be renamed into place once
+    the GeoTIFF is complete. Otherwise a new temporary directory is used.
+    """
+
+    if kept is None:
+        return scratch.mkdtemp()
+    parent = os.path.dirname(os.path.dirname(kept))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    return tempfile.mkdtemp(dir=parent, prefix='.')
+
+
 def _get_geoserver(access):
     if access.lower() == 'restricted':
         return geoserver.secure
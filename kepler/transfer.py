@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+    kepler.transfer
+    ---------------
+
+    This module provides streaming access to bags stored in S3. Rather than
+    downloading a bag to a temporary file before unzipping it, an S3 object
+    can be opened as a seekable file and handed straight to
+    :class:`zipfile.ZipFile`::
+
+        from kepler.transfer import open_object
+
+        with open_object('bucket', 'key') as fp:
+            unpack(fp, '/path/to/bag')
+
+    Reads are translated into ranged GET requests and buffered, so only the
+    parts of the archive that are actually read are transferred. Once a
+    file is being read sequentially, as when a member is extracted, the
+    next few ranges are fetched concurrently ahead of the reader.
+
+    Whole objects are downloaded with :func:`download`, which uses the
+    multipart settings of the S3 extension. In adaptive mode the part size
+    and number of threads are chosen from the size of the object instead,
+    and the same choice sets the range size and read-ahead of
+    :func:`open_object`::
+
+        stats = TransferStats()
+        download('bucket', 'key', '/tmp/bag.zip', stats)
+        stats.throughput     # MB/s
+"""
+
+from __future__ import absolute_import, division
+import io
+import math
+import os
+import threading
+import time
+
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+
+from kepler.extensions import s3
+
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+MB = 1024 * 1024
+
+#: Bounds on the part size chosen in adaptive mode. S3 allows at most
+#: 10,000 parts, which the upper bound keeps well clear of.
+MIN_CHUNKSIZE = 8 * MB
+MAX_CHUNKSIZE = 256 * MB
+
+#: Number of parts per thread aimed for in adaptive mode, so that a slow
+#: part does not leave the other threads idle at the end of a download.
+PARTS_PER_THREAD = 4
+
+
+class S3Object(io.RawIOBase):
+    """Read-only, seekable view of an object in S3.
+
+    With ``read_ahead`` set, the object is read in ranges of ``chunk_size``
+    bytes. When a read follows on from the one before it, up to
+    ``read_ahead`` further ranges are requested concurrently, so the next
+    reads are usually served without waiting on S3.
+
+    :param bucket: name of S3 bucket
+    :param key: object key
+    :param client: boto3 S3 client, defaults to the application's client
+    :param stats: optional :class:`TransferStats` to record reads in
+    :param read_ahead: number of ranges to fetch ahead of sequential reads
+    :param chunk_size: size of ranges fetched ahead
+    """
+
+    def __init__(self, bucket, key, client=None, stats=None, read_ahead=0,
+                 chunk_size=DEFAULT_BUFFER_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.client = client or s3.client
+        self.stats = stats
+        head = self.client.head_object(Bucket=bucket, Key=key)
+        self.size = head['ContentLength']
+        self.read_ahead = read_ahead
+        self.chunk_size = chunk_size
+        self._pos = 0
+        self._next = None
+        self._chunks = []
+        self._executor = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence: %r' % whence)
+        if pos < 0:
+            raise ValueError('Negative seek position %d' % pos)
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos >= self.size or not len(b):
+            return 0
+        if not self.read_ahead:
+            end = min(self._pos + len(b), self.size) - 1
+            data = self._get_range(self._pos, end)
+        else:
+            data = self._read_chunk(self._pos)
+        n = min(len(b), len(data))
+        b[:n] = data[:n]
+        self._pos += n
+        self._next = self._pos
+        return n
+
+    def close(self):
+        self._drop(self._chunks)
+        self._chunks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        super(S3Object, self).close()
+
+    def _read_chunk(self, pos):
+        """Return the data from ``pos`` to the end of the range holding it.
+
+        Ranges before ``pos`` are dropped. If the read follows on from the
+        last one, the ranges after it are requested.
+        """
+
+        self._drop(c for c in self._chunks if c[1] <= pos)
+        self._chunks = [c for c in self._chunks if c[1] > pos]
+        if not self._chunks or self._chunks[0][0] > pos:
+            self._drop(self._chunks)
+            self._chunks = [self._fetch(pos)]
+        if pos == self._next:
+            while len(self._chunks) <= self.read_ahead and \
+                    self._chunks[-1][1] < self.size:
+                self._chunks.append(self._fetch(self._chunks[-1][1]))
+        start, _, future = self._chunks[0]
+        return future.result()[pos - start:]
+
+    def _fetch(self, start):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.read_ahead)
+        end = min(start + self.chunk_size, self.size)
+        return start, end, self._executor.submit(self._get_range, start,
+                                                 end - 1)
+
+    def _drop(self, chunks):
+        for _, _, future in chunks:
+            future.cancel()
+
+    def _get_range(self, start, end):
+        started = time.time()
+        r = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                   Range='bytes=%d-%d' % (start, end))
+        data = r['Body'].read()
+        if self.stats is not None:
+            self.stats.add(len(data), time.time() - started)
+        return data
+
+
+class TransferStats(object):
+    """Running total of bytes transferred and time spent transferring.
+
+    Time is summed over requests, so when several requests run at once the
+    throughput is that of a single connection.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, seconds):
+        with self._lock:
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    @property
+    def throughput(self):
+        """Throughput in MB/s, or ``None`` if nothing was transferred."""
+        if not self.seconds:
+            return None
+        return self.bytes / MB / self.seconds
+
+    def __str__(self):
+        if self.throughput is None:
+            return 'no data transferred'
+        return '%.1f MB in %.1fs (%.1f MB/s)' % \
+            (self.bytes / MB, self.seconds, self.throughput)
+
+
+def open_object(bucket, key, buffer_size=DEFAULT_BUFFER_SIZE, stats=None,
+                read_ahead=0):
+    """Open an S3 object for buffered, streaming reads.
+
+    In adaptive mode the buffer size and read-ahead are taken from the
+    part size and number of threads :func:`transfer_config` chooses for
+    the object, if they are larger.
+
+    :param bucket: name of S3 bucket
+    :param key: object key
+    :param buffer_size: number of bytes to fetch with each ranged GET
+    :param stats: optional :class:`TransferStats` to record reads in
+    :param read_ahead: number of ranges to fetch concurrently ahead of
+                       sequential reads, see :class:`S3Object`
+    :returns: :class:`io.BufferedReader`
+    """
+
+    obj = S3Object(bucket, key, stats=stats, read_ahead=read_ahead,
+                   chunk_size=buffer_size)
+    if s3.adaptive:
+        config = transfer_config(obj.size)
+        buffer_size = max(buffer_size, config.multipart_chunksize)
+        obj.chunk_size = buffer_size
+        obj.read_ahead = max(read_ahead, config.max_concurrency)
+    return io.BufferedReader(obj, buffer_size)
+
+
+def transfer_config(size=None):
+    """Return the :class:`~boto3.s3.transfer.TransferConfig` for an object.
+
+    Unless adaptive transfers are enabled this is the configured transfer
+    config of the S3 extension. In adaptive mode the part size is chosen so
+    that each of up to ``S3_MAX_CONCURRENCY`` threads gets several parts,
+    and no more threads are used than there are parts.
+
+    :param size: size of the object in bytes
+    """
+
+    config = s3.transfer_config
+    if not s3.adaptive or size is None:
+        return config
+    threads = config.max_concurrency
+    chunksize = int(math.ceil(size / (threads * PARTS_PER_THREAD)))
+    chunksize = min(max(chunksize, MIN_CHUNKSIZE), MAX_CHUNKSIZE)
+    threads = max(1, min(threads, int(math.ceil(size / chunksize))))
+    return TransferConfig(multipart_threshold=chunksize,
+                          multipart_chunksize=chunksize,
+                          max_concurrency=threads)
+
+
+def download(bucket, key, path, stats=None):
+    """Download an object to a file.
+
+    :param bucket: name of S3 bucket
+    :param key: object key
+    :param path: file name to download to
+    :param stats: optional :class:`TransferStats` to record the download in
+    :returns: size of the object in bytes
+    """
+
+    size = None
+    if s3.adaptive:
+        size = s3.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    started = time.time()
+    s3.client.download_file(bucket, key, path, Config=transfer_config(size))
+    size = os.path.getsize(path)
+    if stats is not None:
+        stats.add(size, time.time() - started)
+    return size
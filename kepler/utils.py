@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import io
+import os
+import resource
 import uuid
 
+import arrow
 from flask import request
 
 
@@ -11,8 +15,55 @@ def make_uuid(value, namespace):
     return str(uid)
 
 
+def utcnow():
+    """Return the current time as a timezone-aware UTC datetime."""
+    return arrow.utcnow().datetime
+
+
+def as_utc(value):
+    """Return a datetime as a timezone-aware UTC datetime.
+
+    A naive datetime, such as SQLite returns for any column, is taken to be
+    in UTC already.
+    """
+
+    return arrow.get(value).to('utc').datetime
+
+
 def request_wants_json():
     best = request.accept_mimetypes \
         .best_match(['application/json', 'text/html'])
     return best == 'application/json' and \
         request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
+
+
+def rss():
+    """Return the resident memory of this process in bytes.
+
+    The current value is read from ``/proc`` where it is available.
+    Elsewhere the peak for the process so far is returned instead.
+    """
+
+    try:
+        with io.open('/proc/self/statm', 'r') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return _maxrss(resource.RUSAGE_SELF)
+
+
+def children_rss():
+    """Return the peak resident memory of this process's children in bytes.
+
+    This is the peak of the largest child process that has finished and
+    been waited for, such as a GDAL command line tool, since this process
+    started. Children still running are not counted.
+    """
+
+    return _maxrss(resource.RUSAGE_CHILDREN)
+
+
+def _maxrss(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on OS X and kilobytes elsewhere
+    return peak if os.uname()[0] == 'Darwin' else peak * 1024
@@ -5,6 +5,9 @@ from __future__ import absolute_import
 from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
 from kepler.app import create_app
+from kepler.benchmark import FIXTURES, benchmark as run_benchmark, \
+    format_results
+from kepler.geo import ENGINES
 from kepler.settings import HerokuConfig
 from kepler.extensions import db
 
@@ -15,5 +18,17 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('paths', nargs='*', help='GeoTIFFs or directories of them')
+@manager.option('-p', '--profile', dest='profiles', action='append',
+                help='Compression profile, may be repeated')
+@manager.option('-e', '--engine', default='gdal',
+                help='GDAL engine, gdal or subprocess')
+def benchmark(paths, profiles=None, engine='gdal'):
+    """Compare compression profiles on the test fixtures and PATHS."""
+    results = run_benchmark([FIXTURES] + paths, profiles, ENGINES[engine])
+    for line in format_results(results):
+        print(line)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -88,6 +88,8 @@ def adapter():
 def geoserver(app, adapter):
     _geoserver.public.session.mount('mock://', adapter)
     _geoserver.secure.session.mount('mock://', adapter)
+    _geoserver.public.catalog.invalidate()
+    _geoserver.secure.catalog.invalidate()
     return adapter
 
 
@@ -116,6 +118,24 @@ def bag_tif():
     return _fixture_path('bags/674a0ab1-325f-561a-a837-09e9a9a79b91/')
 
 
+@pytest.fixture
+def corrupt_bag_tif(bag_tif):
+    """A copy of the GeoTIFF bag whose FGDC file fails its checksum."""
+    path = os.path.join(tempfile.mkdtemp(),
+                        os.path.basename(os.path.normpath(bag_tif)))
+    shutil.copytree(bag_tif, path)
+    with io.open(os.path.join(path, 'data/fgdc.xml'), 'ab') as fp:
+        fp.write(b'\n')
+    return path
+
+
+@pytest.fixture
+def corrupt_bag_tif_upload(corrupt_bag_tif):
+    return shutil.make_archive(corrupt_bag_tif, 'zip',
+                               os.path.dirname(corrupt_bag_tif),
+                               os.path.basename(corrupt_bag_tif))
+
+
 @pytest.fixture
 def grayscale_tif():
     return _fixture_path('grayscale.tif')
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from contextlib import closing
+import io
 import tempfile
 import os
+import shutil
+from zipfile import ZipFile
 
 import pytest
 from mock import patch
 
 from kepler.bag import *
 from kepler.bag import _extract_data
-from kepler.exceptions import FileNotFound, InvalidAccessLevel
+from kepler.exceptions import FileNotFound, InvalidAccessLevel, InvalidBag
 
 
 def test_extract_returns_pathname(bag):
@@ -38,6 +42,30 @@ def test_unpacks_bag(bag_upload):
     assert os.path.isfile(os.path.join(tmp, 'bag-info.txt'))
 
 
+def test_unpack_strips_bag_directory(bag_upload):
+    tmp = tempfile.mkdtemp()
+    unpack(bag_upload, tmp)
+    assert os.path.isfile(os.path.join(tmp, 'data/shapefile.zip'))
+    assert not os.path.exists(
+        os.path.join(tmp, 'd2fe4762-96ec-57cd-89c9-312ec097284b'))
+
+
+def test_unpacks_bag_from_file_object(bag_upload):
+    tmp = tempfile.mkdtemp()
+    with io.open(bag_upload, 'rb') as fp:
+        unpack(fp, tmp)
+    assert os.path.isfile(os.path.join(tmp, 'data/fgdc.xml'))
+
+
+def test_unpack_rejects_paths_outside_bag():
+    tmp = tempfile.mkdtemp()
+    archive = io.BytesIO()
+    with closing(ZipFile(archive, 'w')) as zf:
+        zf.writestr('bag/../../evil.txt', b'foo')
+    with pytest.raises(InvalidBag):
+        unpack(archive, tmp)
+
+
 def test_get_datatype_returns_shapefile(bag):
     assert get_datatype(bag) == 'shapefile'
 
@@ -55,3 +83,156 @@ def test_get_access_raises_exception(bag):
         rights.return_value = 'Super Secret'
         with pytest.raises(InvalidAccessLevel):
             get_access(bag)
+
+
+class TestBag(object):
+    def testIndexesMembersRelativeToBag(self, bag_upload):
+        with closing(Bag(bag_upload, tempfile.mkdtemp())) as b:
+            member = b.members['data/shapefile.zip']
+        assert member.size == 63966
+
+    def testReadsMetadataWithoutExtracting(self, bag_upload):
+        tmp = tempfile.mkdtemp()
+        with closing(Bag(bag_upload, tmp)) as b:
+            assert b.access == 'Public'
+            assert b.datatype == 'shapefile'
+            assert b.shapefile_name == 'SDE_DATA_BD_A8GNS_2003'
+        assert os.listdir(tmp) == []
+
+    def testExtractsPayloadOnDemand(self, bag_upload):
+        tmp = tempfile.mkdtemp()
+        with closing(Bag(bag_upload, tmp)) as b:
+            assert b.shapefile == os.path.join(tmp, 'data/shapefile.zip')
+        assert os.listdir(os.path.join(tmp, 'data')) == ['shapefile.zip']
+
+    def testFindRaisesException(self, bag_upload):
+        with closing(Bag(bag_upload, tempfile.mkdtemp())) as b:
+            with pytest.raises(FileNotFound):
+                b.find('.wut')
+
+    def testGeotiffName(self, bag_tif_upload):
+        with closing(Bag(bag_tif_upload, tempfile.mkdtemp())) as b:
+            assert b.datatype == 'geotiff'
+            assert b.geotiff_name == 'grayscale'
+
+    def testGdalPathReadsFromArchive(self, bag_tif_upload):
+        tmp = tempfile.mkdtemp()
+        with closing(Bag(bag_tif_upload, tmp,
+                         gdal_archive=bag_tif_upload)) as b:
+            path = get_geotiff_source(b)
+        assert path == '/vsizip/%s/674a0ab1-325f-561a-a837-09e9a9a79b91/' \
+            'data/grayscale.tif' % bag_tif_upload
+        assert os.listdir(tmp) == []
+
+    def testGdalPathExtractsWithoutArchive(self, bag_tif_upload):
+        tmp = tempfile.mkdtemp()
+        with closing(Bag(bag_tif_upload, tmp)) as b:
+            assert get_geotiff_source(b) == \
+                os.path.join(tmp, 'data/grayscale.tif')
+
+    def testBagFunctionsAcceptBag(self, bag_upload):
+        with closing(Bag(bag_upload, tempfile.mkdtemp())) as b:
+            assert get_shapefile_name(b) == 'SDE_DATA_BD_A8GNS_2003'
+            assert get_access(b) == 'Public'
+
+
+class TestBagIndex(object):
+    def testListsDataDirectoryOnce(self, bag):
+        with patch('kepler.bag.os.listdir', wraps=os.listdir) as m:
+            b = BagIndex(bag)
+            b.fgdc
+            b.shapefile
+            b.datatype
+            b.access
+        assert m.call_count == 1
+
+    def testCachesShapefileName(self, bag):
+        b = BagIndex(bag)
+        with patch('kepler.bag._layer_name', return_value='foo') as m:
+            b.shapefile_name
+            b.shapefile_name
+        assert m.call_count == 1
+
+    def testServesFilesInPlace(self, bag):
+        b = BagIndex(bag)
+        assert b.shapefile == os.path.join(bag, 'data/shapefile.zip')
+
+    def testIndexReturnsExistingBag(self, bag):
+        b = BagIndex(bag)
+        assert index(b) is b
+
+
+def test_checksum_is_the_same_for_zipped_and_unpacked_bag(bag, bag_upload):
+    with closing(Bag(bag_upload, tempfile.mkdtemp())) as b:
+        assert b.checksum == BagIndex(bag).checksum
+
+
+def test_checksum_differs_between_bags(bag, bag_tif):
+    assert BagIndex(bag).checksum != BagIndex(bag_tif).checksum
+
+
+def test_payload_checksum_ignores_metadata(bag):
+    tmp = os.path.join(tempfile.mkdtemp(), 'bag')
+    shutil.copytree(bag, tmp)
+    manifest = os.path.join(tmp, 'manifest-md5.txt')
+    with io.open(manifest, 'r') as fp:
+        lines = [l for l in fp if 'fgdc.xml' not in l]
+    with io.open(manifest, 'w') as fp:
+        fp.write(u''.join(lines) + u'0123456789abcdef  data/fgdc.xml\n')
+    assert BagIndex(tmp).payload_checksum == BagIndex(bag).payload_checksum
+    assert BagIndex(tmp).checksum != BagIndex(bag).checksum
+
+
+def test_payload_checksum_differs_between_bags(bag, bag_tif):
+    assert BagIndex(bag).payload_checksum != \
+        BagIndex(bag_tif).payload_checksum
+
+
+class TestVerify(object):
+    def testReturnsVerifiedDigests(self, bag):
+        digests = BagIndex(bag).verify()
+        assert digests['data/shapefile.zip'] == \
+            'md5:836893d412dc8ebc8358dad0ff654a2e'
+        assert 'manifest-md5.txt' in digests
+
+    def testRaisesOnChecksumMismatch(self, corrupt_bag_tif):
+        with pytest.raises(InvalidBag) as excinfo:
+            BagIndex(corrupt_bag_tif).verify()
+        assert 'data/fgdc.xml does not match md5' in str(excinfo.value)
+
+    def testVerifiesSelectedFiles(self, corrupt_bag_tif):
+        digests = BagIndex(corrupt_bag_tif).verify(
+            files=['data/grayscale.tif'])
+        assert list(digests) == ['data/grayscale.tif']
+
+    def testVerifiesGeotiffBag(self, bag_tif):
+        assert 'data/fgdc.xml' in BagIndex(bag_tif).verify()
+
+    def testRaisesOnMissingFile(self, bag):
+        tmp = os.path.join(tempfile.mkdtemp(), 'bag')
+        shutil.copytree(bag, tmp)
+        os.remove(os.path.join(tmp, 'data/shapefile.zip'))
+        with pytest.raises(InvalidBag):
+            BagIndex(tmp).verify()
+
+    def testVerifiesZippedBag(self, bag_upload):
+        with closing(Bag(bag_upload, tempfile.mkdtemp())) as b:
+            digests = b.verify()
+        assert digests['data/shapefile.zip'] == \
+            'md5:836893d412dc8ebc8358dad0ff654a2e'
+
+    def testVerifiesZippedBagFromFileObject(self, corrupt_bag_tif_upload):
+        with io.open(corrupt_bag_tif_upload, 'rb') as fp:
+            with closing(Bag(fp, tempfile.mkdtemp())) as b:
+                with pytest.raises(InvalidBag):
+                    b.verify()
+
+    def testExtractsWhileVerifying(self, bag_upload):
+        tmp = tempfile.mkdtemp()
+        with closing(Bag(bag_upload, tmp)) as b:
+            b.verify(extract=['data/shapefile.zip'])
+            with patch.object(b, 'open') as m:
+                path = b.shapefile
+        assert not m.called
+        assert os.path.isfile(path)
+        assert os.listdir(os.path.join(tmp, 'data')) == ['shapefile.zip']
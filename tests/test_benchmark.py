@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+
+from mock import patch
+
+from kepler.benchmark import benchmark, format_results, rasters
+
+
+def test_rasters_finds_tiffs_in_directory(rgb_tif):
+    assert rgb_tif in rasters([os.path.dirname(rgb_tif)])
+
+
+def test_benchmark_runs_each_profile(rgb_tif):
+    results = list(benchmark([rgb_tif], ['jpeg', 'deflate']))
+    assert [r.profile for r in results] == ['jpeg', 'deflate']
+    assert all(r.error is None for r in results)
+    assert all(r.size > 0 for r in results)
+
+
+def test_benchmark_reports_errors(rgb_tif):
+    with patch('kepler.benchmark.compress', side_effect=Exception('boom')):
+        results = list(benchmark([rgb_tif], ['jpeg']))
+    assert results[0].error == 'boom'
+
+
+def test_format_results_has_row_per_result(rgb_tif):
+    results = list(benchmark([rgb_tif], ['jpeg', 'lzw']))
+    assert len(format_results(results)) == 3
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 from contextlib import closing
+import io
+import os
+import shutil
 
 from mock import patch
+from osgeo import gdal, osr
+import pytest
 
 from kepler.geo import *
 
@@ -25,6 +30,41 @@ class TestRaster(object):
             assert ds.height == 300
 
 
+class TestDescribe(object):
+    def testDescribeSummarizesRaster(self, rgb_tif):
+        info = describe(rgb_tif)
+        assert info.bands == 3
+        assert info.rgb
+        assert info.data_type == 'Byte'
+        assert len(info.geotransform) == 6
+
+    def testDescribeCachesSummary(self, grayscale_tif):
+        info = describe(grayscale_tif)
+        with patch('kepler.geo.Raster') as mock:
+            assert describe(grayscale_tif) is info
+        assert not mock.called
+
+    def testDescribeRereadsChangedFile(self, grayscale_tif, tmpdir):
+        path = str(tmpdir.join('gray.tif'))
+        shutil.copy(grayscale_tif, path)
+        info = describe(path)
+        os.utime(path, (1, 1))
+        assert describe(path) is not info
+        assert describe(path) == info
+
+    def testDescribeDoesNotCacheVirtualPath(self, grayscale_tif):
+        path = '/vsimem/gray.tif'
+        with io.open(grayscale_tif, 'rb') as fp:
+            gdal.FileFromMemBuffer(path, fp.read())
+        try:
+            describe(path)
+            with patch('kepler.geo.Raster') as mock:
+                describe(path)
+            assert mock.called
+        finally:
+            gdal.Unlink(path)
+
+
 class TestProcessing(object):
     @patch('kepler.geo.check_output')
     def testCompressRunsCommandWithArgs(self, sub_mock, paletted_tif):
@@ -70,3 +110,351 @@ class TestProcessing(object):
 
     def testComputeLevelsReturnsEmptyListForNoLevels(self):
         assert compute_levels(2048, 2048) == []
+
+
+class TestEngines(object):
+    def testGetEngineReturnsEngine(self):
+        assert isinstance(get_engine('gdal'), GDALEngine)
+        assert isinstance(get_engine('subprocess'), SubprocessEngine)
+
+    def testGetEngineRaisesForUnknownEngine(self):
+        with pytest.raises(ValueError):
+            get_engine('foobar')
+
+    @patch('kepler.geo.check_output')
+    def testSubprocessEngineSetsConfigOptions(self, sub_mock, grayscale_tif):
+        engine = SubprocessEngine(config={'GDAL_CACHEMAX': 512})
+        compress(grayscale_tif, 'out.tif', engine)
+        assert sub_mock.call_args[0][0][:4] == \
+            ['gdal_translate', '--config', 'GDAL_CACHEMAX', '512']
+
+    @patch('kepler.geo.translate')
+    def testGdalEngineExpandsPalettedTiff(self, trans_mock, paletted_tif):
+        compress(paletted_tif, 'out.tif', GDALEngine())
+        args, kwargs = trans_mock.call_args
+        assert args[1:] == ('out.tif',
+                            ['TILED=YES', 'COMPRESS=JPEG', 'BLOCKXSIZE=2048',
+                             'BLOCKYSIZE=2048', 'PHOTOMETRIC=YCBCR'])
+        assert kwargs['expand']
+
+    @patch('kepler.geo.compute_levels', return_value=[2, 4, 8])
+    @patch('kepler.geo.build_overviews')
+    def testGdalEnginePyramidsWithLevels(self, ovr_mock, comp_mock, rgb_tif):
+        pyramid(rgb_tif, GDALEngine())
+        assert ovr_mock.call_args[0][1] == [2, 4, 8]
+
+    def testGdalEngineCompressesTiff(self, rgb_tif, tmpdir):
+        out = str(tmpdir.join('out.tif'))
+        compress(rgb_tif, out, GDALEngine())
+        with closing(Raster(out)) as ds:
+            assert ds.ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'] == \
+                'YCbCr JPEG'
+
+    def testGdalEngineWritesRgbForPalettedTiff(self, paletted_tif, tmpdir):
+        out = str(tmpdir.join('out.tif'))
+        compress(paletted_tif, out, GDALEngine())
+        with closing(Raster(out)) as ds:
+            assert ds.ds.RasterCount == 3
+
+    def testGdalEngineReportsProgress(self, rgb_tif, tmpdir):
+        progress = []
+        engine = GDALEngine(callback=lambda c, m, d: progress.append(c) or 1)
+        compress(rgb_tif, str(tmpdir.join('out.tif')), engine)
+        assert progress[-1] == 1
+
+    def testConfigOptionsRestoresOptions(self):
+        gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'NO')
+        with config_options({'GDAL_TIFF_INTERNAL_MASK': 'YES'}):
+            assert gdal.GetConfigOption('GDAL_TIFF_INTERNAL_MASK') == 'YES'
+        assert gdal.GetConfigOption('GDAL_TIFF_INTERNAL_MASK') == 'NO'
+        gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', None)
+
+    def testConfigOptionsSetsCacheMaxEveryTime(self):
+        previous = gdal.GetCacheMax()
+        for size in (64, 128):
+            with config_options({'GDAL_CACHEMAX': size}):
+                assert gdal.GetCacheMax() == size * MB
+            assert gdal.GetCacheMax() == previous
+
+
+class TestCog(object):
+    @patch('kepler.geo.compute_levels', return_value=[2, 4])
+    @patch('kepler.geo.check_output')
+    def testSubprocessCogCopiesOverviews(self, sub_mock, comp_mock, rgb_tif):
+        cog(rgb_tif, 'out.tif')
+        commands = [c[0][0] for c in sub_mock.call_args_list]
+        assert commands[0] == ['gdal_translate', '-of', 'VRT', rgb_tif,
+                               'out.tif.vrt']
+        assert commands[1] == ['gdaladdo',
+                               '--config', 'COMPRESS_OVERVIEW', 'JPEG',
+                               '--config', 'INTERLEAVE_OVERVIEW', 'PIXEL',
+                               '--config', 'PHOTOMETRIC_OVERVIEW', 'YCBCR',
+                               '-ro', '-r', 'average', 'out.tif.vrt', 2, 4]
+        assert commands[2][-3:] == ['COPY_SRC_OVERVIEWS=YES', 'out.tif.vrt',
+                                    'out.tif']
+
+    def testOverviewConfigMatchesCreationOptions(self):
+        assert overview_config(['TILED=YES', 'COMPRESS=DEFLATE',
+                                'PREDICTOR=2']) == {
+            'COMPRESS_OVERVIEW': 'DEFLATE',
+            'PREDICTOR_OVERVIEW': '2',
+            'INTERLEAVE_OVERVIEW': 'PIXEL'}
+
+    def testCogOptionsConvertsCreationOptions(self):
+        assert cog_options(['TILED=YES', 'COMPRESS=JPEG', 'BLOCKXSIZE=512',
+                            'BLOCKYSIZE=512', 'PHOTOMETRIC=YCBCR']) == \
+            ['OVERVIEWS=AUTO', 'RESAMPLING=AVERAGE', 'COMPRESS=JPEG',
+             'BLOCKSIZE=512']
+
+    def testGdalEngineWritesCogWithInternalOverviews(self, tmpdir):
+        src = str(tmpdir.join('big.tif'))
+        ds = gdal.GetDriverByName('GTiff').Create(src, 4100, 10, 3)
+        ds = None
+        out = str(tmpdir.join('out.tif'))
+        cog(src, out, GDALEngine())
+        with closing(Raster(out)) as ds:
+            assert ds.ds.GetRasterBand(1).GetOverviewCount() == 2
+        assert not os.path.exists(out + '.vrt.ovr')
+
+    def testGdalEngineEmbedsStatisticsInCog(self, grayscale_tif, tmpdir):
+        out = str(tmpdir.join('out.tif'))
+        stats = cog(grayscale_tif, out, GDALEngine(),
+                    compute_statistics=True)
+        assert sum(stats[0]['histogram']['counts']) == 600 * 300
+        assert not os.path.exists(out + '.aux.xml')
+        with config_options({'GDAL_PAM_ENABLED': 'NO'}), \
+                closing(Raster(out)) as ds:
+            band = ds.ds.GetRasterBand(1)
+            assert band.GetMetadataItem('STATISTICS_HISTOBINVALUES')
+
+
+class TestThreads(object):
+    @patch('kepler.geo.gdal_version', return_value=THREADED_OVERVIEWS_VERSION)
+    @patch('kepler.geo.check_output')
+    def testCompressUsesThreads(self, sub_mock, version_mock, rgb_tif):
+        compress(rgb_tif, 'out.tif', SubprocessEngine(threads=4))
+        assert sub_mock.call_args[0][0][-4:] == \
+            ['-co', 'NUM_THREADS=4', rgb_tif, 'out.tif']
+
+    @patch('kepler.geo.gdal_version', return_value=THREADED_OVERVIEWS_VERSION)
+    @patch('kepler.geo.compute_levels', return_value=[2])
+    @patch('kepler.geo.check_output')
+    def testPyramidUsesOverviewThreads(self, sub_mock, comp_mock,
+                                       version_mock, rgb_tif):
+        pyramid(rgb_tif, SubprocessEngine(overview_threads=4))
+        sub_mock.assert_called_once_with(
+            ['gdaladdo', '--config', 'GDAL_NUM_THREADS', '4',
+             '-r', 'average', rgb_tif, 2])
+
+    @patch('kepler.geo.gdal_version', return_value=THREADED_OVERVIEWS_VERSION)
+    @patch('kepler.geo.translate')
+    def testGdalEngineCompressUsesThreads(self, trans_mock, version_mock,
+                                          grayscale_tif):
+        compress(grayscale_tif, 'out.tif', GDALEngine(threads=2))
+        assert trans_mock.call_args[0][2][-1] == 'NUM_THREADS=2'
+
+    @patch('kepler.geo.gdal_version', return_value=1110100)
+    @patch('kepler.geo.compute_levels', return_value=[2])
+    @patch('kepler.geo.check_output')
+    def testOldGdalSkipsThreads(self, sub_mock, comp_mock, version_mock,
+                                rgb_tif):
+        engine = SubprocessEngine(threads=4, overview_threads=4)
+        compress(rgb_tif, 'out.tif', engine)
+        pyramid(rgb_tif, engine)
+        commands = [c[0][0] for c in sub_mock.call_args_list]
+        assert not any('NUM_THREADS=4' in c for c in commands)
+        assert not any('GDAL_NUM_THREADS' in c for c in commands)
+
+    def testGdalVersionIsNumber(self):
+        assert gdal_version() >= 1000000
+
+    def testCpuCountIsPositive(self):
+        assert cpu_count() >= 1
+
+    def testDefaultCachemaxIsAtLeast64MB(self):
+        assert default_cachemax() >= 64
+
+
+class TestProfiles(object):
+    def testComputeLevelsFollowsBlockSize(self):
+        assert compute_levels(2048, 2048, 512) == [2, 4]
+
+    def testGetProfileReturnsNamedProfile(self):
+        assert get_profile('deflate').compress == 'DEFLATE'
+
+    def testGetProfileCreatesProfileFromDict(self):
+        assert get_profile({'compress': 'lzw', 'blocksize': 256}) == \
+            Profile('LZW', blocksize=256)
+
+    def testGetProfileRaisesForUnknownProfile(self):
+        with pytest.raises(ValueError):
+            get_profile('foobar')
+
+    def testDeflateKeepsPaletteAndUsesPredictor(self, paletted_tif):
+        with closing(Raster(paletted_tif)) as ds:
+            options, expand, color = compress_options(ds, 'deflate')
+        assert options == ['TILED=YES', 'COMPRESS=DEFLATE', 'BLOCKXSIZE=512',
+                           'BLOCKYSIZE=512', 'PREDICTOR=2']
+        assert not expand
+        assert color == []
+
+    def testJpegQuality(self, rgb_tif):
+        with closing(Raster(rgb_tif)) as ds:
+            options, expand, color = compress_options(ds, 'jpeg-q90')
+        assert 'JPEG_QUALITY=90' in options
+        assert color == ['PHOTOMETRIC=YCBCR']
+
+    def testWebpFallsBackToDeflateForGrayscale(self, grayscale_tif):
+        with closing(Raster(grayscale_tif)) as ds:
+            options, expand, color = compress_options(ds, 'webp')
+        assert 'COMPRESS=DEFLATE' in options
+
+    @patch('kepler.geo.check_output')
+    def testPyramidUsesProfileBlockSize(self, sub_mock, grayscale_tif):
+        pyramid(grayscale_tif, SubprocessEngine(profile='jpeg-512'))
+        assert sub_mock.call_args[0][0][-1:] == [2]
+
+
+class TestWindowed(object):
+    def testWindowsSpanTileRowsThatFit(self):
+        assert windows(1000, 1000, 256, 1, 256 * 256 * 8) == \
+            [(0, 0, 1000, 512), (0, 512, 1000, 488)]
+
+    def testWindowsSplitWideRows(self):
+        assert windows(1000, 300, 256, 1, 256 * 256 * 2) == \
+            [(0, 0, 512, 256), (512, 0, 488, 256),
+             (0, 256, 512, 44), (512, 256, 488, 44)]
+
+    def testWindowsHaveAtLeastOneTile(self):
+        assert windows(300, 300, 256, 3, 1)[0] == (0, 0, 256, 256)
+
+    def testMemoryBudgetLimitsCache(self):
+        engine = Engine(config={'GDAL_CACHEMAX': 1024},
+                        memory_budget=512 * 1024 * 1024)
+        assert engine.config['GDAL_CACHEMAX'] == 256
+
+    def testGdalEngineCopiesWindowed(self, rgb_tif, tmpdir):
+        out = str(tmpdir.join('out.tif'))
+        engine = GDALEngine(profile=Profile('DEFLATE', blocksize=16),
+                            memory_budget=16 * 16 * 3 * 4)
+        compress(rgb_tif, out, engine)
+        with closing(Raster(rgb_tif)) as src, closing(Raster(out)) as dest:
+            for a, b in zip(src.bands(), dest.bands()):
+                assert a.Checksum() == b.Checksum()
+            assert dest.ds.GetGeoTransform() == src.ds.GetGeoTransform()
+
+
+class TestStatistics(object):
+    def testStatisticsCountsEveryPixel(self, grayscale_tif, tmpdir):
+        tif = str(tmpdir.join('gray.tif'))
+        shutil.copy(grayscale_tif, tif)
+        stats = statistics(tif)
+        assert len(stats) == 1
+        assert sum(stats[0]['histogram']['counts']) == 600 * 300
+        assert stats[0]['min'] <= stats[0]['mean'] <= stats[0]['max']
+
+    def testStatisticsMatchGdal(self, grayscale_tif, tmpdir):
+        tif = str(tmpdir.join('gray.tif'))
+        shutil.copy(grayscale_tif, tif)
+        stats = statistics(tif)[0]
+        with closing(Raster(grayscale_tif)) as ds:
+            expected = ds.ds.GetRasterBand(1).ComputeStatistics(False)
+        assert [stats['min'], stats['max']] == expected[:2]
+        assert stats['mean'] == pytest.approx(expected[2])
+
+    def testStatisticsWritesSidecar(self, grayscale_tif, tmpdir):
+        tif = str(tmpdir.join('gray.tif'))
+        shutil.copy(grayscale_tif, tif)
+        statistics(tif)
+        assert os.path.isfile(tif + '.aux.xml')
+        with closing(Raster(tif)) as ds:
+            band = ds.ds.GetRasterBand(1)
+            assert band.GetMetadataItem('STATISTICS_MEAN') is not None
+            assert band.GetDefaultHistogram(force=False) is not None
+
+    def testStatisticsUpdateWritesInternalMetadata(self, grayscale_tif,
+                                                   tmpdir):
+        tif = str(tmpdir.join('gray.tif'))
+        shutil.copy(grayscale_tif, tif)
+        stats = statistics(tif, update=True)[0]
+        assert not os.path.exists(tif + '.aux.xml')
+        with config_options({'GDAL_PAM_ENABLED': 'NO'}), \
+                closing(Raster(tif)) as ds:
+            band = ds.ds.GetRasterBand(1)
+            assert float(band.GetMetadataItem('STATISTICS_MEAN')) == \
+                pytest.approx(stats['mean'])
+            counts = band.GetMetadataItem('STATISTICS_HISTOBINVALUES')
+            assert [int(c) for c in counts.split('|')[:-1]] == \
+                stats['histogram']['counts']
+
+    def testStatisticsIgnoresNodata(self, tmpdir):
+        tif = str(tmpdir.join('nodata.tif'))
+        ds = gdal.GetDriverByName('GTiff').Create(tif, 10, 10, 1,
+                                                  gdal.GDT_Float32)
+        band = ds.GetRasterBand(1)
+        band.Fill(5)
+        band.SetNoDataValue(0)
+        band.WriteRaster(0, 0, 10, 1, b'\0' * 40)
+        ds = None
+        stats = statistics(tif)[0]
+        assert sum(stats['histogram']['counts']) == 90
+        assert stats['min'] == stats['max'] == 5
+
+
+class TestBounds(object):
+    def testRasterBoundsUsesGeotransform(self, grayscale_tif):
+        assert raster_bounds(grayscale_tif) == \
+            pytest.approx((-80, -60, 45, 35))
+
+    def testRasterBoundsReprojectsEdges(self, tmpdir):
+        tif = str(tmpdir.join('utm.tif'))
+        ds = gdal.GetDriverByName('GTiff').Create(tif, 100, 100)
+        ds.SetGeoTransform((500000, 1000, 0, 5000000, 0, -1000))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32619)
+        ds.SetProjection(srs.ExportToWkt())
+        ds = None
+        w, e, n, s = raster_bounds(tif)
+        assert -69 < w < e < -67
+        assert 44 < s < n < 46
+
+    def testRasterBoundsIsNoneWithoutProjection(self, tmpdir):
+        tif = str(tmpdir.join('plain.tif'))
+        gdal.GetDriverByName('GTiff').Create(tif, 10, 10)
+        assert raster_bounds(tif) is None
+
+    def testShapefileBoundsUsesLayerExtent(self, shapefile):
+        assert shapefile_bounds(shapefile) == \
+            pytest.approx((-64.908, -64.617, 32.417, 32.233), abs=0.01)
+
+
+class TestVirtualFiles(object):
+    def testVsizipPath(self):
+        assert vsizip('/tmp/bag.zip', 'bag/data/a.tif') == \
+            '/vsizip//tmp/bag.zip/bag/data/a.tif'
+
+    def testVsis3Path(self):
+        assert vsis3('bucket', 'bag.zip') == '/vsis3/bucket/bag.zip'
+
+    def testMemoryFileIsRemoved(self, grayscale_tif):
+        with io.open(grayscale_tif, 'rb') as fp:
+            data = fp.read()
+        with memory_file('gray.tif', data) as path:
+            assert read_file(path) == data
+            statistics(path)
+        assert not gdal.ReadDir(os.path.dirname(path))
+
+    def testGdalEngineCompressesInMemory(self, grayscale_tif):
+        with memory_file('out.tif') as out:
+            compress(grayscale_tif, out, GDALEngine())
+            pyramid(out, GDALEngine())
+            with closing(Raster(out)) as ds:
+                assert ds.width == 600
+
+    def testCompressesFromZip(self, bag_tif_upload, tmpdir):
+        src = vsizip(bag_tif_upload, '674a0ab1-325f-561a-a837-09e9a9a79b91/'
+                                     'data/grayscale.tif')
+        out = str(tmpdir.join('out.tif'))
+        compress(src, out, GDALEngine())
+        with closing(Raster(out)) as ds:
+            assert ds.width == 600
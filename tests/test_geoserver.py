@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import io
+import re
 
+from mock import patch
 import pytest
+import redis
 import requests
 import requests_mock
 
-from kepler.geoserver import GeoService
+from kepler.geoserver import GeoService, MultipartFile
+from kepler.settings import TestConfig
 
 
 @pytest.fixture
@@ -15,8 +20,110 @@ def session(adapter):
     return s
 
 
+@pytest.yield_fixture
+def connection():
+    conn = redis.from_url(TestConfig.REDISTOGO_URL)
+    conn.delete('kepler:catalog:mock://example.com/geoserver:mit:data:'
+                'shapefile')
+    yield conn
+    conn.delete('kepler:catalog:mock://example.com/geoserver:mit:data:'
+                'shapefile')
+
+
 def test_put_uploads_data(session, bag_upload):
     geoserver = GeoService(session, 'mock://example.com/geoserver', 'mit', 'data')
     geoserver.put(bag_upload, 'shapefile', 'test')
     a = session.get_adapter('mock://example.com')
     assert a.call_count == 4
+
+
+def test_put_streams_data(session, bag_upload):
+    geoserver = GeoService(session, 'mock://example.com/geoserver', 'mit', 'data')
+    geoserver.put(bag_upload, 'shapefile', 'test')
+    a = session.get_adapter('mock://example.com')
+    upload = [r for r in a.request_history if r.url.endswith('/tasks')][0]
+    assert isinstance(upload.body, MultipartFile)
+    assert upload.headers['Content-Length'] == str(len(upload.body))
+    assert upload.headers['Content-Type'].startswith('multipart/form-data')
+
+
+def test_multipart_file_encodes_file():
+    body = MultipartFile('filedata', 'a.tif', io.BytesIO(b'foobar'),
+                         boundary='xyz')
+    expected = (b'--xyz\r\nContent-Disposition: form-data; '
+                b'name="filedata"; filename="a.tif"\r\n'
+                b'Content-Type: application/octet-stream\r\n\r\n'
+                b'foobar\r\n--xyz--\r\n')
+    assert len(body) == len(expected)
+    assert body.read() == expected
+
+
+def test_multipart_file_reads_in_chunks():
+    body = MultipartFile('filedata', 'a.tif', io.BytesIO(b'x' * 1000))
+    chunks = list(iter(lambda: body.read(7), b''))
+    assert all(len(c) == 7 for c in chunks[:-1])
+    assert sum(len(c) for c in chunks) == len(body)
+
+
+def test_put_checks_catalog_once(session, adapter, bag_upload):
+    geoserver = GeoService(session, 'mock://example.com/geoserver', 'mit', 'data')
+    geoserver.put(bag_upload, 'shapefile', 'test')
+    geoserver.put(bag_upload, 'shapefile', 'test2')
+    a = session.get_adapter('mock://example.com')
+    assert a.call_count == 7
+
+
+def test_put_replaces_published_layer(session, adapter, bag_upload):
+    adapter.register_uri('POST', '/geoserver/rest/imports/0/tasks',
+        headers={'Location':
+                 'mock://example.com/geoserver/rest/imports/0/tasks/0'})
+    adapter.register_uri('PUT', re.compile('/tasks/'))
+    geoserver = GeoService(session, 'mock://example.com/geoserver', 'mit', 'data')
+    geoserver.put(bag_upload, 'shapefile', 'test')
+    geoserver.put(bag_upload, 'shapefile', 'test')
+    puts = [r for r in adapter.request_history if r.method == 'PUT']
+    assert len(puts) == 1
+
+
+def test_catalog_lists_coverages(session, adapter):
+    adapter.register_uri('GET', '/geoserver/rest/workspaces/mit/'
+                         'coverages.json',
+                         json={'coverages': {'coverage': [{'name': 'a'}]}})
+    geoserver = GeoService(session, 'mock://example.com/geoserver', 'mit', 'data')
+    assert geoserver.catalog.exists('a', 'geotiff')
+    assert not geoserver.catalog.exists('b', 'geotiff')
+    assert adapter.call_count == 1
+
+
+def test_catalog_refreshes_after_ttl(session, adapter):
+    geoserver = GeoService(session, 'mock://example.com/geoserver', 'mit',
+                           'data', catalog_ttl=60)
+    with patch('kepler.geoserver.time.time') as t:
+        t.return_value = 1000
+        geoserver.catalog.exists('a', 'shapefile')
+        t.return_value = 1030
+        geoserver.catalog.exists('a', 'shapefile')
+        assert adapter.call_count == 1
+        t.return_value = 1061
+        geoserver.catalog.exists('a', 'shapefile')
+        assert adapter.call_count == 2
+
+
+def test_catalog_is_shared_between_jobs(session, adapter, bag_upload,
+                                        connection):
+    adapter.register_uri('POST', '/geoserver/rest/imports/0/tasks',
+        headers={'Location':
+                 'mock://example.com/geoserver/rest/imports/0/tasks/0'})
+    adapter.register_uri('PUT', re.compile('/tasks/'))
+    # Each job has a GeoService of its own, in the process RQ forks for it
+    for name in ('test', 'test2', 'test'):
+        geoserver = GeoService(session, 'mock://example.com/geoserver',
+                               'mit', 'data', connection=connection)
+        geoserver.put(bag_upload, 'shapefile', name)
+    listings = [r for r in adapter.request_history
+                if r.url.endswith('/featuretypes.json')]
+    puts = [r for r in adapter.request_history if r.method == 'PUT']
+    assert len(listings) == 1
+    assert len(puts) == 1
+    assert 0 < connection.ttl('kepler:catalog:mock://example.com/geoserver:'
+                              'mit:data:shapefile') <= 300
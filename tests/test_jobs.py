@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-import filecmp
+from contextlib import closing
+import os
+import tempfile
 import uuid
 
-from mock import patch
+from mock import patch, DEFAULT
 import pytest
 
+from kepler import scratch
+from kepler.bag import Bag, BagIndex
 from kepler.models import Job, Item
-from kepler.jobs import create_job, fetch_bag, run_job, delete_bag
+from kepler.prefetch import prefetch_bag
+from kepler.jobs import (create_job, run_job, delete_bag,
+                         job_stages, gdal_archive, verify_bag, detach_job,
+                         merge_job)
+from kepler.utils import as_utc, utcnow
 
 
 pytestmark = pytest.mark.usefixtures('db')
@@ -39,12 +47,6 @@ class TestJobFactory(object):
         assert Job.query.first().status == 'CREATED'
 
 
-def test_fetch_bag_returns_file_name(s3, bag_upload):
-    s3.client.upload_file(bag_upload, 'test_bucket', 'test_bag')
-    fname = fetch_bag('test_bucket', 'test_bag')
-    assert filecmp.cmp(fname, bag_upload)
-
-
 def test_run_job_sets_status_to_pending(s3, job, bag_upload, pysolr,
                                         geoserver):
     s3.client.upload_file(bag_upload, 'test_bucket',
@@ -94,3 +96,222 @@ def test_delete_bag_deletes_bag(s3, bag_upload):
     delete_bag('test_bucket', 'test_bag')
     keys = s3.client.list_objects_v2(Bucket='test_bucket')
     assert 'Contents' not in keys
+
+
+def test_job_stages_overlap_geotiff_upload_and_deposit():
+    stages = dict((s.name, s) for s in job_stages('geotiff'))
+    assert stages['upload'].requires == ()
+    assert stages['dspace'].requires == ()
+    assert set(stages['index'].requires) == set(['upload', 'tiff_url'])
+
+
+def test_run_job_checkpoints_completed_stages(s3, job, bag_upload, pysolr,
+                                              geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    with patch('kepler.jobs.index_shapefile') as m:
+        m.side_effect = Exception()
+        run_job(job.id)
+    checkpoint = job.item.load_checkpoint()
+    assert checkpoint['stages'] == ['upload']
+    assert checkpoint['import_url'] == \
+        'mock://example.com/geoserver/rest/imports/0'
+
+
+def test_run_job_runs_stages_on_detached_jobs(s3, db, job, bag_upload,
+                                             pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    with patch('kepler.jobs.index_shapefile') as m:
+        run_job(job.id)
+    copy = m.call_args[0][0]
+    assert copy is not job
+    assert copy not in db.session
+
+
+def test_run_job_commits_each_stage(s3, job, bag_upload, pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    commits = []
+    with patch('kepler.jobs.db') as m:
+        m.session.commit.side_effect = lambda: commits.append(
+            (job.import_url, job.item.load_checkpoint().get('stages')))
+        run_job(job.id)
+    assert commits[0] == ('mock://example.com/geoserver/rest/imports/0',
+                          ['upload'])
+    assert commits[1][1] == ['upload', 'index']
+
+
+def test_merge_job_applies_changed_columns(job):
+    copy = detach_job(job)
+    job.item.handle = u'http://hdl.handle.net/1721.1/1'
+    copy.import_url = 'mock://example.com/imports/1'
+    merge_job(job, copy)
+    assert job.import_url == 'mock://example.com/imports/1'
+    assert job.item.handle == u'http://hdl.handle.net/1721.1/1'
+
+
+def test_run_job_resumes_from_checkpoint(s3, job, bag, bag_upload, pysolr,
+                                         geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.item.save_checkpoint(stage='upload', bag=BagIndex(bag).checksum,
+                             import_url='mock://example.com/imports/1')
+    with patch('kepler.jobs.upload_shapefile') as m:
+        run_job(job.id)
+    assert not m.called
+    assert job.import_url == 'mock://example.com/imports/1'
+    assert job.status == 'PENDING'
+
+
+def test_run_job_keeps_payload_stages_for_new_metadata(s3, job, bag,
+                                                       bag_upload, pysolr,
+                                                       geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.item.save_checkpoint(stage='upload', bag='older metadata',
+                             payload=BagIndex(bag).payload_checksum,
+                             import_url='mock://example.com/imports/1')
+    job.item.save_checkpoint(stage='index')
+    with patch.multiple('kepler.jobs', upload_shapefile=DEFAULT,
+                        index_shapefile=DEFAULT) as mocks:
+        run_job(job.id)
+    assert not mocks['upload_shapefile'].called
+    assert mocks['index_shapefile'].called
+    assert job.import_url == 'mock://example.com/imports/1'
+
+
+def test_run_job_ignores_checkpoint_for_other_bag(s3, job, bag_upload, pysolr,
+                                                  geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.item.save_checkpoint(stage='upload', bag='not the same bag')
+    with patch('kepler.jobs.upload_shapefile') as m:
+        run_job(job.id)
+    assert m.called
+
+
+def test_run_job_clears_checkpoint_on_success(s3, job, bag_upload, pysolr,
+                                              geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    run_job(job.id)
+    assert job.item.checkpoint is None
+
+
+def test_run_job_skips_upload_for_unchanged_payload(s3, job, bag, bag_upload,
+                                                    pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.item.payload_checksum = BagIndex(bag).payload_checksum
+    with patch('kepler.jobs.upload_shapefile') as m:
+        run_job(job.id)
+    assert not m.called
+    assert job.status == 'COMPLETED'
+    assert job.next_poll is None
+
+
+def test_run_job_uploads_changed_payload(s3, job, bag_upload, pysolr,
+                                         geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.item.payload_checksum = u'0123456789abcdef'
+    with patch('kepler.jobs.upload_shapefile') as m:
+        run_job(job.id)
+    assert m.called
+    assert job.status == 'PENDING'
+
+
+def test_run_job_uploads_payload_when_access_changes(s3, job, bag, bag_upload,
+                                                     pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.item.payload_checksum = BagIndex(bag).payload_checksum
+    job.item.access = u'Restricted'
+    with patch('kepler.jobs.upload_shapefile') as m:
+        run_job(job.id)
+    assert m.called
+
+
+def test_run_job_fails_invalid_bag_before_processing(s3, job,
+                                                     corrupt_bag_tif_upload,
+                                                     pysolr, geoserver):
+    s3.client.upload_file(corrupt_bag_tif_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    with patch('kepler.jobs.upload_geotiff') as m:
+        run_job(job.id)
+    assert not m.called
+    assert job.status == 'FAILED'
+    assert 'InvalidBag' in job.error_msg
+
+
+def test_run_job_defers_job_without_scratch_space(s3, job, bag_upload,
+                                                  pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    with patch('kepler.scratch.free_space') as m, \
+            patch('kepler.jobs.req') as r:
+        m.return_value = 0
+        run_job(job.id)
+    assert job.status == 'CREATED'
+    assert job.deferrals == 1
+    assert as_utc(job.next_poll) > utcnow()
+    assert not r.q.enqueue.called
+    keys = s3.client.list_objects_v2(Bucket='test_bucket')
+    assert keys['KeyCount'] == 1
+
+
+def test_run_job_fails_job_deferred_too_often(app, s3, job, bag_upload,
+                                              pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    job.deferrals = app.config['SCRATCH_MAX_DEFERRALS']
+    with patch('kepler.scratch.free_space') as m:
+        m.return_value = 0
+        run_job(job.id)
+    assert job.status == 'FAILED'
+    assert 'scratch space' in job.error_msg
+
+
+def test_run_job_keeps_scratch_files_in_job_directory(s3, job, bag_upload,
+                                                      pysolr, geoserver):
+    s3.client.upload_file(bag_upload, 'test_bucket',
+                          'd2fe4762-96ec-57cd-89c9-312ec097284b')
+    dirs = []
+
+    def upload(job, data):
+        dirs.append((scratch.mkdtemp(), data.workdir))
+
+    with patch('kepler.jobs.upload_shapefile', upload):
+        run_job(job.id)
+    workdir, bag_dir = dirs[0]
+    assert os.path.dirname(workdir) == bag_dir
+
+
+def test_run_job_uses_prefetched_bag(s3, job, bag_upload, pysolr, geoserver):
+    key = 'd2fe4762-96ec-57cd-89c9-312ec097284b'
+    s3.client.upload_file(bag_upload, 'test_bucket', key)
+    path = prefetch_bag('test_bucket', key)
+    with patch('kepler.jobs.open_object') as m:
+        run_job(job.id)
+    assert not m.called
+    assert job.status == 'PENDING'
+    assert not os.path.exists(path)
+
+
+def test_verify_bag_leaves_geotiff_for_gdal(bag_tif_upload):
+    tmp = tempfile.mkdtemp()
+    with closing(Bag(bag_tif_upload, tmp,
+                     gdal_archive=bag_tif_upload)) as bag:
+        verify_bag(bag)
+    assert os.listdir(os.path.join(tmp, 'data')) == ['fgdc.xml']
+
+
+def test_gdal_archive_is_none_by_default():
+    assert gdal_archive('test_bucket', 'foo') is None
+
+
+def test_gdal_archive_uses_prefetched_bag(app):
+    app.config['GEOTIFF_VSI'] = True
+    assert gdal_archive('test_bucket', 'foo', 'bag.zip') == \
+        os.path.abspath('bag.zip')
@@ -105,3 +105,22 @@ class TestItem(object):
         Job(item=item, status='COMPLETED')
         db.session.add(item)
         assert item.as_dict() == {'uri': 'stuff', 'status': 'COMPLETED'}
+
+    def test_item_checkpoint_defaults_to_empty(self, db):
+        item = Item(uri=u'foo')
+        assert item.load_checkpoint() == {}
+
+    def test_item_saves_completed_stages(self, db):
+        item = Item(uri=u'foo')
+        item.save_checkpoint(stage='upload', import_url='mock://imports/0')
+        item.save_checkpoint(stage='upload')
+        item.save_checkpoint(stage='index')
+        checkpoint = item.load_checkpoint()
+        assert checkpoint['stages'] == ['upload', 'index']
+        assert checkpoint['import_url'] == 'mock://imports/0'
+
+    def test_item_clears_checkpoint(self, db):
+        item = Item(uri=u'foo')
+        item.save_checkpoint(stage='upload')
+        item.clear_checkpoint()
+        assert item.load_checkpoint() == {}
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import threading
+
+import pytest
+
+from kepler.pipeline import Stage, run_stages, check_stages
+
+
+pytestmark = pytest.mark.usefixtures('app')
+
+
+def _task(calls):
+    def task(job, data):
+        calls.append(job)
+    return task
+
+
+def _fail(job, data):
+    raise Exception('Stage failed')
+
+
+def test_run_stages_respects_dependencies():
+    calls = []
+    stages = [Stage('b', _task(calls), requires=['a']),
+              Stage('a', _task(calls)), ]
+    finished = run_stages(stages, 'job', 'data')
+    assert finished == ['a', 'b']
+
+
+def test_run_stages_runs_independent_stages_concurrently():
+    event = threading.Event()
+
+    def waiter(job, data):
+        assert event.wait(5)
+
+    def setter(job, data):
+        event.set()
+
+    stages = [Stage('a', waiter), Stage('b', setter), ]
+    assert sorted(run_stages(stages, 'job', 'data', 2)) == ['a', 'b']
+
+
+def test_run_stages_passes_job_and_data():
+    calls = []
+
+    def task(job, data):
+        calls.append((job, data))
+
+    run_stages([Stage('a', task)], 'job', 'data')
+    assert calls == [('job', 'data')]
+
+
+def test_run_stages_gives_stages_detached_jobs():
+    calls, finished = [], []
+
+    def on_finish(stage, job):
+        finished.append((stage.name, job))
+
+    run_stages([Stage('a', _task(calls))], 'job', 'data',
+               on_finish=on_finish, detach=lambda job: job + ' copy')
+    assert calls == ['job copy']
+    assert finished == [('a', 'job copy')]
+
+
+def test_run_stages_skips_dependents_of_failed_stage():
+    calls = []
+    stages = [Stage('a', _fail), Stage('b', _task(calls), requires=['a']), ]
+    with pytest.raises(Exception) as excinfo:
+        run_stages(stages, 'job', 'data')
+    assert 'Stage failed' in str(excinfo.value)
+    assert calls == []
+
+
+def test_check_stages_raises_on_unknown_dependency():
+    with pytest.raises(ValueError):
+        check_stages([Stage('a', _fail, requires=['b'])])
+
+
+def test_check_stages_raises_on_cycle():
+    with pytest.raises(ValueError):
+        check_stages([Stage('a', _fail, requires=['b']),
+                      Stage('b', _fail, requires=['a'])])
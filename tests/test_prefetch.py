@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import filecmp
+import os
+
+from mock import Mock, patch
+import pytest
+
+from kepler.models import Job, Item
+from kepler.prefetch import (prefetch_bag, prefetched_bag, discard_bag,
+                             next_bag, PrefetchWorker)
+
+
+pytestmark = pytest.mark.usefixtures('db')
+
+
+@pytest.fixture
+def job(db):
+    j = Job(item=Item(uri=u'd2fe4762-96ec-57cd-89c9-312ec097284b'),
+            status=u'CREATED')
+    db.session.add(j)
+    db.session.commit()
+    return j
+
+
+def test_prefetch_bag_downloads_bag(s3, bag_upload):
+    s3.client.upload_file(bag_upload, 'test_bucket', 'test_bag')
+    path = prefetch_bag('test_bucket', 'test_bag')
+    assert filecmp.cmp(path, bag_upload)
+    assert prefetched_bag('test_bag') == path
+
+
+def test_prefetch_bag_skips_bag_without_scratch_space(s3, bag_upload):
+    s3.client.upload_file(bag_upload, 'test_bucket', 'test_bag')
+    with patch('kepler.scratch.free_space') as m:
+        m.return_value = 0
+        assert prefetch_bag('test_bucket', 'test_bag') is None
+    assert prefetched_bag('test_bag') is None
+
+
+def test_discard_bag_removes_prefetched_bag(s3, bag_upload):
+    s3.client.upload_file(bag_upload, 'test_bucket', 'test_bag')
+    path = prefetch_bag('test_bucket', 'test_bag')
+    discard_bag('test_bag')
+    assert not os.path.exists(path)
+
+
+def test_next_bag_returns_key_for_run_job(job):
+    queue = Mock()
+    queue.get_jobs.return_value = [Mock(id='abc',
+                                        func_name='kepler.jobs.run_job',
+                                        args=(job.id,))]
+    assert next_bag(queue) == ('abc', 'd2fe4762-96ec-57cd-89c9-312ec097284b')
+
+
+def test_next_bag_ignores_other_jobs(job):
+    queue = Mock()
+    queue.get_jobs.return_value = [Mock(func_name='kepler.tasks.foo',
+                                        args=(job.id,))]
+    assert next_bag(queue) is None
+
+
+def test_next_bag_handles_empty_queue():
+    queue = Mock()
+    queue.get_jobs.return_value = []
+    assert next_bag(queue) is None
+
+
+def test_prefetch_worker_downloads_in_separate_process(job):
+    worker = PrefetchWorker.__new__(PrefetchWorker)
+    worker._prefetch = None
+    queue = Mock()
+    queue.get_jobs.return_value = [Mock(id='abc',
+                                        func_name='kepler.jobs.run_job',
+                                        args=(job.id,))]
+    with patch('kepler.prefetch.multiprocessing') as m, \
+            patch('kepler.prefetch.db'):
+        worker._start_prefetch(queue)
+    assert m.Process.return_value.start.called
+    assert worker._prefetch[:2] == \
+        ('abc', 'd2fe4762-96ec-57cd-89c9-312ec097284b')
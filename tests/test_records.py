@@ -20,6 +20,16 @@ class TestRecordCreation(object):
         assert record.dc_rights_s == 'Restricted'
         assert record.dct_provenance_s == 'MIT'
 
+    def testCreateRecordKeepsMatchingBoundingBox(self, fgdc):
+        record = create_record(fgdc, FGDCParser,
+                               bbox=(-64.91, -64.6167, 32.4167, 32.2333))
+        assert record.solr_geom == create_record(fgdc, FGDCParser).solr_geom
+
+    def testCreateRecordReplacesWrongBoundingBox(self, fgdc):
+        record = create_record(fgdc, FGDCParser, bbox=(-80, -60, 45, 35))
+        assert record.solr_geom == \
+            MitRecord(solr_geom=(-80, -60, 45, 35)).solr_geom
+
 
 class TestMitRecord(object):
     def testAccessConstraintMapped(self):
@@ -50,6 +60,12 @@ class TestMitRecord(object):
                now.replace(minutes=+1)
 
 
+def testBboxMatchesWithinTolerance():
+    assert bbox_matches((1, 2, 3, 4), (1.005, 2, 3, 3.995))
+    assert not bbox_matches((1, 2, 3, 4), (1, 2, 3, 5))
+    assert not bbox_matches(None, (1, 2, 3, 4))
+
+
 def testRightsMapperNormalizesTerm():
     assert rights_mapper('Unrestricted layer') == 'Public'
     assert rights_mapper('rEsTrIcted layer') == 'Restricted'
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import glob
+import io
+import json
+import os
+import socket
+import subprocess
+import time
+
+from mock import patch
+import pytest
+
+from kepler import scratch
+from kepler.bag import BagIndex
+from kepler.exceptions import InsufficientScratchSpace
+
+
+pytestmark = pytest.mark.usefixtures('app')
+
+
+@pytest.yield_fixture
+def write_reservation():
+    path = os.path.join(scratch.root(), '.reservation-test')
+
+    def write(**kwargs):
+        reservation = {'host': socket.gethostname(), 'time': time.time()}
+        reservation.update(kwargs)
+        with io.open(path, 'w') as fp:
+            fp.write(u'%s' % json.dumps(reservation))
+
+    yield write
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def test_estimate_sums_payload_sizes(bag):
+    index = BagIndex(bag)
+    size = sum(os.path.getsize(os.path.join(bag, n)) for n in index.payload)
+    assert scratch.estimate(index) == size
+
+
+def test_estimate_allows_for_compressed_geotiff(bag_tif):
+    index = BagIndex(bag_tif)
+    size = sum(os.path.getsize(os.path.join(bag_tif, n))
+               for n in index.payload)
+    tiff = os.path.getsize(index.geotiff)
+    assert scratch.estimate(index) == \
+        size + int(tiff * scratch.COMPRESSED_GEOTIFF_RATIO) + tiff
+
+
+def test_reserve_records_reservation():
+    with scratch.reserve(1024):
+        assert scratch.reserved() == 1024
+    assert scratch.reserved() == 0
+
+
+def test_reserve_counts_outstanding_reservations():
+    with patch('kepler.scratch.free_space') as m:
+        m.return_value = 1500
+        with scratch.reserve(1000):
+            with pytest.raises(InsufficientScratchSpace):
+                with scratch.reserve(1000):
+                    pass
+
+
+def test_reserve_leaves_minimum_free(app):
+    app.config['SCRATCH_MIN_FREE'] = 1000
+    with patch('kepler.scratch.free_space') as m:
+        m.return_value = 1500
+        with pytest.raises(InsufficientScratchSpace):
+            with scratch.reserve(1000):
+                pass
+    assert not glob.glob(os.path.join(scratch.root(), '.reservation-*'))
+
+
+def test_reserve_counts_only_unused_space(tmpdir):
+    with scratch.reserve(1000, str(tmpdir)):
+        tmpdir.join('bag.zip').write(b'x' * 400, mode='wb')
+        assert scratch.reserved() == 600
+
+
+def test_reserve_creates_scratch_files_in_job_directory(tmpdir):
+    with scratch.reserve(1000, str(tmpdir)):
+        path = scratch.mkdtemp()
+    assert os.path.dirname(path) == str(tmpdir)
+    assert os.path.dirname(scratch.mkdtemp()) == scratch.root()
+
+
+def test_reserved_removes_reservations_of_dead_workers(write_reservation,
+                                                       tmpdir):
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    write_reservation(size=1000, path=str(tmpdir), pid=proc.pid)
+    assert scratch.reserved() == 0
+    assert not glob.glob(os.path.join(scratch.root(), '.reservation-*'))
+    assert not tmpdir.check()
+
+
+def test_reserved_removes_old_reservations(write_reservation):
+    write_reservation(size=1000, pid=os.getpid(), time=0)
+    assert scratch.reserved() == 0
+
+
+def test_reserved_counts_reservations_of_running_workers(write_reservation):
+    write_reservation(size=1000, pid=os.getpid())
+    assert scratch.reserved() == 1000
+
+
+def test_scratch_dir_is_configurable(app, tmpdir):
+    app.config['SCRATCH_DIR'] = str(tmpdir.join('scratch'))
+    path = scratch.mkdtemp()
+    assert os.path.dirname(path) == str(tmpdir.join('scratch'))
+
+
+def test_usage_monitor_records_stage_peaks():
+    with patch('kepler.scratch.free_space') as m:
+        m.return_value = 1000
+        with scratch.UsageMonitor(interval=60) as usage:
+            usage.start_stage('upload')
+            m.return_value = 400
+            usage.sample()
+            m.return_value = 900
+            usage.finish_stage('upload')
+            usage.start_stage('index')
+            usage.finish_stage('index')
+    assert usage.peak == 600
+    assert usage.peaks == {'upload': 600, 'index': 100}
+
+
+def test_usage_monitor_records_measured_usage():
+    values = iter([100, 300, 200, 200])
+    with scratch.UsageMonitor(interval=60, measure=lambda: next(values)) \
+            as usage:
+        usage.start_stage('index')
+        usage.sample()
+        usage.finish_stage('index')
+    assert usage.peaks == {'index': 300}
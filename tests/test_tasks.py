@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from contextlib import closing
+from datetime import timedelta
 import json
 import os.path
 import re
+import struct
 
 import arrow
 import pytest
 import requests_mock
 from mock import patch, DEFAULT
 
+from kepler.bag import Bag
+from kepler.exceptions import GDALError
 from kepler.models import Job, Item
+from kepler.records import MitRecord
+from kepler.utils import as_utc, utcnow
 from kepler.tasks import *
 from kepler.tasks import (_index_records, _load_marc_records,
                           _prep_solr_record, _upload_to_geoserver,
-                          _fgdc_to_mods)
+                          _fgdc_to_mods, _geo_engine)
 
 
 pytestmark = pytest.mark.usefixtures('app')
@@ -60,6 +67,14 @@ def test_index_shapefile_assigns_layer_id(job, bag):
     assert job.item.layer_id == 'mit:SDE_DATA_BD_A8GNS_2003'
 
 
+def test_index_shapefile_does_not_extract_unchanged_payload(job, bag):
+    job.payload_checksum = job.item.payload_checksum = u'abc123'
+    with patch('kepler.tasks.get_shapefile') as m:
+        index_shapefile(job, bag)
+    assert not m.called
+    assert job.item.record is not None
+
+
 def test_index_geotiff_assigns_layer_id(job, bag_tif):
     index_geotiff(job, bag_tif)
     assert job.item.layer_id == 'mit:grayscale'
@@ -71,6 +86,33 @@ def test_index_geotiff_indexes_from_fgdc(job, bag_tif):
     assert json.loads(job.item.record).get('layer_id_s') == 'mit:grayscale'
 
 
+def test_index_geotiff_uses_bounding_box_of_raster(job, bag_tif):
+    job.item.tiff_url = 'http://example.com/foobar'
+    index_geotiff(job, bag_tif)
+    record = json.loads(job.item.record)
+    expected = MitRecord(solr_geom=(-80.0, -60.0, 45.0, 35.0))
+    assert record['solr_geom'] == expected.solr_geom
+
+
+def test_index_geotiff_does_not_extract_unchanged_payload(job, bag_tif):
+    job.payload_checksum = job.item.payload_checksum = u'abc123'
+    with patch('kepler.tasks.get_geotiff_source') as m:
+        index_geotiff(job, bag_tif)
+    assert not m.called
+    assert job.item.record is not None
+
+
+def test_index_geotiff_reads_bounds_in_place(job, bag_tif_upload, tmpdir):
+    job.payload_checksum = job.item.payload_checksum = u'abc123'
+    with closing(Bag(bag_tif_upload, str(tmpdir),
+                     gdal_archive=bag_tif_upload)) as bag:
+        index_geotiff(job, bag)
+    record = json.loads(job.item.record)
+    expected = MitRecord(solr_geom=(-80.0, -60.0, 45.0, 35.0))
+    assert record['solr_geom'] == expected.solr_geom
+    assert not list(tmpdir.visit('*.tif'))
+
+
 def test_submit_to_dspace_uploads_sword_package(sword, job, bag_tif):
     submit_to_dspace(job, bag_tif)
     req = sword.request_history[0]
@@ -142,6 +184,131 @@ def testUploadGeotiffPyramidsTiff(job, bag_tif, geoserver):
         assert mocks['pyramid'].called
 
 
+def test_upload_geotiff_writes_cog(app, job, bag_tif, geoserver):
+    app.config['COG_OUTPUT'] = True
+    with patch.multiple('kepler.tasks', cog=DEFAULT, compress=DEFAULT,
+                        pyramid=DEFAULT) as mocks:
+        mocks['cog'].return_value = []
+        upload_geotiff(job, bag_tif)
+    assert mocks['cog'].call_count == 1
+    assert not mocks['compress'].called
+    assert not mocks['pyramid'].called
+
+
+def test_upload_geotiff_keeps_compressed_tiff_for_retry(app, job, bag_tif,
+                                                       geoserver, tmpdir):
+    app.config['CHECKPOINT_DIR'] = str(tmpdir)
+    with patch('kepler.tasks._upload_to_geoserver') as m:
+        m.side_effect = Exception()
+        with pytest.raises(Exception):
+            upload_geotiff(job, bag_tif)
+    with patch('kepler.tasks._write_geotiff') as m:
+        upload_geotiff(job, bag_tif)
+    assert not m.called
+    assert job.import_url == 'mock://example.com/geoserver/rest/imports/0'
+    assert tmpdir.listdir() == []
+
+
+def test_upload_geotiff_saves_statistics(job, bag_tif, geoserver):
+    upload_geotiff(job, bag_tif)
+    stats = json.loads(job.item.stats)
+    assert len(stats) == 1
+    assert sum(stats[0]['histogram']['counts']) == 600 * 300
+
+
+def test_upload_geotiff_succeeds_without_statistics(job, bag_tif, geoserver):
+    with patch.multiple('kepler.tasks', compress=DEFAULT, pyramid=DEFAULT):
+        upload_geotiff(job, bag_tif)
+    assert job.item.stats is None
+    assert job.import_url == 'mock://example.com/geoserver/rest/imports/0'
+
+
+def test_upload_geotiff_skips_statistics(app, job, bag_tif, geoserver):
+    app.config['GEOTIFF_STATISTICS'] = False
+    with patch('kepler.tasks.statistics') as mock:
+        upload_geotiff(job, bag_tif)
+    assert not mock.called
+
+
+def test_upload_geotiff_in_memory(app, job, bag_tif, geoserver):
+    app.config['GEOTIFF_MEMORY_THRESHOLD'] = 64 * 1024 * 1024
+    with patch('kepler.tasks._workdir') as m:
+        upload_geotiff(job, bag_tif)
+    assert not m.called
+    assert job.import_url == 'mock://example.com/geoserver/rest/imports/0'
+    assert job.item.stats is not None
+    uploads = [r for r in geoserver.request_history
+               if r.url.endswith('/tasks')]
+    assert b'filename="grayscale.tif"' in uploads[0].body.read()
+
+
+@pytest.mark.parametrize('cog_output', [False, True])
+def test_upload_geotiff_posts_statistics_in_tiff(app, job, bag_tif,
+                                                 geoserver, cog_output):
+    app.config['GEOTIFF_MEMORY_THRESHOLD'] = 64 * 1024 * 1024
+    app.config['COG_OUTPUT'] = cog_output
+    upload_geotiff(job, bag_tif)
+    uploads = [r for r in geoserver.request_history
+               if r.url.endswith('/tasks')]
+    assert b'STATISTICS_HISTOBINVALUES' in uploads[0].body.read()
+    assert json.loads(job.item.stats)[0]['histogram']['counts']
+
+
+def test_upload_geotiff_keeps_cog_directory_first(app, job, bag_tif,
+                                                  geoserver):
+    app.config['GEOTIFF_MEMORY_THRESHOLD'] = 64 * 1024 * 1024
+    app.config['COG_OUTPUT'] = True
+    with patch('kepler.tasks._upload_to_geoserver') as m:
+        m.return_value = 'mock://example.com/geoserver/rest/imports/0'
+        upload_geotiff(job, bag_tif)
+    data = m.call_args[0][0][1].read()
+    assert data[:2] == b'II'
+    ifd = struct.unpack('<I', data[4:8])[0]
+    assert ifd < len(data) // 2
+    assert b'STATISTICS_MEAN' in data[:ifd + 4096]
+
+
+def test_upload_geotiff_writes_cog_without_statistics(app, job, bag_tif,
+                                                      geoserver):
+    app.config['COG_OUTPUT'] = True
+    with patch.multiple('kepler.tasks', cog=DEFAULT,
+                        compress=DEFAULT) as mocks:
+        mocks['cog'].side_effect = [GDALError('Band contains no data'),
+                                    None]
+        upload_geotiff(job, bag_tif)
+    assert mocks['cog'].call_count == 2
+    assert job.item.stats is None
+
+
+def test_upload_geotiff_uses_disk_above_threshold(app, job, bag_tif,
+                                                  geoserver):
+    app.config['GEOTIFF_MEMORY_THRESHOLD'] = 1024
+    with patch('kepler.tasks._upload_in_memory') as m:
+        upload_geotiff(job, bag_tif)
+    assert not m.called
+
+
+def test_requeue_deferred_jobs_requeues_due_jobs(job, db):
+    job.status = 'CREATED'
+    job.deferrals = 1
+    job.next_poll = utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    with patch('kepler.tasks.req') as r:
+        requeue_deferred_jobs()
+    r.q.enqueue.assert_called_once_with('kepler.jobs.run_job', job.id)
+    assert job.next_poll is None
+
+
+def test_requeue_deferred_jobs_waits_for_delay(job, db):
+    job.status = 'CREATED'
+    job.deferrals = 1
+    job.next_poll = utcnow() + timedelta(seconds=60)
+    db.session.commit()
+    with patch('kepler.tasks.req') as r:
+        requeue_deferred_jobs()
+    assert not r.q.enqueue.called
+
+
 def test_resolve_pending_completes_finished_imports(job, db, geo_mock):
     job.import_url = 'mock://example.com/geoserver/rest/imports/0'
     job.status = 'PENDING'
@@ -159,6 +326,14 @@ def test_resolve_pending_skips_unfinished_imports(job, db, geo_mock):
     assert job.status == 'PENDING'
 
 
+def test_resolve_pending_skips_jobs_without_import(job, db, geo_mock):
+    job.status = 'PENDING'
+    db.session.commit()
+    resolve_pending_jobs()
+    assert job.status == 'PENDING'
+    assert not geo_mock.called
+
+
 def test_resolve_pending_resolves_only_last_job_for_item(job, db, geo_mock):
     job.status = 'PENDING'
     job2 = Job(item=job.item, status='PENDING')
@@ -223,6 +398,106 @@ def test_resolve_pending_does_not_delete_pending_jobs(job, db, geo_mock):
     assert geo_mock.request_history.pop().method == 'GET'
 
 
+def test_resolve_pending_resolves_jobs_concurrently(db, geo_mock):
+    jobs = []
+    for i in (0, 1, 3):
+        job = Job(item=Item(uri=u'urn:uuid:%d' % i), status='PENDING',
+                  import_url='mock://example.com/geoserver/rest/imports/%d'
+                  % i)
+        job.item.record = '{"uuid": "foo"}'
+        db.session.add(job)
+        jobs.append(job)
+    db.session.commit()
+    resolve_pending_jobs()
+    assert [j.status for j in jobs] == ['COMPLETED', 'PENDING', 'FAILED']
+    deleted = [r.url for r in geo_mock.request_history
+               if r.method == 'DELETE']
+    assert 'mock://example.com/geoserver/rest/imports/0' in deleted
+    assert 'mock://example.com/geoserver/rest/imports/3' in deleted
+    assert 'mock://example.com/geoserver/rest/imports/1' not in deleted
+
+
+def test_resolve_pending_skips_jobs_not_due(job, db, geo_mock):
+    job.import_url = 'mock://example.com/geoserver/rest/imports/0'
+    job.status = 'PENDING'
+    job.next_poll = utcnow() + timedelta(minutes=5)
+    db.session.commit()
+    resolve_pending_jobs()
+    assert job.status == 'PENDING'
+    assert not geo_mock.called
+
+
+def test_resolve_pending_reschedules_unfinished_imports(job, db, geo_mock):
+    job.import_url = 'mock://example.com/geoserver/rest/imports/1'
+    job.status = 'PENDING'
+    db.session.commit()
+    resolve_pending_jobs()
+    assert job.polls == 1
+    assert as_utc(job.next_poll) > utcnow()
+
+
+def test_schedule_poll_handles_aware_job_time(job):
+    now = utcnow()
+    job.time = now - timedelta(minutes=10)
+    job.polls = 3
+    schedule_poll(job, now)
+    assert job.next_poll == now + timedelta(seconds=80)
+    assert job.next_poll.tzinfo is not None
+
+
+def test_schedule_poll_treats_naive_job_time_as_utc(job):
+    now = utcnow()
+    job.time = now.replace(tzinfo=None) - timedelta(minutes=10)
+    job.polls = 3
+    schedule_poll(job, now)
+    assert job.next_poll == now + timedelta(seconds=80)
+
+
+def test_resolve_pending_handles_errors_per_job(db, geo_mock):
+    jobs = []
+    for i in (1, 3):
+        job = Job(item=Item(uri=u'urn:uuid:%d' % i), status='PENDING',
+                  import_url='mock://example.com/geoserver/rest/imports/%d'
+                  % i)
+        db.session.add(job)
+        jobs.append(job)
+    db.session.commit()
+    with patch('kepler.tasks.schedule_poll', side_effect=ValueError):
+        resolve_pending_jobs()
+    db.session.expire_all()
+    assert jobs[0].polls is None
+    assert jobs[1].status == 'FAILED'
+
+
+def test_resolve_pending_commits_sweep_once(db, geo_mock):
+    for i in (1, 3):
+        db.session.add(Job(item=Item(uri=u'urn:uuid:%d' % i),
+                           status='PENDING',
+                           import_url='mock://example.com/geoserver/rest/'
+                                      'imports/%d' % i))
+    db.session.commit()
+    with patch('kepler.tasks.requeue_deferred_jobs'), \
+            patch.object(db.session, 'commit',
+                         wraps=db.session.commit) as m:
+        resolve_pending_jobs()
+    assert m.call_count == 1
+
+
+def test_poll_delay_backs_off_exponentially(app):
+    assert poll_delay(0, 3600) == 10
+    assert poll_delay(3, 3600) == 80
+    assert poll_delay(10, 36000) == 600
+
+
+def test_poll_delay_is_limited_by_elapsed_time(app):
+    assert poll_delay(5, 60) == 30
+    assert poll_delay(5, 0) == 10
+
+
+def test_poll_delay_waits_for_large_uploads(app):
+    assert poll_delay(0, 0, 200 * 1024 * 1024) == 20
+
+
 def test_publish_record_adds_record_to_solr(db, job):
     job.item.record = '{"layer_id_s": "mit:FOOBARBAZ"}'
     db.session.commit()
@@ -243,6 +518,16 @@ def test_publish_record_sets_status(db, job):
     assert job.status == 'COMPLETED'
 
 
+def test_publish_record_saves_payload_checksum(db, job):
+    job.item.record = '{"uuid": "foobar"}'
+    job.payload_checksum = u'0123456789abcdef'
+    db.session.commit()
+    with requests_mock.Mocker() as m:
+        m.post(requests_mock.ANY)
+        publish_record(job.id)
+    assert job.item.payload_checksum == u'0123456789abcdef'
+
+
 def test_publish_record_fails_record_on_error(db, job):
     job.item.record = '{"uuid": "foobar"}'
     db.session.commit()
@@ -306,3 +591,21 @@ def test_prep_solr_record_converts_dates():
     now = arrow.now()
     rec = _prep_solr_record({'foo': now})
     assert rec['foo'] == now.to('utc').format('YYYY-MM-DDTHH:mm:ss') + 'Z'
+
+
+def test_geo_engine_detects_threads(app, job):
+    app.config['GDAL_THREADS'] = None
+    app.config['GDAL_OVERVIEW_THREADS'] = 2
+    app.config['GDAL_CACHEMAX'] = 256
+    with patch('kepler.tasks.cpu_count', return_value=8):
+        engine = _geo_engine(job)
+    assert engine.threads == 8
+    assert engine.overview_threads == 2
+    assert engine.config == {'GDAL_CACHEMAX': 256}
+
+
+def test_geo_engine_logs_ignored_threads(app, job):
+    with patch('kepler.tasks.gdal_version', return_value=1110100), \
+            patch.object(app.logger, 'info') as m:
+        _geo_engine(job)
+    assert 'GDAL_THREADS, GDAL_OVERVIEW_THREADS' in m.call_args[0][0]
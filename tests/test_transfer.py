@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import filecmp
+import io
+import os
+from zipfile import ZipFile
+
+import pytest
+
+from kepler.transfer import (S3Object, TransferStats, download, open_object,
+                             transfer_config, MB, MIN_CHUNKSIZE)
+
+
+@pytest.fixture
+def s3_bag(s3, bag_upload):
+    s3.client.upload_file(bag_upload, 'test_bucket', 'test_bag')
+    return s3
+
+
+def test_s3_object_has_size(s3_bag, bag_upload):
+    obj = S3Object('test_bucket', 'test_bag')
+    with io.open(bag_upload, 'rb') as fp:
+        assert obj.size == len(fp.read())
+
+
+def test_s3_object_reads_from_offset(s3_bag, bag_upload):
+    obj = S3Object('test_bucket', 'test_bag')
+    obj.seek(-22, io.SEEK_END)
+    with io.open(bag_upload, 'rb') as fp:
+        fp.seek(-22, io.SEEK_END)
+        assert obj.read(22) == fp.read(22)
+
+
+def test_s3_object_returns_empty_bytes_at_end(s3_bag):
+    obj = S3Object('test_bucket', 'test_bag')
+    obj.seek(0, io.SEEK_END)
+    assert obj.read(10) == b''
+
+
+def test_s3_object_reads_ahead_of_sequential_reads(s3_bag, bag_upload):
+    obj = S3Object('test_bucket', 'test_bag', read_ahead=2, chunk_size=1024)
+    with io.open(bag_upload, 'rb') as fp:
+        assert obj.read(1024) == fp.read(1024)
+        assert len(obj._chunks) == 1
+        assert obj.read(1024) == fp.read(1024)
+        assert [c[0] for c in obj._chunks] == [1024, 2048, 3072]
+    obj.close()
+
+
+def test_open_object_with_read_ahead_reads_object(s3_bag, bag_upload):
+    with open_object('test_bucket', 'test_bag', 1024, read_ahead=4) as fp:
+        with io.open(bag_upload, 'rb') as bag:
+            assert fp.read() == bag.read()
+
+
+def test_open_object_can_be_read_as_zip(s3_bag):
+    with open_object('test_bucket', 'test_bag', 1024) as fp:
+        names = ZipFile(fp).namelist()
+    assert 'd2fe4762-96ec-57cd-89c9-312ec097284b/data/fgdc.xml' in names
+
+
+def test_open_object_records_reads(s3_bag, bag_upload):
+    stats = TransferStats()
+    with open_object('test_bucket', 'test_bag', 1024, stats) as fp:
+        fp.read()
+    assert stats.bytes == os.path.getsize(bag_upload)
+
+
+def test_download_writes_object_to_file(s3_bag, bag_upload, tmpdir):
+    path = str(tmpdir.join('bag.zip'))
+    stats = TransferStats()
+    size = download('test_bucket', 'test_bag', path, stats)
+    assert filecmp.cmp(path, bag_upload)
+    assert size == stats.bytes == os.path.getsize(bag_upload)
+
+
+def test_transfer_config_uses_configured_settings(s3):
+    assert transfer_config(10 * 1024 ** 3) is s3.transfer_config
+
+
+def test_adaptive_transfer_config_uses_minimum_part_size(s3, monkeypatch):
+    monkeypatch.setattr(s3, 'adaptive', True)
+    config = transfer_config(20 * MB)
+    assert config.multipart_chunksize == MIN_CHUNKSIZE
+    assert config.max_concurrency == 3
+
+
+def test_adaptive_transfer_config_scales_part_size(s3, monkeypatch):
+    monkeypatch.setattr(s3, 'adaptive', True)
+    config = transfer_config(4000 * MB)
+    assert config.multipart_chunksize == 100 * MB
+    assert config.max_concurrency == 10
+
+
+def test_transfer_stats_reports_throughput():
+    stats = TransferStats()
+    stats.add(MB, 0.5)
+    stats.add(MB, 0.5)
+    assert stats.throughput == 2
@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from datetime import datetime
+import subprocess
 
-from kepler.utils import make_uuid
+from kepler.utils import as_utc, children_rss, make_uuid, rss, utcnow
 
 
 def testMakeUuidReturnsUuid5():
     assert make_uuid('BD_A8GNS_2003', 'arrowsmith.mit.edu') == \
         'c8921f5a-eac7-509b-bac5-bd1b2cb202dc'
+
+
+def test_rss_returns_resident_memory():
+    assert rss() > 0
+
+
+def test_children_rss_counts_finished_children():
+    subprocess.check_call(['true'])
+    assert children_rss() > 0
+
+
+def test_utcnow_is_timezone_aware():
+    assert utcnow().utcoffset().total_seconds() == 0
+
+
+def test_as_utc_takes_naive_datetime_as_utc():
+    assert as_utc(datetime(2001, 1, 1)) == \
+        datetime(2001, 1, 1, tzinfo=utcnow().tzinfo)
@@ -6,6 +6,7 @@ import redis
 from rq import Connection, Worker, Queue
 
 from kepler.app import create_app
+from kepler.prefetch import PrefetchWorker
 from kepler.settings import HerokuConfig
 
 
@@ -17,5 +18,8 @@ if __name__ == '__main__':
     app = create_app(HerokuConfig())
     with app.app_context():
         with Connection(conn):
-            worker = Worker(Queue())
+            if app.config['PREFETCH_BAGS']:
+                worker = PrefetchWorker(Queue())
+            else:
+                worker = Worker(Queue())
             worker.work()